@@ -0,0 +1,522 @@
+import os
+import asyncio
+import queue
+import threading
+import time
+import uuid
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from infer_and_track_violations import analyze_video_for_violations
+from replay_analysis import replay_video_for_violations
+from metrics import REGISTRY, METRICS_ENABLED, job_timer, observe_job_finished
+from result_cache import ResultCache, RESULT_CACHE
+from model_pool import get_model_pool, default_pool_size, all_pools
+from segment_analysis import analyze_video_in_segments, should_use_segments
+
+# --- CONFIGURATION ---
+# Number of videos analysed at the same time
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "0")) or default_pool_size()
+# "thread" shares the warm model pool of the API process, "process" gives every worker its own process and model
+ANALYSIS_EXECUTOR = os.environ.get("ANALYSIS_EXECUTOR", "thread")
+# Maximum number of jobs waiting in the queue before new requests get HTTP 429
+ANALYSIS_MAX_QUEUE = int(os.environ.get("ANALYSIS_MAX_QUEUE", "16"))
+# How many finished jobs are kept in memory for /jobs/{id} lookups and stats
+MAX_FINISHED_JOBS = 200
+# Progress events of a job are pushed to its event stream at most this often
+PROGRESS_EVENT_INTERVAL_SECONDS = 0.25
+
+QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED = "queued", "running", "completed", "failed", "cancelled"
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Raised inside the progress callback to stop a running analysis."""
+
+
+class QueueFullError(Exception):
+    """Raised by JobManager.submit when the queue depth limit is reached."""
+
+
+class AnalysisJob:
+    def __init__(self, params: dict):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = QUEUED
+        self.progress = {"current_frame": 0, "total_frames": 1}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.pipeline_stats = None
+        # Tahlil davomida ko'rish mumkin bo'lgan annotatsiyalangan video (HLS playlist) URL i
+        self.stream_url = None
+        # Bir xil tahlil (video, vazn va sozlamalar) kaliti va natija keshdan olinganmi
+        self.cache_key = None
+        self.cache_hit = False
+        # Shu ishni kutayotgan bir xil so'rovlar soni; bekor qilish faqat oxirgisi bekor qilganda bajariladi
+        self.sharers = 1
+        # Oqim hodisalari (violation, status, complete) kech ulangan obunachilarga qayta yuboriladi
+        self.events = []
+        self._subscribers = []
+        self._events_lock = threading.Lock()
+        self._last_progress_event = 0.0
+
+    @property
+    def queue_wait_seconds(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.created_at
+
+    @property
+    def run_seconds(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def publish(self, kind: str, data: dict):
+        """
+        Pushes an event to the job's subscribers. "progress" events are not stored (only the latest
+        progress matters); other events get a sequence id and are replayed to later subscribers.
+        """
+        with self._events_lock:
+            event_id = None
+            if kind != "progress":
+                event_id = len(self.events) + 1
+                self.events.append((event_id, kind, data))
+            subscribers = list(self._subscribers)
+        for loop, subscriber in subscribers:
+            try:
+                loop.call_soon_threadsafe(subscriber.put_nowait, (event_id, kind, data))
+            except RuntimeError:
+                # Obunachining event loopi yopilgan
+                pass
+
+    def publish_progress(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_progress_event < PROGRESS_EVENT_INTERVAL_SECONDS:
+            return
+        self._last_progress_event = now
+        self.publish("progress", {"status": self.status, **self.progress})
+
+    def set_stream_url(self, url: str):
+        self.stream_url = url
+        self.publish("stream", {"hls_url": url})
+
+    def subscribe(self, after_event_id: int = 0) -> asyncio.Queue:
+        """
+        Subscribes the running event loop to the job's events. The queue starts with the stored events
+        after after_event_id, so a subscriber that connects (or reconnects) late misses nothing.
+        """
+        subscriber = asyncio.Queue()
+        with self._events_lock:
+            for event in self.events:
+                if event[0] > after_event_id:
+                    subscriber.put_nowait(event)
+            self._subscribers.append((asyncio.get_running_loop(), subscriber))
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        with self._events_lock:
+            self._subscribers = [entry for entry in self._subscribers if entry[1] is not subscriber]
+
+    def completion_event(self) -> dict:
+        data = {"status": self.status, "result_url": f"/jobs/{self.id}/result"}
+        if self.status == COMPLETED and isinstance(self.result, dict):
+            for key in ("annotated_video_url", "hls_url", "detection_log_url", "violation_count"):
+                data[key] = self.result.get(key)
+        elif self.error:
+            data["error"] = self.error
+        return data
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "video_path": self.params.get("video_path"),
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_wait_seconds": self.queue_wait_seconds,
+            "run_seconds": self.run_seconds,
+            "pipeline_stats": self.pipeline_stats,
+            "cache_hit": self.cache_hit,
+            "sharers": self.sharers,
+            "hls_url": self.stream_url,
+        }
+
+
+def run_analysis_job(job_id: str, params: dict, progress_callback, stats_callback=None, violation_callback=None,
+                     stream_callback=None, pool_size: int = None, pool_callback=None):
+    """
+    Job target: borrows a warm model from the pool and analyses one video.
+    Segment mode reports its violations only with the result (violation_callback is not called).
+    Only single-pass mode streams the annotated video while it runs (stream_callback gets the HLS playlist URL).
+    Replay mode needs no model: it re-runs tracking and rules on the raw detections of an earlier analysis.
+
+    :param pool_size: Size of the job backend's model pool if it has to be created (one model per worker).
+    :param pool_callback: Gets the pool status before a cold pool is loaded and after the model is borrowed.
+    """
+    if params.get("mode") == "replay":
+        return replay_video_for_violations(params["video_path"], params["model_path"], progress_callback,
+                                           run_id=job_id, render=bool(params.get("render")),
+                                           backend=params.get("backend"), roi=params.get("roi"),
+                                           roi_polygons=params.get("roi_polygons"),
+                                           timer=job_timer(params.get("backend")),
+                                           violation_callback=violation_callback)
+    if should_use_segments(params["video_path"], params.get("mode", "auto")):
+        # Uzun videolar bo'laklarga ajratilib, alohida jarayonlarda parallel tahlil qilinadi
+        return analyze_video_in_segments(params["video_path"], params["model_path"], progress_callback,
+                                         run_id=job_id, num_workers=params.get("segment_workers"),
+                                         roi=params.get("roi"), roi_polygons=params.get("roi_polygons"),
+                                         backend=params.get("backend"))
+    pool = get_model_pool(params["model_path"], size=pool_size, backend=params.get("backend"))
+    if pool_callback and not pool.is_warm:
+        # Boshqa backend birinchi marta so'ralganda pool shu yerda (acquire ichida) yuklanadi
+        pool_callback(pool.status())
+    with pool.acquire() as model:
+        if pool_callback:
+            pool_callback(pool.status())
+        return analyze_video_for_violations(params["video_path"], params["model_path"], progress_callback,
+                                            model=model, run_id=job_id, stats_callback=stats_callback,
+                                            roi=params.get("roi"), roi_polygons=params.get("roi_polygons"),
+                                            timer=job_timer(params.get("backend")),
+                                            violation_callback=violation_callback, backend=params.get("backend"),
+                                            stream_callback=stream_callback)
+
+
+def _init_process_worker(model_path):
+    # Har bir worker jarayoni o'zining bitta modelini yuklab, warm-up qiladi
+    get_model_pool(model_path, size=1).start()
+
+
+def _warm_process_worker(model_path):
+    # Isitilgan standart pool holati (worker PID i bilan) API jarayoniga qaytariladi
+    return dict(get_model_pool(model_path, size=1).status(), pid=os.getpid())
+
+
+def _run_in_process(job_id, params, events, cancelled):
+    last_progress = 0.0
+
+    def progress_callback(current_frame, total_frames):
+        nonlocal last_progress
+        # Har kadrda ikkita IPC chaqiruv qimmat: bekor qilish va progress har 0.25 s da (va oxirgi kadrda) tekshiriladi
+        now = time.monotonic()
+        if now - last_progress < PROGRESS_EVENT_INTERVAL_SECONDS and current_frame < total_frames - 1:
+            return
+        last_progress = now
+        if job_id in cancelled:
+            raise JobCancelled()
+        events.put(("progress", job_id, {"current_frame": current_frame, "total_frames": total_frames}))
+
+    def stats_callback(pipeline_stats):
+        events.put(("pipeline_stats", job_id, pipeline_stats))
+
+    def violation_callback(entry):
+        events.put(("violation", job_id, entry))
+
+    def stream_callback(url):
+        events.put(("stream", job_id, url))
+
+    def pool_callback(status):
+        # Worker jarayonlaridagi poollar API jarayonida ko'rinmaydi, holati /health uchun yuboriladi
+        events.put(("pool", job_id, dict(status, pid=os.getpid())))
+
+    try:
+        # Har bir worker jarayoni har bir backend uchun bitta model saqlaydi
+        return run_analysis_job(job_id, params, progress_callback, stats_callback, violation_callback,
+                                stream_callback, pool_size=1, pool_callback=pool_callback)
+    finally:
+        # Worker jarayonidagi metrikalar (model yuklash, bosqichlar vaqti) API jarayoniga yuboriladi
+        if METRICS_ENABLED:
+            events.put(("metrics", job_id, REGISTRY.drain()))
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class JobManager:
+    """
+    Queue of analysis jobs served by a fixed number of workers.
+    Workers are threads in this process, or threads that hand each job to a process pool.
+    """
+
+    def __init__(self, model_path, num_workers: int = ANALYSIS_WORKERS, executor: str = ANALYSIS_EXECUTOR,
+                 max_queue_depth: int = ANALYSIS_MAX_QUEUE, result_cache: bool = RESULT_CACHE):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor '{executor}', expected 'thread' or 'process'")
+        self.model_path = model_path
+        self.num_workers = max(1, num_workers)
+        self.executor = executor
+        self.max_queue_depth = max_queue_depth
+        self._jobs = {}
+        self._finished = deque()
+        self._queue = queue.Queue()
+        self._queued_count = 0
+        self._lock = threading.Lock()
+        self._workers = []
+        self._process_pool = None
+        self._process_warmup = []
+        self._manager = None
+        # Natijalar keshi va bajarilayotgan (navbatdagi) ishlar kesh kaliti bo'yicha
+        self.result_cache = ResultCache() if result_cache else None
+        self._inflight = {}
+        # Worker jarayonlaridagi model poollari holati: (pid, backend) -> status
+        self._worker_pools = {}
+
+    def start(self):
+        if self.executor == "process":
+            ctx = multiprocessing.get_context("spawn")
+            self._manager = ctx.Manager()
+            self._events = self._manager.Queue()
+            self._cancelled = self._manager.dict()
+            self._process_pool = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=ctx,
+                                                     initializer=_init_process_worker,
+                                                     initargs=(self.model_path,))
+            # Barcha worker jarayonlarini oldindan ishga tushirib modellarni isitamiz
+            self._process_warmup = [self._process_pool.submit(_warm_process_worker, self.model_path)
+                                    for _ in range(self.num_workers)]
+            threading.Thread(target=self._event_listener, name="analysis-events", daemon=True).start()
+        else:
+            threading.Thread(target=get_model_pool(self.model_path, size=self.num_workers).start,
+                             name="model-pool-warmup", daemon=True).start()
+
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"analysis-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def is_warm(self) -> bool:
+        if self.executor == "process":
+            return bool(self._process_warmup) and all(f.done() and not f.exception() for f in self._process_warmup)
+        return get_model_pool(self.model_path).is_warm
+
+    def pool_status(self) -> list:
+        """Status of every model pool, including pools of non-default backends in worker processes."""
+        if self.executor == "process":
+            pools = {(status["pid"], status["backend"]): status
+                     for status in (f.result() for f in self._process_warmup if f.done() and not f.exception())}
+            with self._lock:
+                pools.update(self._worker_pools)
+            return list(pools.values())
+        return [pool.status() for pool in all_pools()]
+
+    def submit(self, params: dict, cache_key: str = None) -> AnalysisJob:
+        """
+        Queues an analysis. With a cache_key (result_cache.analysis_cache_key), a cached result is returned
+        as an already completed job, and an identical queued or running job is returned instead of a new one.
+        """
+        job = AnalysisJob(params)
+        with self._lock:
+            if cache_key and self.result_cache is not None:
+                shared = self._inflight.get(cache_key)
+                if shared is not None:
+                    shared.sharers += 1
+                    return shared
+                cached = self.result_cache.get(cache_key)
+                if cached is not None:
+                    job.cache_key, job.cache_hit = cache_key, True
+                    job.result = dict(cached, cache_hit=True)
+                    job.status = COMPLETED
+                    job.started_at = job.finished_at = time.time()
+                    job.progress = {"current_frame": 1, "total_frames": 1}
+                    self._jobs[job.id] = job
+                    self._remember_finished(job)
+                    job.publish("complete", job.completion_event())
+                    return job
+            if self._queued_count >= self.max_queue_depth:
+                raise QueueFullError(f"Analysis queue is full ({self._queued_count} jobs waiting)")
+            self._jobs[job.id] = job
+            self._queued_count += 1
+            if cache_key and self.result_cache is not None:
+                job.cache_key = cache_key
+                self._inflight[cache_key] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str, force: bool = False):
+        """
+        Cancels a queued or running job. Returns the job, or None if the id is unknown.
+        A job shared by identical requests (see submit) keeps running until every sharer has cancelled it,
+        unless force is set.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return job
+            if job.sharers > 1 and not force:
+                job.sharers -= 1
+                return job
+            job.cancel_event.set()
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+                self._queued_count -= 1
+                self._remember_finished(job)
+                self._inflight.pop(job.cache_key, None)
+            elif self.executor == "process":
+                self._cancelled[job.id] = True
+        if job.status == CANCELLED:
+            job.publish("complete", job.completion_event())
+        return job
+
+    def _remember_finished(self, job):
+        # Faqat oxirgi MAX_FINISHED_JOBS ta tugagan ishni xotirada saqlaymiz
+        self._finished.append(job)
+        while len(self._finished) > MAX_FINISHED_JOBS:
+            old = self._finished.popleft()
+            self._jobs.pop(old.id, None)
+
+    def shutdown(self):
+        """Cancels running jobs and stops the worker processes (process executor only)."""
+        with self._lock:
+            running = [job.id for job in self._jobs.values() if job.status in (QUEUED, RUNNING)]
+        for job_id in running:
+            self.cancel(job_id, force=True)
+        if self.result_cache is not None:
+            self.result_cache.flush()
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+    @property
+    def worker_pids(self) -> list:
+        """PIDs of the analysis worker processes (process executor only)."""
+        return [f.result()["pid"] for f in self._process_warmup if f.done() and not f.exception()]
+
+    def _event_listener(self):
+        while True:
+            try:
+                kind, job_id, payload = self._events.get()
+            except (EOFError, OSError):
+                # Manager jarayoni to'xtatildi (ilova o'chmoqda)
+                return
+            if kind == "metrics":
+                REGISTRY.merge(payload)
+                continue
+            if kind == "pool":
+                with self._lock:
+                    self._worker_pools[(payload["pid"], payload["backend"])] = payload
+                continue
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if kind == "progress":
+                job.progress = payload
+                job.publish_progress()
+            elif kind == "violation":
+                job.publish("violation", payload)
+            elif kind == "stream":
+                job.set_stream_url(payload)
+            elif kind == "pipeline_stats":
+                job.pipeline_stats = payload
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if job.status == CANCELLED:
+                    continue
+                self._queued_count -= 1
+                job.status = RUNNING
+                job.started_at = time.time()
+            job.publish_progress(force=True)
+
+            try:
+                if self.executor == "process":
+                    future = self._process_pool.submit(_run_in_process, job.id, job.params, self._events,
+                                                       self._cancelled)
+                    result = future.result()
+                else:
+                    result = run_analysis_job(job.id, job.params, self._progress_callback(job),
+                                              self._stats_callback(job), lambda entry: job.publish("violation", entry),
+                                              job.set_stream_url, pool_size=self.num_workers)
+                job.result = result
+                job.status = COMPLETED
+                print(f"Analysis job {job.id} completed.")
+            except JobCancelled:
+                job.status = CANCELLED
+                print(f"Analysis job {job.id} cancelled.")
+            except Exception as e:
+                print(f"Error during video analysis job {job.id}: {e}")
+                job.error = str(e)
+                job.result = {"error": str(e)}
+                job.status = FAILED
+            finally:
+                job.finished_at = time.time()
+                if job.status == COMPLETED and job.cache_key:
+                    # Kesh yozuvi in-flight yozuvidan oldin qo'shiladi, aks holda bir xil so'rov qayta ishga tushadi
+                    try:
+                        self.result_cache.put(job.cache_key, job.result)
+                    except Exception as e:
+                        print(f"⚠️ Could not cache the result of job {job.id}: {e}")
+                with self._lock:
+                    self._inflight.pop(job.cache_key, None)
+                    self._remember_finished(job)
+                    if self.executor == "process":
+                        self._cancelled.pop(job.id, None)
+                self._observe_finished(job)
+                job.publish("complete", job.completion_event())
+
+    @staticmethod
+    def _observe_finished(job):
+        frames = mode = None
+        if job.status == COMPLETED and isinstance(job.result, dict):
+            frames = job.result.get("inference_schedule", {}).get("frames")
+            mode = "segments" if "segments" in job.result else "single"
+        observe_job_finished(job.status, mode, frames, job.run_seconds, job.queue_wait_seconds)
+
+    @staticmethod
+    def _progress_callback(job):
+        def update_progress_callback(current_frame, total_frames):
+            if job.cancel_event.is_set():
+                raise JobCancelled()
+            job.progress = {"current_frame": current_frame, "total_frames": total_frames}
+            job.publish_progress()
+
+        return update_progress_callback
+
+    @staticmethod
+    def _stats_callback(job):
+        def update_stats_callback(pipeline_stats):
+            job.pipeline_stats = pipeline_stats
+
+        return update_stats_callback
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            queued = self._queued_count
+        counts = {state: 0 for state in (QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED)}
+        for job in jobs:
+            counts[job.status] += 1
+        waits = [job.queue_wait_seconds for job in jobs if job.queue_wait_seconds is not None]
+        runs = [job.run_seconds for job in jobs if job.run_seconds is not None]
+        return {
+            "executor": self.executor,
+            "workers": self.num_workers,
+            "queue_depth": queued,
+            "max_queue_depth": self.max_queue_depth,
+            "jobs": counts,
+            "queue_wait_seconds": {"mean": sum(waits) / len(waits) if waits else None,
+                                   "p50": _percentile(waits, 50), "p95": _percentile(waits, 95)},
+            "run_seconds": {"mean": sum(runs) / len(runs) if runs else None,
+                            "p50": _percentile(runs, 50), "p95": _percentile(runs, 95)},
+            "result_cache": self.result_cache.stats() if self.result_cache is not None else {"enabled": False},
+        }
@@ -0,0 +1,218 @@
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+from detections import format_timestamp
+
+# --- CONFIGURATION ---
+# "jsonl" (one JSON object per tracked object per line) or "npz" (columnar NumPy chunks)
+DETECTION_LOG_FORMAT = os.environ.get("DETECTION_LOG_FORMAT", "jsonl")
+# JSON Lines: the file is flushed to disk every this many frames
+LOG_FLUSH_FRAMES = 100
+# npz: rows buffered in memory before a chunk file is written
+LOG_CHUNK_ROWS = 65536
+
+LOG_FILE_NAMES = {"jsonl": "detection_log.jsonl", "npz": "detection_log"}
+
+
+def _columns_as_lists(track_ids, cls_ids, confs, boxes):
+    return (np.asarray(track_ids).tolist(), np.asarray(cls_ids).tolist(),
+            np.asarray(confs, dtype=np.float32).tolist(), np.asarray(boxes).reshape(-1, 4).astype(int).tolist())
+
+
+class DetectionLogWriter:
+    """
+    Base class of detection log backends. Rows are written one frame at a time from columns
+    (track ids, class ids, confidences, integer boxes), so memory use does not grow with video length.
+    Rows of frames without inference (boxes propagated by the tracker) are marked "estimated".
+    """
+
+    def __init__(self, class_names: dict, fps: float):
+        self.class_names = class_names
+        self.fps = fps
+        self._name_to_id = {name: cls_id for cls_id, name in class_names.items()}
+        self.rows = 0
+
+    def write_frame(self, frame_idx: int, track_ids, cls_ids, confs, boxes, estimated: bool = False):
+        raise NotImplementedError
+
+    def write_entries(self, entries):
+        """Writes log entry dicts ({"frame", "id", "class", "conf", "box"[, "estimated"]}) sorted by frame."""
+        frame_entries = []
+        for entry in entries:
+            if frame_entries and entry["frame"] != frame_entries[0]["frame"]:
+                self._write_entry_group(frame_entries)
+                frame_entries = []
+            frame_entries.append(entry)
+        if frame_entries:
+            self._write_entry_group(frame_entries)
+
+    def _write_entry_group(self, entries):
+        self.write_frame(entries[0]["frame"], [entry["id"] for entry in entries],
+                         [self._name_to_id.get(entry["class"], -1) for entry in entries],
+                         [entry["conf"] for entry in entries], [entry["box"] for entry in entries],
+                         estimated=entries[0].get("estimated", False))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryLogWriter(DetectionLogWriter):
+    """Keeps entry dicts in a list; the ViolationAnalyzer default when no log_writer is given (benchmarks, tools)."""
+
+    def __init__(self, class_names: dict, fps: float):
+        super().__init__(class_names, fps)
+        self.entries = []
+
+    def write_frame(self, frame_idx, track_ids, cls_ids, confs, boxes, estimated=False):
+        time_str = format_timestamp(frame_idx, self.fps)
+        for track_id, cls_id, conf, box in zip(*_columns_as_lists(track_ids, cls_ids, confs, boxes)):
+            entry = {"frame": frame_idx, "time": time_str, "id": track_id,
+                     "class": self.class_names.get(cls_id, 'Unknown'), "conf": conf, "box": box}
+            if estimated:
+                entry["estimated"] = True
+            self.entries.append(entry)
+        self.rows += len(track_ids)
+
+
+class JsonlLogWriter(DetectionLogWriter):
+    """Streams one JSON object per tracked object per line, in the same shape as the former JSON log."""
+
+    def __init__(self, path, class_names: dict, fps: float, flush_frames: int = LOG_FLUSH_FRAMES):
+        super().__init__(class_names, fps)
+        self.path = Path(path)
+        self.flush_frames = flush_frames
+        self._frames_since_flush = 0
+        self._file = open(self.path, 'w')
+
+    def write_frame(self, frame_idx, track_ids, cls_ids, confs, boxes, estimated=False):
+        time_str = format_timestamp(frame_idx, self.fps)
+        lines = []
+        for track_id, cls_id, conf, box in zip(*_columns_as_lists(track_ids, cls_ids, confs, boxes)):
+            entry = {"frame": frame_idx, "time": time_str, "id": track_id,
+                     "class": self.class_names.get(cls_id, 'Unknown'), "conf": conf, "box": box}
+            if estimated:
+                entry["estimated"] = True
+            lines.append(json.dumps(entry))
+        if lines:
+            self._file.write("\n".join(lines) + "\n")
+            self.rows += len(lines)
+        self._frames_since_flush += 1
+        if self._frames_since_flush >= self.flush_frames:
+            self._file.flush()
+            self._frames_since_flush = 0
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class NpzChunkLogWriter(DetectionLogWriter):
+    """
+    Columnar log: a directory of chunk_NNNNN.npz files with frame, id, cls (int32), conf (float32),
+    box (N x 4 int32) and estimated (bool) arrays, plus meta.json with the class names and fps.
+    """
+
+    def __init__(self, path, class_names: dict, fps: float, chunk_rows: int = LOG_CHUNK_ROWS):
+        super().__init__(class_names, fps)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk_rows = chunk_rows
+        self._columns = {"frame": [], "id": [], "cls": [], "conf": [], "box": [], "estimated": []}
+        self._buffered_rows = 0
+        self._chunks = 0
+        with open(self.path / 'meta.json', 'w') as f:
+            json.dump({"fps": fps, "class_names": {str(k): v for k, v in class_names.items()}}, f)
+
+    def write_frame(self, frame_idx, track_ids, cls_ids, confs, boxes, estimated=False):
+        count = len(track_ids)
+        if not count:
+            return
+        self._columns["frame"].append(np.full(count, frame_idx, dtype=np.int32))
+        self._columns["id"].append(np.asarray(track_ids, dtype=np.int32))
+        self._columns["cls"].append(np.asarray(cls_ids, dtype=np.int32))
+        self._columns["conf"].append(np.asarray(confs, dtype=np.float32))
+        self._columns["box"].append(np.asarray(boxes).reshape(-1, 4).astype(np.int32))
+        self._columns["estimated"].append(np.full(count, estimated, dtype=bool))
+        self._buffered_rows += count
+        self.rows += count
+        if self._buffered_rows >= self.chunk_rows:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if not self._buffered_rows:
+            return
+        arrays = {name: np.concatenate(parts) for name, parts in self._columns.items()}
+        np.savez_compressed(self.path / f"chunk_{self._chunks:05d}.npz", **arrays)
+        self._chunks += 1
+        self._columns = {name: [] for name in self._columns}
+        self._buffered_rows = 0
+
+    def close(self):
+        self._write_chunk()
+
+
+def open_log_writer(result_dir, class_names: dict, fps: float, log_format: str = None) -> DetectionLogWriter:
+    """Creates the detection log of a run in result_dir using DETECTION_LOG_FORMAT (or log_format)."""
+    log_format = log_format or DETECTION_LOG_FORMAT
+    if log_format == "jsonl":
+        return JsonlLogWriter(Path(result_dir) / LOG_FILE_NAMES["jsonl"], class_names, fps)
+    if log_format == "npz":
+        return NpzChunkLogWriter(Path(result_dir) / LOG_FILE_NAMES["npz"], class_names, fps)
+    raise ValueError(f"Unknown detection log format '{log_format}', expected 'jsonl' or 'npz'")
+
+
+def find_detection_log(result_dir):
+    """Returns the detection log path in a result directory, or None."""
+    for name in LOG_FILE_NAMES.values():
+        path = Path(result_dir) / name
+        if path.exists():
+            return path
+    return None
+
+
+def iter_log_entries(path):
+    """Yields the log entry dicts of a JSON Lines or npz detection log, in frame order."""
+    path = Path(path)
+    if path.is_dir():
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        class_names = {int(k): v for k, v in meta["class_names"].items()}
+        for chunk_path in sorted(path.glob("chunk_*.npz")):
+            with np.load(chunk_path) as chunk:
+                columns = [chunk[name].tolist() for name in ("frame", "id", "cls", "conf", "box", "estimated")]
+            for frame_idx, track_id, cls_id, conf, box, estimated in zip(*columns):
+                entry = {"frame": frame_idx, "time": format_timestamp(frame_idx, meta["fps"]),
+                         "id": track_id, "class": class_names.get(cls_id, 'Unknown'), "conf": conf, "box": box}
+                if estimated:
+                    entry["estimated"] = True
+                yield entry
+    else:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_json_export(path, batch_size: int = 1000):
+    """Streams the log as one JSON array (the former detection_log.json format) in text pieces."""
+    yield "["
+    first = True
+    batch = []
+    for entry in iter_log_entries(path):
+        batch.append(json.dumps(entry))
+        if len(batch) >= batch_size:
+            yield ("" if first else ",") + ",".join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ("" if first else ",") + ",".join(batch)
+    yield "]"
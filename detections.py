@@ -0,0 +1,72 @@
+import numpy as np
+
+
+def format_timestamp(frame_idx: int, fps: float) -> str:
+    """Formats a frame index as HH:MM:SS.ss."""
+    timestamp = frame_idx / fps
+    return f"{int(timestamp // 3600):02}:{int((timestamp % 3600) // 60):02}:{timestamp % 60:05.2f}"
+
+
+class FrameDetections:
+    """
+    Detections of one frame as contiguous NumPy arrays: xyxy (N, 4) float32, conf (N,) float32 and
+    cls (N,) int32. Built with a single device->host copy per frame instead of per-box tensor calls.
+    """
+
+    __slots__ = ("xyxy", "conf", "cls")
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = np.ascontiguousarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.ascontiguousarray(conf, dtype=np.float32).reshape(-1)
+        self.cls = np.ascontiguousarray(cls, dtype=np.int32).reshape(-1)
+
+    def __len__(self):
+        return len(self.conf)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty((0, 4)), np.empty(0), np.empty(0))
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        Converts an ultralytics Results object (or None) to columns.
+
+        :param result: Results of one frame; its boxes.data rows are [x1, y1, x2, y2, (track_id,) conf, cls].
+        """
+        if result is None or result.boxes is None or len(result.boxes) == 0:
+            return cls.empty()
+        data = result.boxes.data.cpu().numpy()
+        return cls(data[:, :4], data[:, -2], data[:, -1])
+
+    def centroids(self):
+        """(N, 2) box centres."""
+        return np.stack(((self.xyxy[:, 0] + self.xyxy[:, 2]) / 2, (self.xyxy[:, 1] + self.xyxy[:, 3]) / 2), axis=1)
+
+    def select(self, mask):
+        """Detections where the boolean mask (or index array) is set."""
+        return FrameDetections(self.xyxy[mask], self.conf[mask], self.cls[mask])
+
+
+def resolve_class_ids(class_names: dict, *names) -> list:
+    """
+    Maps class names to model class ids once per video, so per-frame filtering compares integers.
+    Names the model does not have map to -1, which matches no detection.
+    """
+    name_to_id = {name: cls_id for cls_id, name in class_names.items()}
+    return [name_to_id.get(name, -1) for name in names]
+
+
+def box_iou(boxes_a, boxes_b):
+    """(A, B) intersection-over-union matrix of (A, 4) and (B, 4) xyxy boxes."""
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
@@ -0,0 +1,134 @@
+import os
+from collections import deque
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from video_encoder import open_video_writer
+
+# --- CONFIGURATION ---
+# JPEG quality of buffered frames (default 90: a 2 s pre-roll of 1080p frames takes ~10-20 MB instead of ~370 MB
+# per running job); 0 keeps raw frames (fastest, ~width*height*3 bytes per frame)
+RING_BUFFER_JPEG_QUALITY = int(os.environ.get("RING_BUFFER_JPEG_QUALITY", "90"))
+# Upper bound on clips being recorded at the same time (one encoder process each)
+MAX_OPEN_CLIPS = 16
+
+
+class FrameRingBuffer:
+    """
+    Keeps the last `capacity` frames of a video. Frames are copied on push (raw or JPEG-compressed),
+    so callers may draw on their frame afterwards.
+    """
+
+    def __init__(self, capacity: int, jpeg_quality: int = RING_BUFFER_JPEG_QUALITY):
+        self.capacity = max(1, capacity)
+        self.jpeg_quality = jpeg_quality
+        self._frames = deque(maxlen=self.capacity)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, frame_idx: int, frame):
+        if self.jpeg_quality:
+            ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                raise RuntimeError(f"Could not JPEG-encode frame {frame_idx}")
+            self._frames.append((frame_idx, encoded))
+        else:
+            self._frames.append((frame_idx, frame.copy()))
+
+    def _decode(self, data):
+        return cv2.imdecode(data, cv2.IMREAD_COLOR) if self.jpeg_quality else data
+
+    def get(self, frame_idx: int):
+        """Returns the buffered frame with this index, or None if it already left the buffer."""
+        for idx, data in reversed(self._frames):
+            if idx == frame_idx:
+                return self._decode(data)
+            if idx < frame_idx:
+                break
+        return None
+
+    def frames_since(self, first_frame_idx: int):
+        """Yields (frame_idx, frame) of buffered frames with index >= first_frame_idx, oldest first."""
+        for idx, data in list(self._frames):
+            if idx >= first_frame_idx:
+                yield idx, self._decode(data)
+
+    def nbytes(self) -> int:
+        return sum(np.asarray(data).nbytes for _, data in self._frames)
+
+
+class ViolationClipRecorder:
+    """
+    Writes the screenshot and the +-clip_seconds clip of every violation during the main pass.
+    The pre-roll comes from a ring buffer of recent raw frames, the post-roll is appended as the next
+    frames are pushed, so the source video is never reopened or decoded twice. Memory is bounded by the
+    ring buffer size, whatever the number of violations.
+    """
+
+    def __init__(self, violation_dir: Path, screenshot_dir: Path, fps: float, size: tuple, clip_seconds: float,
+                 jpeg_quality: int = RING_BUFFER_JPEG_QUALITY, max_open_clips: int = MAX_OPEN_CLIPS):
+        self.violation_dir = Path(violation_dir)
+        self.screenshot_dir = Path(screenshot_dir)
+        self.fps = fps
+        self.size = size
+        self.clip_frames = int(clip_seconds * fps)
+        self.max_open_clips = max_open_clips
+        # Buzilish kadri ham bufferda bo'lishi kerak, shuning uchun +1
+        self.buffer = FrameRingBuffer(self.clip_frames + 1, jpeg_quality)
+        self._open_clips = []
+
+    @staticmethod
+    def artifact_names(info: dict):
+        time_filename = info['time_str'].replace(':', '-').replace('.', '_')
+        suffix = f"{info['frame_idx']}_{time_filename}_CarID_{info['car_id']}"
+        return f"violation_frame_{suffix}.jpg", f"violation_clip_{suffix}.mp4"
+
+    def push(self, frame_idx: int, frame):
+        """Adds an undrawn frame. Call for every frame, in order, before drawing on it."""
+        self.buffer.push(frame_idx, frame)
+        for clip in list(self._open_clips):
+            if frame_idx < clip["end_frame"]:
+                clip["writer"].write(frame)
+            if frame_idx + 1 >= clip["end_frame"]:
+                self._finish(clip)
+
+    def add_violation(self, info: dict):
+        """
+        Saves the screenshot and starts the clip of a violation at info['frame_idx'], which must be the
+        most recently pushed frame.
+
+        :return: (screenshot path, clip path); the clip path is None if the clip was skipped.
+        """
+        screenshot_name, clip_name = self.artifact_names(info)
+        screenshot_path = self.screenshot_dir / screenshot_name
+        screenshot_frame = self.buffer.get(info['frame_idx'])
+        if screenshot_frame is not None:
+            cv2.imwrite(str(screenshot_path), screenshot_frame)
+            print(f"✅ Screenshot saved: {screenshot_path}")
+        else:
+            print(f"❌ Error: Could not retrieve screenshot frame for frame_idx {info['frame_idx']}.")
+
+        if len(self._open_clips) >= self.max_open_clips:
+            print(f"⚠️ {self.max_open_clips} clips are already being recorded, skipping clip of frame {info['frame_idx']}")
+            return screenshot_path, None
+
+        clip_path = self.violation_dir / clip_name
+        clip = {"path": clip_path, "end_frame": info['frame_idx'] + self.clip_frames,
+                "writer": open_video_writer(clip_path, self.fps, self.size)}
+        for _, frame in self.buffer.frames_since(info['frame_idx'] - self.clip_frames):
+            clip["writer"].write(frame)
+        self._open_clips.append(clip)
+        return screenshot_path, clip_path
+
+    def _finish(self, clip):
+        self._open_clips.remove(clip)
+        clip["writer"].release()
+        print(f"✅ Violation clip saved: {clip['path']}")
+
+    def close(self):
+        """Finishes clips whose post-roll was cut short by the end of the video."""
+        for clip in list(self._open_clips):
+            self._finish(clip)
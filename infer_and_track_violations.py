@@ -1,65 +1,370 @@
 import os
 import cv2
-import json
-from ultralytics import YOLO
 from norfair import Detection, Tracker
 from tqdm import tqdm
 import numpy as np
 from datetime import datetime
 from pathlib import Path
 import sys
-import subprocess  # FFmpeg ni ishlatish uchun qo'shildi
+import time
+
+from model_pool import load_yolo_model
+from video_pipeline import VideoPipeline, PIPELINE_QUEUE_SIZE
+from video_encoder import HLS_OUTPUT, HLS_PLAYLIST_NAME, open_video_writer
+from frame_ring_buffer import ViolationClipRecorder
+from detections import FrameDetections, format_timestamp, resolve_class_ids
+from inference_scheduler import InferenceScheduler, SCHEDULE_LOG_NAME, INFERENCE_SCHEDULE
+from detection_log import MemoryLogWriter, open_log_writer
+from violation_rules import RuleEngine
+from scene_layout import SceneLayoutCache, SCENE_LAYOUT_CACHE
+from light_classifier import LightStateClassifier
+from raw_detections import RAW_DETECTION_STORE, RawDetectionRecorder, raw_store_path
+from roi_inference import make_roi_detector
+from video_upload import open_video_capture
+from stage_timing import NULL_TIMER
 
 # Suppress OMP and MKL warnings if they're not fully configured
 os.environ["OMP_NUM_THREADS"] = "2"
 os.environ["MKL_NUM_THREADS"] = "2"
 
+# --- DEFAULT ANALYSIS CONFIGURATION ---
+CONFIDENCE_THRESHOLD = 0.5  # Minimum confidence score for a detection to be considered
+FRAME_SKIP = 1  # Process every Nth frame (1 = every frame)
+IMGSZ = 640  # Image size for inference
+BATCH_SIZE = 4  # Frames per inference call; "auto" picks the fastest batch size on this host
+CLIP_DURATION_SECONDS = 2  # Seconds of video saved before and after a violation
+RESULTS_ROOT = Path('/app/results')  # Har bir tahlil shu katalog ichida o'z papkasini oladi
+TRACKER_DISTANCE_THRESHOLD = 50  # Max centroid distance (pixels) for norfair to match a detection to a track
 
-def analyze_video_for_violations(video_path: str, model_path: str, progress_callback=None):
-    # --- 1. CONFIGURATION ---
-    CONFIDENCE_THRESHOLD = 0.5
-    FRAME_SKIP = 1
-    IMGSZ = 640
-    CLIP_DURATION_SECONDS = 2
+# Batch sizes tried by autotune_batch_size and how many timed calls each gets
+AUTOTUNE_BATCH_SIZES = (1, 2, 4, 8, 16)
+AUTOTUNE_ITERATIONS = 3
 
-    # --- 2. FILE AND DIRECTORY SETUP ---
-    current_time_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    RESULT_DIR = Path('/app/results') / current_time_str
-    VIOLATION_DIR = RESULT_DIR / 'violations'
+VIOLATION_COLOR = (0, 0, 255)
 
-    RESULT_DIR.mkdir(parents=True, exist_ok=True)
-    VIOLATION_DIR.mkdir(parents=True, exist_ok=True)
-    SCREENSHOT_DIR = VIOLATION_DIR / 'screenshots'
-    SCREENSHOT_DIR.mkdir(parents=True, exist_ok=True)
+_autotuned_batch_sizes = {}
 
-    print(f"Results will be saved to: {RESULT_DIR}")
 
-    RAW_ANNOTATED_VIDEO_PATH = RESULT_DIR / 'temp_annotated_video.mp4' # <<< Vaqtincha annotated video
-    FINAL_ANNOTATED_VIDEO_PATH = RESULT_DIR / 'annotated_video.mp4'    # <<< Yakuniy annotated video
+def make_class_colors(class_names: dict) -> dict:
+    """Deterministic per-class colours, identical to the former np.random.seed(42) palette."""
+    rng = np.random.RandomState(42)
+    return {cls_id: [int(c) for c in rng.randint(50, 255, size=3)] for cls_id in class_names.keys()}
+
 
-    JSON_LOG_PATH = RESULT_DIR / 'detection_log.json'
+def draw_tracked_box(frame, box, label: str, color):
+    x1, y1, x2, y2 = box
+    cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+    cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+
+
+def prepare_result_dirs(run_id: str = None):
+    """
+    Creates the timestamped result directory of one analysis run.
+
+    :return: (run directory name, result dir, violation dir, screenshot dir)
+    """
+    current_time_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    if run_id:
+        current_time_str = f"{current_time_str}_{run_id[:8]}"
+    result_dir = RESULTS_ROOT / current_time_str
+    violation_dir = result_dir / 'violations'
+    screenshot_dir = violation_dir / 'screenshots'
+    screenshot_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Results will be saved to: {result_dir}")
+    return current_time_str, result_dir, violation_dir, screenshot_dir
+
+
+class ViolationAnalyzer:
+    """
+    Per-video tracking and violation rule state: norfair tracker, rule engine, violations and detection log.
+    Used by the single-process pipeline and by segment workers (with draw=False).
+    Frames without inference get their boxes from the tracker's motion estimates (propagate_frame).
+    With scene_cache, static objects (crosswalks, lines, traffic-light housings) leave the tracker once
+    their layout is locked (see SceneLayoutCache).
+    """
+
+    def __init__(self, class_names: dict, fps: float, draw: bool = True, min_violation_frame: int = 0,
+                 rule_names=None, log_writer=None, scene_cache: bool = SCENE_LAYOUT_CACHE, timer=None,
+                 recorder=None, light_classifier=None):
+        self.class_names = class_names
+        self.fps = fps
+        self.draw = draw
+        # Segment workerlari overlap qismidagi qoidabuzarliklarni hisobga olmaydi
+        self.min_violation_frame = min_violation_frame
+        self.class_colors = make_class_colors(class_names)
+        self.rule_engine = RuleEngine(class_names, fps, rule_names)
+        # Harakatlanuvchi obyektlar soni inference rejalashtiruvchisiga beriladi
+        self.dynamic_cls = np.array(resolve_class_ids(class_names, 'car', 'person'), dtype=np.int32)
+        self.dynamic_track_count = 0
+        self.tracker = Tracker(distance_function="euclidean", distance_threshold=TRACKER_DISTANCE_THRESHOLD)
+        # Statik sahna obyektlari warm-up dan keyin keshlanadi, trekerga faqat harakatlanuvchi obyektlar boradi
+        self.scene = SceneLayoutCache(class_names, fps) if scene_cache else None
+        # Svetofor holati har kadrda ma'lum svetofor qutilari kesimlaridan aniqlanadi (detektor kamroq ishlaganda ham)
+        # recorder: xom detektsiyalar va svetofor holatlari replay uchun saqlanadi (RawDetectionRecorder)
+        self.recorder = recorder
+        self.light_classifier = light_classifier or LightStateClassifier(class_names, recorder=recorder)
+        # Detektsiya logi oqim sifatida yoziladi; writer berilmasa yozuvlar xotirada saqlanadi
+        self.log_writer = log_writer if log_writer is not None else MemoryLogWriter(class_names, fps)
+        self.violations = []
+        # Bosqichlar vaqti (benchmark uchun StageTimer); berilmasa hech narsa o'lchanmaydi
+        self.timer = timer or NULL_TIMER
+        # Oxirgi inference kadri treklari va ularning tezligi (piksel/kadr), oraliq kadrlar uchun
+        self._last_keyframe = None
+        self._last_tracks = None
+
+    @property
+    def first_violation_info(self):
+        return self.violations[0] if self.violations else None
+
+    @property
+    def log(self):
+        """Log entries kept in memory (only when no log_writer was given)."""
+        return self.log_writer.entries
+
+    def process_frame(self, frame_idx: int, frame, result):
+        """
+        Tracks the detections of one frame, evaluates the violation rules, draws boxes and logs them.
+
+        :param result: ultralytics Results of the frame, or FrameDetections.
+        """
+        if not isinstance(result, FrameDetections):
+            with self.timer.measure("convert"):
+                result = FrameDetections.from_result(result)
+        if self.recorder is not None:
+            self.recorder.add_detections(frame_idx, result)
+        with self.timer.measure("track"):
+            track_ids, tracks, velocity, gap = self._track(frame_idx, result)
+        self.dynamic_track_count = int(np.isin(tracks.cls, self.dynamic_cls).sum())
+        # Kalman filtri bitta update qadamidagi siljishni beradi; kadrga bo'lib saqlaymiz
+        self._last_tracks = (track_ids, tracks, velocity / gap)
+        self._last_keyframe = frame_idx
+        self._emit_frame(frame_idx, frame, track_ids, tracks, estimated=False)
+
+    def _track(self, frame_idx: int, detections: FrameDetections):
+        """:return: (track ids, tracked objects, per-update velocity, frames since the last inference frame)"""
+        if self.scene is not None:
+            detections = self.scene.filter(frame_idx, detections)
+
+        # Detection.data = (kadr detektsiyalari, qator indeksi); trekerdagi obyekt oldingi kadr detektsiyasiga
+        # ishora qilishi mumkin, shuning uchun massivlar ham saqlanadi
+        centroids = detections.centroids()
+        norfair_detections = [Detection(points=centroids[i], scores=detections.conf[i:i + 1], data=(detections, i))
+                              for i in range(len(detections))]
+
+        # period: oldingi inference kadridan beri o'tgan kadrlar soni (kadr tashlab ketilganda treklar o'lmasligi uchun)
+        gap = 1 if self._last_keyframe is None else max(1, frame_idx - self._last_keyframe)
+        tracked_objects = self.tracker.update(detections=norfair_detections, period=gap)
+
+        # Kuzatilayotgan obyektlar ham ustunlarga yig'iladi: ids, xyxy, conf, cls va Kalman tezligi
+        track_ids = np.array([obj.id for obj in tracked_objects], dtype=np.int64)
+        tracked_xyxy = np.empty((len(tracked_objects), 4), dtype=np.float32)
+        tracked_conf = np.empty(len(tracked_objects), dtype=np.float32)
+        tracked_cls = np.empty(len(tracked_objects), dtype=np.int32)
+        velocity = np.empty((len(tracked_objects), 2), dtype=np.float32)
+        for row, obj in enumerate(tracked_objects):
+            source, index = obj.last_detection.data
+            tracked_xyxy[row] = source.xyxy[index]
+            tracked_conf[row] = source.conf[index]
+            tracked_cls[row] = source.cls[index]
+            velocity[row] = obj.estimate_velocity[0]
+
+        tracks = FrameDetections(tracked_xyxy, tracked_conf, tracked_cls)
+        if self.scene is not None:
+            keep = self.scene.observe(frame_idx, track_ids, tracks)
+            track_ids, tracks, velocity = track_ids[keep], tracks.select(keep), velocity[keep]
+        return track_ids, tracks, velocity, gap
+
+    def propagate_frame(self, frame_idx: int, frame):
+        """
+        Annotates a frame that was not sent to inference: boxes of the last inference frame are moved by
+        the tracker's velocity estimates, then rules, drawing and logging run on these estimates.
+        """
+        if self._last_tracks is None or frame_idx <= self._last_keyframe:
+            return
+        track_ids, tracks, velocity = self._last_tracks
+        shift = np.tile(velocity * (frame_idx - self._last_keyframe), 2)
+        estimated = FrameDetections(tracks.xyxy + shift, tracks.conf, tracks.cls)
+        self._emit_frame(frame_idx, frame, track_ids, estimated, estimated=True)
+
+    def _emit_frame(self, frame_idx: int, frame, track_ids, tracks: FrameDetections, estimated: bool):
+        # Svetofor holati har kadrda kesim rangidan aniqlanadi; keshlangan statik obyektlar qo'shiladi
+        with self.timer.measure("light_state"):
+            tracks = self.light_classifier.relabel(frame, tracks, frame_idx)
+            if self.scene is not None:
+                self.scene.classify_lights(frame_idx, frame, self.light_classifier)
+                track_ids, tracks = self.scene.merge(frame_idx, track_ids, tracks)
+        # Barcha qoidalar barcha treklar ustida vektor amallar bilan tekshiriladi; har bir hodisa bir marta qayd etiladi
+        violating_rows = set()
+        with self.timer.measure("rules"):
+            events = self.rule_engine.evaluate(frame_idx, track_ids, tracks)
+        for rule, row in events:
+            if frame_idx < self.min_violation_frame:
+                continue
+            violating_rows.add(row)
+            self.violations.append({
+                "frame_idx": frame_idx,
+                "time_str": format_timestamp(frame_idx, self.fps),
+                "car_id": int(track_ids[row]),
+                "violation_type": rule.violation_type,
+                "rule": rule.name,
+            })
+
+        if self.draw:
+            with self.timer.measure("draw"):
+                boxes = tracks.xyxy.astype(int).tolist()
+                for row, (track_id, cls_id, conf, box) in enumerate(zip(track_ids.tolist(), tracks.cls.tolist(),
+                                                                        tracks.conf.tolist(), boxes)):
+                    class_name = self.class_names.get(cls_id, 'Unknown')
+                    color = VIOLATION_COLOR if row in violating_rows else self.class_colors.get(cls_id, (0, 0, 255))
+                    draw_tracked_box(frame, box, f'{class_name} ID:{track_id} Conf:{conf:.2f}', color)
+
+        with self.timer.measure("log_write"):
+            self.log_writer.write_frame(frame_idx, track_ids, tracks.cls, tracks.conf, tracks.xyxy,
+                                        estimated=estimated)
+
+
+def run_batched_inference(model, frames: list, conf: float = CONFIDENCE_THRESHOLD, imgsz: int = IMGSZ):
+    """
+    Runs one inference call over a list of frames.
+
+    :param model: Loaded YOLO model.
+    :param frames: BGR frames of the same size.
+    :return: One ultralytics Results object per frame, in the same order.
+    """
+    if not frames:
+        return []
+    return model(frames, verbose=False, conf=conf, imgsz=imgsz, augment=False)
+
+
+def autotune_batch_size(model, width: int, height: int, imgsz: int = IMGSZ, conf: float = CONFIDENCE_THRESHOLD,
+                        candidates=AUTOTUNE_BATCH_SIZES) -> int:
+    """
+    Times batched inference on synthetic frames and returns the batch size with the best frames/sec.
+    The result is cached per model and frame size, so only the first job on a host pays for the measurement.
+
+    :param model: Loaded (ideally warmed-up) YOLO model.
+    :param width: Frame width of the video to analyse.
+    :param height: Frame height of the video to analyse.
+    """
+    cache_key = (getattr(model, 'ckpt_path', None) or id(model), width, height, imgsz)
+    if cache_key in _autotuned_batch_sizes:
+        return _autotuned_batch_sizes[cache_key]
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, size=(height, width, 3), dtype=np.uint8)
+    best_size, best_fps = 1, 0.0
+    for size in candidates:
+        frames = [frame] * size
+        run_batched_inference(model, frames, conf, imgsz)  # warm-up for this batch shape
+        start = time.perf_counter()
+        for _ in range(AUTOTUNE_ITERATIONS):
+            run_batched_inference(model, frames, conf, imgsz)
+        fps = size * AUTOTUNE_ITERATIONS / (time.perf_counter() - start)
+        print(f"⏱️ Batch size {size}: {fps:.1f} frames/sec")
+        if fps > best_fps:
+            best_size, best_fps = size, fps
+        elif fps < best_fps * 0.9:
+            break  # Kattaroq batch endi tezlashtirmayapti
+
+    print(f"✅ Auto-tuned batch size: {best_size} ({best_fps:.1f} frames/sec)")
+    _autotuned_batch_sizes[cache_key] = best_size
+    return best_size
+
+
+def inference_settings() -> dict:
+    """Settings that decide which frames the detector runs on and what it returns (keys the raw detection store)."""
+    return {"confidence_threshold": CONFIDENCE_THRESHOLD, "imgsz": IMGSZ, "frame_skip": FRAME_SKIP,
+            "inference_schedule": INFERENCE_SCHEDULE}
+
+
+def result_url(current_time_str: str, path, subdir: str = ""):
+    return f"/results/{current_time_str}/{subdir}{path.name}" if path else None
+
+
+def violation_entry(current_time_str: str, info: dict, artifacts: dict = None) -> dict:
+    """
+    API representation of one violation.
+
+    :param artifacts: {(frame_idx, car_id): (screenshot path, clip path)} of the violations.
+    """
+    screenshot_path, clip_path = (artifacts or {}).get((info['frame_idx'], info['car_id']), (None, None))
+    return {
+        "violation_type": info['violation_type'],
+        "rule": info.get('rule'),
+        "frame_idx": info['frame_idx'],
+        "timestamp": info['time_str'],
+        "car_id": info['car_id'],
+        "screenshot_url": result_url(current_time_str, screenshot_path, "violations/screenshots/"),
+        "clip_url": result_url(current_time_str, clip_path, "violations/"),
+    }
+
+
+def build_final_result(current_time_str: str, annotated_video_path: Path, violations: list = (),
+                       artifacts: dict = None) -> dict:
+    """
+    :param violations: Violation infos in the order they happened.
+    :param artifacts: {(frame_idx, car_id): (screenshot path, clip path)} of the violations.
+    """
+    entries = [violation_entry(current_time_str, info, artifacts) for info in violations]
+    if entries:
+        # Yuqori darajadagi maydonlar birinchi qoidabuzarlikni ko'rsatadi (oldingi API bilan moslik uchun)
+        first = entries[0]
+        return {
+            "violation_detected": True,
+            "violation_type": first['violation_type'],
+            "screenshot_url": first['screenshot_url'],
+            "clip_url": first['clip_url'],
+            "timestamp": first['timestamp'],
+            "annotated_video_url": result_url(current_time_str, annotated_video_path),
+            "violation_count": len(entries),
+            "violations": entries,
+        }
+    print("\nℹ️ No violation detected throughout the video.")
+    # Agar qoidabuzarlik topilmasa ham, annotatsiyalangan video fayli yaratiladi va URL beriladi
+    return {
+        "violation_detected": False,
+        "annotated_video_url": result_url(current_time_str, annotated_video_path),
+        "violation_count": 0,
+        "violations": [],
+    }
+
+
+def analyze_video_for_violations(video_path: str, model_path: str, progress_callback=None, model=None,
+                                 run_id: str = None, batch_size=None, stats_callback=None, roi: str = None,
+                                 roi_polygons=None, timer=None, violation_callback=None, backend: str = None,
+                                 stream_callback=None):
+    # model: oldindan yuklangan (warm) YOLO modeli. Berilmasa model_path dan yuklanadi.
+    # run_id: natija katalogi nomiga qo'shiladi, bir vaqtda ishlayotgan tahlillar bir-birini ustiga yozmasligi uchun.
+    # batch_size: bitta inference chaqiruvidagi kadrlar soni (yoki "auto"). Berilmasa BATCH_SIZE ishlatiladi.
+    # stats_callback: pipeline bosqichlari statistikasini (navbat to'liqligi, band vaqt) vaqti-vaqti bilan oladi.
+    # roi, roi_polygons: detektor faqat shu zonalarda ishlaydi ("off", "auto", ROI_CONFIG dagi kamera id yoki poligonlar).
+    # timer: bosqichlar vaqtini yig'uvchi (StageTimer yoki metrics.MetricsTimer); berilmasa hech narsa o'lchanmaydi.
+    # violation_callback: har bir qoidabuzarlik topilishi bilan uning API ko'rinishini (violation_entry) oladi.
+    # backend: inference muhiti ("torch", "onnx", ...); model yuklash va xom detektsiyalar store kaliti uchun.
+    # stream_callback: annotatsiyalangan videoning HLS playlisti (birinchi segment) paydo bo'lishi bilan URL ini oladi.
+    # --- 1. CONFIGURATION ---
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+    timer = timer or NULL_TIMER
+
+    # --- 2. FILE AND DIRECTORY SETUP ---
+    current_time_str, RESULT_DIR, VIOLATION_DIR, SCREENSHOT_DIR = prepare_result_dirs(run_id)
+
+    FINAL_ANNOTATED_VIDEO_PATH = RESULT_DIR / 'annotated_video.mp4'    # <<< Yakuniy annotated video
 
     # --- 3. MODEL AND TRACKER LOADING ---
-    print(f"Loading model from: {model_path}")
-    if not Path(model_path).exists():
-        print(f"❌ ERROR: Model file not found! Please check the specified path: {model_path}")
-        print("Hint: Using default 'yolov8n.pt' model for inference.")
-        model = YOLO('yolov8n.pt')
+    if model is None:
+        model = load_yolo_model(model_path, backend)
     else:
-        model = YOLO(model_path)
+        print(f"Using preloaded model for: {model_path}")
 
     ALL_CLASS_NAMES = model.names
     print(f"✅ Model loaded successfully. Classes to detect ({len(ALL_CLASS_NAMES)}):")
     print(list(ALL_CLASS_NAMES.values()))
 
-    np.random.seed(42)
-    CLASS_COLORS = {cls_id: [int(c) for c in np.random.randint(50, 255, size=3)] for cls_id in ALL_CLASS_NAMES.keys()}
-    VIOLATION_COLOR = (0, 0, 255)
-
-    tracker = Tracker(distance_function="euclidean", distance_threshold=50)
-
     # --- 4. VIDEO ANALYSIS ---
-    cap = cv2.VideoCapture(video_path)
+    # Hali yuklanayotgan video (.part) yuklash davom etayotganda o'qiladi (video_upload.GrowingFileCapture)
+    cap = open_video_capture(video_path)
     if not cap.isOpened():
         print(f"❌ Error: Could not open video: {video_path}")
         return {"violation_detected": False, "error": f"Could not open video: {video_path}"}
@@ -69,228 +374,174 @@ def analyze_video_for_violations(video_path: str, model_path: str, progress_call
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    # Vaqtincha annotatsiya videosini yozish uchun kodek
-    fourcc_opencv_temp = cv2.VideoWriter_fourcc(*'mp4v') # Bu keyinroq FFmpeg orqali qayta kodlanadi
-    out = cv2.VideoWriter(str(RAW_ANNOTATED_VIDEO_PATH), fourcc_opencv_temp, fps, (width, height))
-
-    log = []
-    frame_idx = 0
-
-    first_violation_info = None
-    violation_detected_flag = False
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if progress_callback:
-            progress_callback(frame_idx, total_frames)
-
-        if frame_idx % FRAME_SKIP == 0:
-            results = model(frame, verbose=False, conf=CONFIDENCE_THRESHOLD, imgsz=IMGSZ, augment=False)
-
-            norfair_detections = []
-            if results and results[0].boxes:
-                for det in results[0].boxes:
-                    xyxy = det.xyxy[0].cpu().numpy()
-                    conf = det.conf[0].cpu().item()
-                    centroid = np.array([(xyxy[0] + xyxy[2]) / 2, (xyxy[1] + xyxy[3]) / 2])
-                    norfair_detections.append(Detection(points=centroid, scores=np.array([conf]), data=det))
-
-            tracked_objects = tracker.update(detections=norfair_detections)
-
-            cars = [obj for obj in tracked_objects if ALL_CLASS_NAMES[int(obj.last_detection.data.cls[0])] == 'car']
-            crosswalks = [obj for obj in tracked_objects if
-                          ALL_CLASS_NAMES[int(obj.last_detection.data.cls[0])] == 'crosswalk']
-            traffic_lights_red = [obj for obj in tracked_objects if
-                                  ALL_CLASS_NAMES[int(obj.last_detection.data.cls[0])] == 'traffic_light_red']
-
-            is_violation_in_frame = False
-            violating_car_obj = None
-
-            if not violation_detected_flag and cars and crosswalks and traffic_lights_red:
-                for car_obj in cars:
-                    car_box = car_obj.last_detection.data.xyxy[0].cpu().numpy()
-                    car_center_x = (car_box[0] + car_box[2]) / 2
-                    car_center_y = (car_box[1] + car_box[3]) / 2
-
-                    for crosswalk in crosswalks:
-                        crosswalk_box = crosswalk.last_detection.data.xyxy[0].cpu().numpy()
-
-                        if (crosswalk_box[0] < car_center_x < crosswalk_box[2] and
-                                crosswalk_box[1] < car_center_y < crosswalk_box[3]):
-                            is_violation_in_frame = True
-                            violating_car_obj = car_obj
-                            violation_detected_flag = True
-
-                            timestamp = frame_idx / fps
-                            time_str = f"{int(timestamp // 3600):02}:{int((timestamp % 3600) // 60):02}:{timestamp % 60:05.2f}"
-
-                            first_violation_info = {
-                                "frame_idx": frame_idx,
-                                "time_str": time_str,
-                                "car_id": violating_car_obj.id,
-                                "violation_type": "Qizil chiroqda o'tish"
-                            }
-                            break
-                    if violation_detected_flag:
-                        break
-
-            for t_obj in tracked_objects:
-                det_data = t_obj.last_detection.data
-                xyxy = det_data.xyxy[0].cpu().numpy()
-                conf = det_data.conf[0].cpu().item()
-                cls_id = int(det_data.cls[0].cpu().item())
-                x1, y1, x2, y2 = map(int, xyxy)
-
-                class_name = ALL_CLASS_NAMES.get(cls_id, 'Unknown')
-                color = CLASS_COLORS.get(cls_id, (0, 0, 255))
-
-                if is_violation_in_frame and violating_car_obj and t_obj.id == violating_car_obj.id:
-                    color = VIOLATION_COLOR
-
-                cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-                label = f'{class_name} ID:{t_obj.id} Conf:{conf:.2f}'
-                cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-
-                timestamp = frame_idx / fps
-                time_str = f"{int(timestamp // 3600):02}:{int((timestamp % 3600) // 60):02}:{timestamp % 60:05.2f}"
-                log.append(
-                    {"frame": frame_idx, "time": time_str, "id": int(t_obj.id), "class": class_name,
-                     "conf": float(conf),
-                     "box": [x1, y1, x2, y2]})
-
-        out.write(frame)
-        frame_idx += 1
-
-    # --- 5. FINALIZE ANALYSIS ---
-    cap.release()
-    out.release() # Vaqtincha annotatsiya videosini yozishni tugatamiz
-    cv2.destroyAllWindows()
-
-    print(f"\n✅ Raw annotated video saved to: {RAW_ANNOTATED_VIDEO_PATH}")
-
-    # Annotatsiya qilingan videoni FFmpeg orqali qayta kodlash
-    try:
-        print(f"🔄 Re-encoding main annotated video using FFmpeg to browser-friendly H.264: {FINAL_ANNOTATED_VIDEO_PATH}")
-        command_main_video = [
-            'ffmpeg',
-            '-i', str(RAW_ANNOTATED_VIDEO_PATH),
-            '-c:v', 'libx264',
-            '-preset', 'veryfast',
-            '-crf', '23',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-movflags', '+faststart',
-            '-y',
-            str(FINAL_ANNOTATED_VIDEO_PATH)
-        ]
-        subprocess.run(command_main_video, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"✅ Main annotated video successfully re-encoded: {FINAL_ANNOTATED_VIDEO_PATH}")
-        os.remove(RAW_ANNOTATED_VIDEO_PATH) # Vaqtincha faylni o'chirish
-    except subprocess.CalledProcessError as e:
-        print(f"❌ FFmpeg re-encoding failed for main annotated video {RAW_ANNOTATED_VIDEO_PATH}:")
-        print(f"Stdout: {e.stdout.decode()}")
-        print(f"Stderr: {e.stderr.decode()}")
-        FINAL_ANNOTATED_VIDEO_PATH = RAW_ANNOTATED_VIDEO_PATH # Agar xato bo'lsa, vaqtincha faylga murojaat qilish
-    except FileNotFoundError:
-        print("❌ FFmpeg not found for main annotated video. Please ensure FFmpeg is installed and in the system's PATH.")
-        FINAL_ANNOTATED_VIDEO_PATH = RAW_ANNOTATED_VIDEO_PATH
-
-    print(f"✅ Final annotated video available at: {FINAL_ANNOTATED_VIDEO_PATH}")
-
-    with open(JSON_LOG_PATH, 'w') as f:
-        json.dump(log, f, indent=4)
-    print(f"✅ Detection log saved to: {JSON_LOG_PATH}")
-
-    # --- 6. POST-ANALYSIS VIOLATION FILE SAVING (violation_clip va screenshot) ---
-    final_result = None
-    if first_violation_info:
-        print("\n--- Saving first violation artifacts... ---")
-
-        info = first_violation_info
-        time_filename = info['time_str'].replace(':', '-').replace('.', '_')
-        screenshot_path = SCREENSHOT_DIR / f"violation_frame_{info['frame_idx']}_{time_filename}_CarID_{info['car_id']}.jpg"
-
-        cap_screenshot = cv2.VideoCapture(video_path)
-        cap_screenshot.set(cv2.CAP_PROP_POS_FRAMES, info['frame_idx'])
-        ret_ss, screenshot_frame = cap_screenshot.read()
-        cap_screenshot.release()
-
-        if ret_ss:
-            cv2.imwrite(str(screenshot_path), screenshot_frame)
-            print(f"✅ Screenshot saved: {screenshot_path}")
+    # Detektsiya logi tahlil davomida diskka oqim sifatida yoziladi (JSON Lines yoki npz bo'laklari)
+    log_writer = open_log_writer(RESULT_DIR, ALL_CLASS_NAMES, fps)
+    # Xom detektsiyalar (treker va qoidalardan oldin) video, vaznlar va inference sozlamalari kaliti bilan
+    # saqlanadi, keyin treker/qoida o'zgarishlari inference siz qayta o'ynatiladi (replay_analysis.py)
+    recorder = None
+    if RAW_DETECTION_STORE:
+        try:
+            # Detektsiyalar tahlil davomida bo'laklab diskka yoziladi, xotirada to'planmaydi
+            recorder = RawDetectionRecorder(
+                {"video_path": str(video_path), "model_path": str(model_path), "fps": fps, "width": width,
+                 "height": height, "class_names": {str(cls_id): name for cls_id, name in ALL_CLASS_NAMES.items()}})
+        except OSError as e:
+            print(f"⚠️ Raw detections will not be saved: {e}")
+    analyzer = ViolationAnalyzer(ALL_CLASS_NAMES, fps, log_writer=log_writer, timer=timer, recorder=recorder)
+    # Qoidabuzarlik skrinshoti va klipi asosiy o'tish davomida xotiradagi halqa buferdan yoziladi,
+    # manba video qayta ochilmaydi va qayta dekodlanmaydi
+    # Detektor faqat qiziqish zonalarida (ROI) ishlashi mumkin; qutilar to'liq kadr koordinatalariga qaytariladi
+    roi_detector = make_roi_detector((width, height), roi, roi_polygons, analyzer.scene)
+    clip_recorder = ViolationClipRecorder(VIOLATION_DIR, SCREENSHOT_DIR, fps, (width, height), CLIP_DURATION_SECONDS)
+    violation_artifacts = {}
+
+    # Annotatsiya qilingan kadrlar to'g'ridan-to'g'ri FFmpeg (libx264) ga uzatiladi, alohida qayta kodlash kerak emas.
+    # FFmpeg bo'lmasa cv2.VideoWriter ('mp4v') ishlatiladi.
+    # HLS_OUTPUT bo'lsa o'sha kodlangan oqim hls/ ga segmentlab ham yoziladi: video tahlil tugamasdan ko'rinadi
+    out = open_video_writer(FINAL_ANNOTATED_VIDEO_PATH, fps, (width, height),
+                            hls_dir=RESULT_DIR / 'hls' if HLS_OUTPUT else None)
+    hls_url = f"/results/{current_time_str}/hls/{HLS_PLAYLIST_NAME}" if out.playlist_path is not None else None
+    hls_announced = False
+
+    # Qaysi kadrlar inference ga yuborilishini rejalashtiruvchi hal qiladi: harakat bo'lmasa chastota keskin
+    # kamayadi (eng kami SCHEDULER_MAX_INTERVAL_SECONDS da bir marta), harakat yoki mashinalar bo'lsa har
+    # FRAME_SKIP kadrda. Har bir kadr qarori inference_schedule.jsonl ga yoziladi.
+    scheduler = InferenceScheduler(fps, min_interval=FRAME_SKIP, log_path=RESULT_DIR / SCHEDULE_LOG_NAME)
+
+    if batch_size == "auto":
+        batch_size = autotune_batch_size(model, width, height, IMGSZ, CONFIDENCE_THRESHOLD)
+    batch_size = max(1, int(batch_size))
+    print(f"Inference batch size: {batch_size}")
+
+    # Tahlil bosqichli pipeline sifatida ishlaydi: decode -> infer -> track/draw -> encode.
+    # Har bir bosqich alohida oqimda, bosqichlar orasida chegaralangan navbatlar bor,
+    # shuning uchun decode va encode inference bilan parallel ishlaydi, kadrlar tartibi saqlanadi.
+    def decode_frames():
+        frame_idx = 0
+        while True:
+            with timer.measure("decode"):
+                ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame_idx, frame, scheduler.decide(frame_idx, frame)
+            frame_idx += 1
+
+    # Kadrlar batch_size ta inference kadri yig'ilguncha saqlanadi, so'ng bitta chaqiruvda aniqlanadi
+    pending = []
+    pending_inference_count = 0
+
+    def flush_inference(emit):
+        nonlocal pending_inference_count
+        inference_frames = [frame for _, frame, needs_inference in pending if needs_inference]
+        start = time.perf_counter()
+        if roi_detector is not None:
+            results = iter(roi_detector.detect(inference_frames, lambda images, size: run_batched_inference(
+                model, images, CONFIDENCE_THRESHOLD, size), IMGSZ))
         else:
-            print(f"❌ Error: Could not retrieve screenshot frame for frame_idx {info['frame_idx']}.")
-
-        # Videoklipni saqlash va FFmpeg orqali qayta kodlash
-        temp_violation_clip_path = VIOLATION_DIR / f"temp_violation_clip_{info['frame_idx']}_{time_filename}_CarID_{info['car_id']}.mp4"
-        final_violation_clip_path = VIOLATION_DIR / f"violation_clip_{info['frame_idx']}_{time_filename}_CarID_{info['car_id']}.mp4"
-
-        start_frame = max(0, info['frame_idx'] - int(CLIP_DURATION_SECONDS * fps))
-        end_frame = min(total_frames, info['frame_idx'] + int(CLIP_DURATION_SECONDS * fps))
-
-        cap_clip = cv2.VideoCapture(video_path)
-        if not cap_clip.isOpened():
-            print(f"❌ Error: Could not open original video for clip creation: {video_path}")
+            results = iter(run_batched_inference(model, inference_frames, CONFIDENCE_THRESHOLD, IMGSZ))
+        timer.add("inference", time.perf_counter() - start, len(inference_frames))
+        for pending_idx, pending_frame, needs_inference in pending:
+            emit((pending_idx, pending_frame, next(results) if needs_inference else None, needs_inference))
+        pending.clear()
+        pending_inference_count = 0
+
+    def infer_stage(item, emit):
+        nonlocal pending_inference_count
+        item_idx, frame, needs_inference = item
+        if not needs_inference and not pending:
+            # Oldinda kutayotgan inference kadri yo'q: kadr ushlanmasdan keyingi bosqichga o'tadi
+            emit((item_idx, frame, None, False))
+            return
+        pending.append(item)
+        if needs_inference:
+            pending_inference_count += 1
+        # Harakatsiz sahnada inference kadrlari siyrak, shuning uchun kutayotgan kadrlar soni ham cheklanadi
+        if pending_inference_count >= batch_size or len(pending) >= queue_size:
+            flush_inference(emit)
+
+    def track_draw_stage(item, emit):
+        item_idx, frame, result, needs_inference = item
+        if progress_callback:
+            progress_callback(item_idx, total_frames)
+        clip_recorder.push(item_idx, frame)  # chizishdan oldin, kadr nusxasi saqlanadi
+        violations_before = len(analyzer.violations)
+        if needs_inference:
+            analyzer.process_frame(item_idx, frame, result)
+            scheduler.report_tracks(analyzer.dynamic_track_count)
         else:
-            out_temp_clip = cv2.VideoWriter(str(temp_violation_clip_path), fourcc_opencv_temp, fps, (width, height))
-
-            cap_clip.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-            for i in range(start_frame, end_frame):
-                ret, clip_frame = cap_clip.read()
-                if not ret:
-                    break
-                out_temp_clip.write(clip_frame)
-
-            out_temp_clip.release()
-            cap_clip.release()
-            print(f"✅ Temporary {2 * CLIP_DURATION_SECONDS}-second violation clip saved: {temp_violation_clip_path}")
-
-            # FFmpeg orqali qayta kodlash (violation clip uchun)
-            try:
-                print(f"🔄 Re-encoding violation clip using FFmpeg to browser-friendly H.264: {final_violation_clip_path}")
-                command_violation_clip = [
-                    'ffmpeg',
-                    '-i', str(temp_violation_clip_path),
-                    '-c:v', 'libx264',
-                    '-preset', 'veryfast',
-                    '-crf', '23',
-                    '-c:a', 'aac',
-                    '-b:a', '128k',
-                    '-movflags', '+faststart',
-                    '-y',
-                    str(final_violation_clip_path)
-                ]
-                subprocess.run(command_violation_clip, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                print(f"✅ Violation clip successfully re-encoded: {final_violation_clip_path}")
-                os.remove(temp_violation_clip_path)  # Vaqtincha faylni o'chirish
-            except subprocess.CalledProcessError as e:
-                print(f"❌ FFmpeg re-encoding failed for violation clip {temp_violation_clip_path}:")
-                print(f"Stdout: {e.stdout.decode()}")
-                print(f"Stderr: {e.stderr.decode()}")
-                final_violation_clip_path = temp_violation_clip_path  # Agar xato bo'lsa, vaqtincha faylga murojaat qilish
-            except FileNotFoundError:
-                print("❌ FFmpeg not found for violation clip. Please ensure FFmpeg is installed and in the system's PATH.")
-                final_violation_clip_path = temp_violation_clip_path
-
-        final_result = {
-            "violation_detected": True,
-            "violation_type": info['violation_type'],
-            "screenshot_url": f"/results/{current_time_str}/violations/screenshots/{screenshot_path.name}",
-            "clip_url": f"/results/{current_time_str}/violations/{final_violation_clip_path.name}", # <<< YANGILANDI
-            "timestamp": info['time_str'],
-            "annotated_video_url": f"/results/{current_time_str}/{FINAL_ANNOTATED_VIDEO_PATH.name}" # <<< YANGILANDI
-        }
-    else:
-        print("\nℹ️ No violation detected throughout the video.")
-        # Agar qoidabuzarlik topilmasa ham, annotatsiyalangan video fayli yaratiladi va URL beriladi
-        final_result = {
-            "violation_detected": False,
-            "annotated_video_url": f"/results/{current_time_str}/{FINAL_ANNOTATED_VIDEO_PATH.name}"
-        }
+            # Inference qilinmagan kadr: qutilar treker tezligi bo'yicha siljitiladi, qoidalar ham tekshiriladi
+            analyzer.propagate_frame(item_idx, frame)
+        for info in analyzer.violations[violations_before:]:
+            # Bir kadrda bitta mashina bir nechta qoidani buzsa, skrinshot va klip bitta bo'ladi
+            key = (info['frame_idx'], info['car_id'])
+            if key not in violation_artifacts:
+                violation_artifacts[key] = clip_recorder.add_violation(info)
+            if violation_callback:
+                violation_callback(violation_entry(current_time_str, info, violation_artifacts))
+        emit(frame)
+
+    def encode_stage(frame, emit):
+        nonlocal hls_announced
+        with timer.measure("encode"):
+            out.write(frame)
+        # Playlist birinchi segment tayyor bo'lganda paydo bo'ladi; shundan keyin tekshirilmaydi
+        if stream_callback and hls_url and not hls_announced and out.playlist_path.exists():
+            hls_announced = True
+            stream_callback(hls_url)
+
+    queue_size = max(PIPELINE_QUEUE_SIZE, 2 * batch_size * FRAME_SKIP)
+    pipeline = VideoPipeline(queue_size=PIPELINE_QUEUE_SIZE, stats_callback=stats_callback)
+    pipeline.set_source("decode", decode_frames())
+    pipeline.add_stage("infer", infer_stage, flush=flush_inference, queue_size=queue_size)
+    pipeline.add_stage("track_draw", track_draw_stage, queue_size=queue_size)
+    pipeline.add_stage("encode", encode_stage)
+    try:
+        pipeline_stats = pipeline.run()
+    except BaseException:
+        if recorder is not None:
+            recorder.discard()
+        raise
+    finally:
+        cap.release()
+        out.release()
+        clip_recorder.close()
+        log_writer.close()
+        scheduler.close()
+    print(f"✅ Pipeline finished in {pipeline_stats['elapsed_seconds']:.2f}s, "
+          f"bottleneck stage: {pipeline_stats['bottleneck']}")
+    schedule_stats = scheduler.stats()
+    print(f"✅ Inference ran on {schedule_stats['inference_frames']}/{schedule_stats['frames']} frames "
+          f"({schedule_stats['mode']} schedule)")
+    if recorder is not None:
+        recorder.meta.update(frames=schedule_stats['frames'], light_classifier=analyzer.light_classifier.mode)
+        try:
+            # Kalit oxirida hisoblanadi: tahlil video yuklanib bo'lishidan oldin boshlangan bo'lishi mumkin
+            store_path = raw_store_path(video_path, model_path, inference_settings(), backend, roi, roi_polygons)
+            print(f"✅ Raw detections saved to: {recorder.save(store_path)}")
+        except OSError as e:
+            # Store faqat replay uchun kerak, tahlil natijasi undan qat'i nazar qaytariladi
+            print(f"⚠️ Could not save raw detections: {e}")
+            recorder = None
 
+    # --- 5. FINALIZE ANALYSIS ---
+    print(f"\n✅ Final annotated video available at: {FINAL_ANNOTATED_VIDEO_PATH}")
+
+    print(f"✅ Detection log saved to: {log_writer.path} ({log_writer.rows} rows)")
+
+    # --- 6. VIOLATION ARTIFACTS (violation_clip va screenshot tahlil davomida yozilgan) ---
+    print(f"✅ {len(analyzer.violations)} violation(s) detected")
+    final_result = build_final_result(current_time_str, FINAL_ANNOTATED_VIDEO_PATH, analyzer.violations,
+                                      violation_artifacts)
+    final_result["detection_log_url"] = f"/results/{current_time_str}/{log_writer.path.name}"
+    final_result["hls_url"] = hls_url if hls_url and out.playlist_path.exists() else None
+    final_result["inference_schedule"] = schedule_stats
+    final_result["inference_schedule_url"] = f"/results/{current_time_str}/{SCHEDULE_LOG_NAME}"
+    final_result["scene_layout"] = analyzer.scene.stats() if analyzer.scene is not None else {"enabled": False}
+    final_result["light_classifier"] = {"mode": analyzer.light_classifier.mode,
+                                        "classified_frames": analyzer.light_classifier.frames}
+    final_result["roi"] = roi_detector.stats() if roi_detector is not None else {"mode": "off"}
+    final_result["raw_detection_store"] = recorder.path.name if recorder is not None else None
+    final_result["pipeline_stats"] = pipeline_stats
     return final_result
 
 
@@ -311,4 +562,4 @@ if __name__ == "__main__":
         model_path=str(MODEL_PATH_DEFAULT),
         progress_callback=my_progress_callback
     )
-    print("\nAnalysis finished. Results:", results)
\ No newline at end of file
+    print("\nAnalysis finished. Results:", results)
@@ -0,0 +1,171 @@
+import os
+import shutil
+import importlib.util
+import threading
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+# --- CONFIGURATION ---
+# Default inference runtime: "torch" (eager PyTorch), "onnx" (ONNX Runtime), "openvino", or their INT8 models
+# published by utils/quantize_model.py: "onnx_int8", "openvino_int8"
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+# Exported models are cached in this directory next to the weights, one sub-directory per weights hash
+EXPORT_DIR_NAME = ".exports"
+# Image size the models are exported for; exports are dynamic, so other sizes (ROI crops) still work
+EXPORT_IMGSZ = 640
+
+BACKENDS = {}
+
+_export_lock = threading.Lock()
+
+
+class ExportedYOLO(YOLO):
+    """
+    YOLO model loaded from an exported file. ultralytics only knows the class names of exported models
+    once the predictor (AutoBackend) has read the export metadata, so the names are taken from there.
+    """
+
+    @property
+    def names(self):
+        if self.predictor is None:
+            self.predict(np.zeros((EXPORT_IMGSZ, EXPORT_IMGSZ, 3), dtype=np.uint8), verbose=False)
+        return self.predictor.model.names
+
+
+def export_dir_for(model_path, weights_hash: str, backend_name: str) -> Path:
+    """Cache directory of one backend's model for the given weights: <weights dir>/.exports/<hash>/<backend>/."""
+    return Path(model_path).parent / EXPORT_DIR_NAME / weights_hash[:16] / backend_name
+
+
+def register_backend(backend_class):
+    """Class decorator that makes a backend selectable by its `name`."""
+    BACKENDS[backend_class.name] = backend_class()
+    return backend_class
+
+
+class InferenceBackend:
+    """
+    Base class of an inference runtime. A backend turns the trained .pt weights into its own format once
+    (export) and loads it as an ultralytics YOLO model, so every backend returns the same Results objects
+    and the analysis code gets the same FrameDetections columns whichever runtime is active.
+    """
+
+    name = None
+    # ultralytics export format, None when the .pt weights are used directly
+    export_format = None
+    # Python modules the runtime needs
+    requires = ()
+
+    def available(self) -> bool:
+        return all(importlib.util.find_spec(module) is not None for module in self.requires)
+
+    def exported_path(self, export_dir: Path) -> Path:
+        """Path of the exported model inside a finished export directory."""
+        raise NotImplementedError
+
+    def export(self, model_path, weights_hash: str, imgsz: int = EXPORT_IMGSZ) -> Path:
+        """
+        Exports the weights once and returns the exported model path.
+        The export is cached as <weights dir>/.exports/<hash>/<backend>/ and reused while the weights hash
+        is unchanged. It is written to a temporary directory first, so concurrent workers never load a
+        half-written export.
+        """
+        model_path = Path(model_path)
+        export_dir = export_dir_for(model_path, weights_hash, self.name)
+        exported = self.exported_path(export_dir)
+        if exported.exists():
+            return exported
+        with _export_lock:
+            if exported.exists():
+                return exported
+            print(f"🔄 Exporting {model_path.name} to {self.name} (one-time, cached in {export_dir})...")
+            tmp_dir = export_dir.with_name(f"{self.name}.tmp-{os.getpid()}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            tmp_dir.mkdir(parents=True)
+            # Eksport .pt fayli yonida yoziladi, shuning uchun vaqtinchalik katalogga nusxa olinadi
+            shutil.copy2(model_path, tmp_dir / "model.pt")
+            YOLO(str(tmp_dir / "model.pt")).export(format=self.export_format, imgsz=imgsz, dynamic=True,
+                                                   half=False, verbose=False)
+            (tmp_dir / "model.pt").unlink()
+            try:
+                os.rename(tmp_dir, export_dir)
+            except OSError:
+                # Boshqa jarayon eksportni oldinroq tugatgan
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            print(f"✅ Exported {self.name} model: {exported}")
+        return exported
+
+    def load(self, model_path, weights_hash: str):
+        """:return: ultralytics YOLO model running on this backend."""
+        return ExportedYOLO(str(self.export(model_path, weights_hash)), task='detect')
+
+
+@register_backend
+class TorchBackend(InferenceBackend):
+    name = "torch"
+
+    def available(self) -> bool:
+        return True
+
+    def load(self, model_path, weights_hash):
+        return YOLO(str(model_path))
+
+
+@register_backend
+class OnnxRuntimeBackend(InferenceBackend):
+    name = "onnx"
+    export_format = "onnx"
+    requires = ("onnx", "onnxruntime")
+
+    def exported_path(self, export_dir):
+        return export_dir / "model.onnx"
+
+
+@register_backend
+class OpenVINOBackend(InferenceBackend):
+    name = "openvino"
+    export_format = "openvino"
+    requires = ("openvino",)
+
+    def exported_path(self, export_dir):
+        return export_dir / "model_openvino_model"
+
+
+class QuantizedBackend:
+    """
+    Mixin of INT8 backends. INT8 models need calibration data and an accuracy check, so they are never
+    exported on demand: utils/quantize_model.py publishes them into the backend's export directory.
+    """
+
+    def export(self, model_path, weights_hash, imgsz=EXPORT_IMGSZ):
+        exported = self.exported_path(export_dir_for(model_path, weights_hash, self.name))
+        if not exported.exists():
+            raise RuntimeError(f"No published INT8 model for {Path(model_path).name} ({self.name}), "
+                               f"run utils/quantize_model.py first")
+        return exported
+
+
+@register_backend
+class OnnxInt8Backend(QuantizedBackend, OnnxRuntimeBackend):
+    name = "onnx_int8"
+
+
+@register_backend
+class OpenVINOInt8Backend(QuantizedBackend, OpenVINOBackend):
+    name = "openvino_int8"
+
+
+def get_backend(name: str = None) -> InferenceBackend:
+    """
+    :param name: Backend name, or None for INFERENCE_BACKEND.
+    :raises ValueError: Unknown backend, or its runtime is not installed.
+    """
+    name = name or INFERENCE_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', available: {sorted(BACKENDS)}")
+    backend = BACKENDS[name]
+    if not backend.available():
+        raise ValueError(f"Inference backend '{name}' needs {', '.join(backend.requires)} installed")
+    return backend
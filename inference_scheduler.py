@@ -0,0 +1,120 @@
+import os
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# --- CONFIGURATION ---
+# "adaptive": inference rate follows scene motion; "fixed": every FRAME_SKIP-th frame
+INFERENCE_SCHEDULE = os.environ.get("INFERENCE_SCHEDULE", "adaptive")
+# Motion is measured on grayscale frames downscaled to this width
+MOTION_DOWNSCALE_WIDTH = 160
+# A pixel has changed if its grayscale difference to the last inferred frame is above this
+# (15 still catches a dark-red car on grey asphalt; sensor noise averages out in the downscale)
+MOTION_PIXEL_THRESHOLD = 15
+# A frame has motion if at least this fraction of its pixels changed since the last inferred frame.
+# Measured: a 200x100 car moving 10 px/frame in 1080p gives 0.001-0.003 two frames after the reference,
+# static test clips give 0.0
+MOTION_RATIO_THRESHOLD = 0.001
+# Lowest inference rate on a static scene: one inference per this many seconds
+SCHEDULER_MAX_INTERVAL_SECONDS = 1.0
+
+SCHEDULE_LOG_NAME = "inference_schedule.jsonl"
+
+
+class InferenceScheduler:
+    """
+    Decides per decoded frame whether it is sent to inference.
+
+    In adaptive mode the interval between inference frames is min_interval while the scene moves or
+    dynamic objects are tracked, and doubles after every inference on a static scene up to max_interval.
+    Motion is the fraction of changed pixels between the downscaled grayscale frame and that of the last
+    inferred frame, so slow objects accumulate change until they are noticed.
+    Every decision (frame, motion, interval, rate, inferred) is streamed to the schedule log, or kept in
+    `records` when no log path is given (segment workers).
+    """
+
+    def __init__(self, fps: float, min_interval: int = 1, max_interval: int = None, mode: str = INFERENCE_SCHEDULE,
+                 log_path=None):
+        if mode not in ("adaptive", "fixed"):
+            raise ValueError(f"Unknown inference schedule '{mode}', expected 'adaptive' or 'fixed'")
+        self.fps = fps
+        self.mode = mode
+        self.min_interval = max(1, int(min_interval))
+        if max_interval is None:
+            max_interval = int(SCHEDULER_MAX_INTERVAL_SECONDS * fps)
+        self.max_interval = max(self.min_interval, int(max_interval))
+        self.interval = self.min_interval
+        self.dynamic_tracks = 0
+        self.records = []
+        self.frames = 0
+        self.inference_frames = 0
+        self.log_path = Path(log_path) if log_path else None
+        self._log_file = open(self.log_path, 'w') if self.log_path else None
+        self._reference_small = None
+        self._last_inference = None
+
+    def report_tracks(self, dynamic_tracks: int):
+        """Called with the number of tracked dynamic objects (cars, people) after each inference frame."""
+        self.dynamic_tracks = dynamic_tracks
+
+    @staticmethod
+    def _downscale(frame):
+        height, width = frame.shape[:2]
+        scale = MOTION_DOWNSCALE_WIDTH / width
+        small = cv2.resize(frame, (MOTION_DOWNSCALE_WIDTH, max(1, int(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def _motion(self, small) -> float:
+        if self._reference_small is None:
+            return 1.0
+        changed = cv2.absdiff(small, self._reference_small) > MOTION_PIXEL_THRESHOLD
+        return float(np.count_nonzero(changed)) / small.size
+
+    def decide(self, frame_idx: int, frame) -> bool:
+        """:return: True if this frame should be sent to inference."""
+        if self.mode == "fixed":
+            motion = None
+            interval = self.min_interval
+            inferred = frame_idx % self.min_interval == 0
+        else:
+            small = self._downscale(frame)
+            motion = self._motion(small)
+            if motion >= MOTION_RATIO_THRESHOLD or self.dynamic_tracks:
+                self.interval = self.min_interval
+            interval = self.interval
+            since_last = None if self._last_inference is None else frame_idx - self._last_inference
+            inferred = since_last is None or since_last >= interval
+            if inferred and motion < MOTION_RATIO_THRESHOLD and not self.dynamic_tracks:
+                # Sahna harakatsiz: keyingi inferencegacha oraliq keskin (ikki barobar) oshadi
+                self.interval = min(self.max_interval, self.interval * 2)
+            if inferred:
+                # Harakat endi shu kadrga nisbatan o'lchanadi
+                self._reference_small = small
+        if inferred:
+            self._last_inference = frame_idx
+            self.inference_frames += 1
+        self.frames += 1
+        record = schedule_record(frame_idx, motion, interval, inferred, self.fps)
+        if self._log_file is not None:
+            self._log_file.write(json.dumps(record) + "\n")
+        else:
+            self.records.append(record)
+        return inferred
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "frames": self.frames, "inference_frames": self.inference_frames,
+                "inference_ratio": round(self.inference_frames / self.frames, 4) if self.frames else 0.0,
+                "min_interval": self.min_interval, "max_interval": self.max_interval}
+
+    def close(self):
+        if self._log_file is not None and not self._log_file.closed:
+            self._log_file.close()
+
+
+def schedule_record(frame_idx: int, motion, interval: int, inferred: bool, fps: float) -> dict:
+    return {"frame": frame_idx, "motion": None if motion is None else round(motion, 5), "interval": interval,
+            "rate": round(fps / interval, 3), "inferred": bool(inferred)}
+
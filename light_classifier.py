@@ -0,0 +1,123 @@
+import os
+
+import cv2
+import numpy as np
+
+from detections import FrameDetections, resolve_class_ids
+
+# --- CONFIGURATION ---
+# "hsv": the state of known traffic lights is classified from their crops on every frame; "off": detector only
+LIGHT_CLASSIFIER = os.environ.get("LIGHT_CLASSIFIER", "hsv")
+# Detector classes of the light states, in the order of LIGHT_STATES
+TRAFFIC_LIGHT_CLASS_NAMES = ('traffic_light_red', 'traffic_light_yellow', 'traffic_light_green')
+LIGHT_STATES = ('red', 'yellow', 'green')
+# Every light crop is resized to this size, so all lights of a frame are classified as one array
+LIGHT_CROP_WIDTH = 16
+LIGHT_CROP_HEIGHT = 32
+# A pixel is lit if its saturation and brightness are at least these (OpenCV HSV, 0-255)
+LIT_MIN_SATURATION = 90
+LIT_MIN_VALUE = 150
+# OpenCV hue (0-180) ranges of the lamp colours; red wraps around 0
+RED_HUE_RANGES = ((0, 10), (160, 180))
+YELLOW_HUE_RANGES = ((15, 35),)
+GREEN_HUE_RANGES = ((40, 95),)
+# The crop needs at least this share of lit pixels to get a state
+MIN_LIT_FRACTION = 0.03
+
+
+def _hue_mask(hue, ranges):
+    mask = np.zeros(hue.shape, dtype=bool)
+    for low, high in ranges:
+        mask |= (hue >= low) & (hue <= high)
+    return mask
+
+
+def crop_lights(frame, boxes):
+    """(L, LIGHT_CROP_HEIGHT, LIGHT_CROP_WIDTH, 3) BGR crops of the xyxy boxes, clipped to the frame."""
+    height, width = frame.shape[:2]
+    boxes = np.asarray(boxes).reshape(-1, 4).round().astype(int)
+    x1 = np.clip(boxes[:, 0], 0, width - 1)
+    y1 = np.clip(boxes[:, 1], 0, height - 1)
+    x2 = np.clip(boxes[:, 2], x1 + 1, width)
+    y2 = np.clip(boxes[:, 3], y1 + 1, height)
+    crops = np.empty((len(boxes), LIGHT_CROP_HEIGHT, LIGHT_CROP_WIDTH, 3), dtype=np.uint8)
+    for i in range(len(boxes)):
+        crops[i] = cv2.resize(frame[y1[i]:y2[i], x1[i]:x2[i]], (LIGHT_CROP_WIDTH, LIGHT_CROP_HEIGHT),
+                              interpolation=cv2.INTER_AREA)
+    return crops
+
+
+def classify_light_states(frame, boxes):
+    """
+    Classifies the lamp colour of traffic-light boxes from HSV statistics of their crops.
+    All crops are converted and counted as one array, so the cost is one small conversion per frame.
+
+    :param frame: BGR frame.
+    :param boxes: (L, 4) xyxy boxes of traffic-light housings.
+    :return: (states, confidences): index into LIGHT_STATES or -1 when no lamp is lit, and the share of
+             lit pixels that have the winning colour.
+    """
+    if not len(boxes):
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    crops = crop_lights(frame, boxes)
+    # Barcha kesimlar bitta ustun rasmga yig'iladi va bitta cvtColor chaqiruvida HSV ga o'tkaziladi
+    hsv = cv2.cvtColor(crops.reshape(-1, LIGHT_CROP_WIDTH, 3), cv2.COLOR_BGR2HSV).reshape(crops.shape)
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    lit = (saturation >= LIT_MIN_SATURATION) & (value >= LIT_MIN_VALUE)
+    counts = np.stack([(lit & _hue_mask(hue, ranges)).sum(axis=(1, 2))
+                       for ranges in (RED_HUE_RANGES, YELLOW_HUE_RANGES, GREEN_HUE_RANGES)], axis=1)
+    lit_pixels = counts.sum(axis=1)
+    states = counts.argmax(axis=1).astype(np.int32)
+    confidences = (counts.max(axis=1) / np.maximum(lit_pixels, 1)).astype(np.float32)
+    unlit = lit_pixels < MIN_LIT_FRACTION * LIGHT_CROP_WIDTH * LIGHT_CROP_HEIGHT
+    states[unlit] = -1
+    confidences[unlit] = 0.0
+    return states, confidences
+
+
+class LightStateClassifier:
+    """
+    Second-stage traffic-light state classifier. Traffic-light boxes that are already known (tracked or
+    cached by SceneLayoutCache) get their state class from the HSV statistics of their crops, so the
+    red-light rules see the current state on every frame, not only on frames the detector ran on.
+    """
+
+    # Holat kadr piksellaridan aniqlanadi; kadrsiz (frame=None) chaqiruvlar o'tkazib yuboriladi
+    needs_frame = True
+
+    def __init__(self, class_names: dict, mode: str = LIGHT_CLASSIFIER, recorder=None):
+        """:param recorder: RawDetectionRecorder that keeps every classification for replays, or None."""
+        if mode not in ("hsv", "off"):
+            raise ValueError(f"Unknown light classifier '{mode}', expected 'hsv' or 'off'")
+        self.mode = mode
+        self.light_cls = np.array(resolve_class_ids(class_names, *TRAFFIC_LIGHT_CLASS_NAMES), dtype=np.int32)
+        self.recorder = recorder
+        self.frames = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def classify(self, frame, boxes, frame_idx: int = None):
+        """:return: (class ids, confidences) of the boxes; class id -1 where no lamp is lit."""
+        states, confidences = classify_light_states(frame, boxes)
+        self.frames += 1
+        cls_ids = np.where(states >= 0, self.light_cls[np.maximum(states, 0)], -1).astype(np.int32)
+        if self.recorder is not None and frame_idx is not None:
+            self.recorder.add_lights(frame_idx, boxes, cls_ids, confidences)
+        return cls_ids, confidences
+
+    def relabel(self, frame, tracks: FrameDetections, frame_idx: int = None) -> FrameDetections:
+        """Tracks with the classified state on traffic-light rows (rows without a lit lamp keep theirs)."""
+        if not self.enabled or (frame is None and self.needs_frame):
+            return tracks
+        rows = np.flatnonzero(np.isin(tracks.cls, self.light_cls))
+        if not len(rows):
+            return tracks
+        cls_ids, confidences = self.classify(frame, tracks.xyxy[rows], frame_idx)
+        lit = cls_ids >= 0
+        cls = tracks.cls.copy()
+        conf = tracks.conf.copy()
+        cls[rows[lit]] = cls_ids[lit]
+        conf[rows[lit]] = confidences[lit]
+        return FrameDetections(tracks.xyxy, conf, cls)
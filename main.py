@@ -1,40 +1,118 @@
 # main.py
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
+from typing import Optional, List
 import asyncio
+import json
+import mimetypes
 from pathlib import Path
 import os
 import sys
+from contextlib import asynccontextmanager
 
 # infer_and_track_violations.py faylidagi funksiyani import qilish
 # 'app' katalogini sys.path ga qo'shish (kerakli bo'lsa)
 sys.path.append(str(Path(
     __file__).resolve().parent))  # Bu o'zgarish main.py va infer_and_track_violations.py bir xil katalogda bo'lsa ishlaydi
 
-from infer_and_track_violations import analyze_video_for_violations
+from analysis_jobs import JobManager, QueueFullError, FINISHED_STATES, COMPLETED, FAILED
+from detection_log import iter_json_export
+from infer_and_track_violations import RESULTS_ROOT, inference_settings
+from raw_detections import raw_store_path
+from roi_inference import resolve_roi
+from inference_backends import get_backend
+from result_cache import analysis_cache_key
+from video_upload import (UploadManager, UnsupportedVideo, UploadOffsetMismatch, UploadTooLarge, COMPLETE,
+                          UPLOAD_CHUNK_BYTES)
+from metrics import REGISTRY, METRICS_ENABLED, QUEUE_DEPTH, JOBS, PROCESS_RSS_BYTES, process_rss_bytes
 
-app = FastAPI()
+# Model yo'lini Docker konteyneri ichidagi joylashuvga moslab belgilash
+MODEL_PATH = os.environ.get("MODEL_PATH", "/app/runs/train/exp_fast_train3/weights/best.pt")
+
+# SSE oqimi shu vaqt ichida hodisa bo'lmasa izoh qatori yuboradi (proksi ulanishni yopmasligi uchun)
+SSE_KEEPALIVE_SECONDS = 15
+
+# Tahlil ishlari navbati (job queue)
+job_manager = JobManager(MODEL_PATH)
+# Bo'laklab, uzilgan joyidan davom ettirib yuklanadigan videolar
+upload_manager = UploadManager()
+
+
+def collect_service_metrics():
+    # Navbat holati va xotira har bir /metrics so'rovida hisoblanadi
+    stats = job_manager.stats()
+    QUEUE_DEPTH.set(stats["queue_depth"])
+    for status, count in stats["jobs"].items():
+        JOBS.set(count, status)
+    PROCESS_RSS_BYTES.clear()
+    for name, pid in [("api", "self")] + [(f"worker-{pid}", pid) for pid in job_manager.worker_pids]:
+        rss = process_rss_bytes(pid)
+        if rss is not None:
+            PROCESS_RSS_BYTES.set(rss, name)
+
+
+REGISTRY.add_collector(collect_service_metrics)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Workerlar va modellar ilova ishga tushganda tayyorlanadi (warm-up fon oqimida)
+    job_manager.start()
+    yield
+    job_manager.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Frontend (HTML, CSS, JS) fayllarini joylashuvi
 # Docker konteynerida /app/static bo'ladi
 # Directory 'static' o'rniga to'liq yo'lni beramiz, agar main.py va static bir xil darajada bo'lsa
 app.mount("/static", StaticFiles(directory="/app/static"), name="static")
 
+# HLS segmentlari (.m4s) hamma tizimning mime jadvalida yo'q
+mimetypes.add_type("video/iso.segment", ".m4s")
+
+
+@app.middleware("http")
+async def no_cache_live_playlists(request: Request, call_next):
+    # Tahlil davomida HLS playlist o'sib boradi: brauzer uni keshdan emas, har safar serverdan olishi kerak
+    response = await call_next(request)
+    if request.url.path.startswith("/results/") and request.url.path.endswith(".m3u8"):
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 # Natija fayllari uchun katalog
 app.mount("/results", StaticFiles(directory="/app/results"), name="results") # Bu ham mutlaq yo'l bo'lishi yaxshi
 
 templates = Jinja2Templates(directory="templates")
 
-# Video tahlili holatini saqlash uchun global o'zgaruvchi
-analysis_progress = {"current_frame": 0, "total_frames": 1}
-analysis_result = None
-
 
 class VideoAnalysisRequest(BaseModel):
     video_path: str  # Videoning Docker konteyneri ichidagi yo'li
+    # "single", "segments" (uzun videolarni jarayonlar bo'yicha parallel tahlil), "auto" yoki
+    # "replay" (saqlangan xom detektsiyalar ustida faqat treker va qoidalar, inference siz)
+    mode: str = "auto"
+    segment_workers: Optional[int] = None  # "segments" rejimida ishchi jarayonlar soni
+    roi: Optional[str] = None  # "off", "auto" yoki ROI_CONFIG dagi kamera id (berilmasa ROI_MODE)
+    roi_polygons: Optional[List[List[List[float]]]] = None  # Kadr pikselidagi ROI poligonlari [[[x, y], ...], ...]
+    backend: Optional[str] = None  # "torch", "onnx" yoki "openvino" (berilmasa INFERENCE_BACKEND)
+    render: bool = False  # "replay" rejimida annotatsiyalangan video va kliplar ham yoziladi (video dekodlanadi)
+
+
+class UploadRequest(BaseModel):
+    filename: str  # Asl fayl nomi (kengaytmasi konteynerni bildiradi)
+    size: int  # Faylning to'liq hajmi, baytlarda
+    analyze: bool = False  # Yuklash tugashi bilan tahlil navbatga qo'yiladi
+    start_early: bool = True  # Oqimli konteynerlarda tahlil yetarli qism kelganda, yuklash tugashini kutmay boshlanadi
+    mode: str = "auto"  # "single", "segments" yoki "auto" (erta boshlangan tahlil doim "single")
+    segment_workers: Optional[int] = None
+    roi: Optional[str] = None
+    roi_polygons: Optional[List[List[List[float]]]] = None
+    backend: Optional[str] = None
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -43,16 +121,9 @@ async def read_root(request: Request):
 
 
 @app.post("/analyze_video")
-async def analyze_video(request: VideoAnalysisRequest, background_tasks: BackgroundTasks):
-    global analysis_progress, analysis_result
-
-    # Progressni boshlang'ich holatiga qaytarish
-    analysis_progress = {"current_frame": 0, "total_frames": 1}
-    analysis_result = None
-
+async def analyze_video(request: VideoAnalysisRequest):
     video_to_process = request.video_path
-    # Model yo'lini Docker konteyneri ichidagi joylashuvga moslab belgilash
-    model_to_use = "/app/runs/train/exp_fast_train3/weights/best.pt"
+    model_to_use = MODEL_PATH
 
     if not Path(video_to_process).exists():
         raise HTTPException(status_code=404, detail=f"Video not found at {video_to_process}")
@@ -60,37 +131,265 @@ async def analyze_video(request: VideoAnalysisRequest, background_tasks: Backgro
     if not Path(model_to_use).exists():
         print(f"Warning: Model not found at {model_to_use}. Using default YOLOv8n.")
 
-    def video_analysis_task(video_path, model_path):
-        global analysis_progress, analysis_result
+    _validate_analysis_options(request, ("auto", "single", "segments", "replay"))
+
+    params = {"video_path": video_to_process, "model_path": model_to_use, "mode": request.mode,
+              "segment_workers": request.segment_workers, "roi": request.roi, "roi_polygons": request.roi_polygons,
+              "backend": request.backend, "render": request.render}
+    if request.mode == "replay":
+        # Replay faqat oldingi tahlil saqlagan xom detektsiyalar ustida ishlaydi
+        store_path = await asyncio.to_thread(raw_store_path, video_to_process, model_to_use, inference_settings(),
+                                             request.backend, request.roi, request.roi_polygons)
+        if not store_path.exists():
+            raise HTTPException(status_code=404, detail="No raw detections for this video with the current weights "
+                                                        "and inference settings; analyse it once first")
+    # Video va vaznlar xeshi diskdan oqim bilan o'qiladi, shuning uchun event loop dan tashqarida hisoblanadi.
+    # Replay keshlanmaydi: u treker va qoidalar o'zgarishini sinash uchun, kalit esa ularni qamramaydi
+    cache_key = None
+    if job_manager.result_cache is not None and request.mode != "replay":
+        cache_key = await asyncio.to_thread(analysis_cache_key, params)
+
+    try:
+        # Kesh indeksi diskdan o'qiladi/yoziladi, shuning uchun submit ham event loop dan tashqarida
+        job = await asyncio.to_thread(job_manager.submit, params, cache_key)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "10"})
+
+    return {
+        "message": "Natija keshdan olindi" if job.cache_hit else "Video tahlili navbatga qo'yildi",
+        "status": job.status,
+        "cache_hit": job.cache_hit,
+        **_job_links(job.id),
+    }
+
+
+def _validate_analysis_options(request, modes):
+    if request.mode not in modes:
+        raise HTTPException(status_code=422, detail=f"Unknown analysis mode '{request.mode}'")
+    try:
+        resolve_roi(request.roi, request.roi_polygons)
+        get_backend(request.backend)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def _job_links(job_id: str) -> dict:
+    return {"job_id": job_id, "progress_url": f"/jobs/{job_id}/progress", "events_url": f"/jobs/{job_id}/events",
+            "result_url": f"/jobs/{job_id}/result"}
+
+
+def _get_upload_or_404(upload_id: str):
+    session = upload_manager.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found")
+    return session
 
-        def update_progress_callback(current_frame, total_frames):
-            analysis_progress["current_frame"] = current_frame
-            analysis_progress["total_frames"] = total_frames
 
+def _upload_response(session) -> dict:
+    data = {**session.to_dict(), "upload_url": f"/uploads/{session.id}", "chunk_size": UPLOAD_CHUNK_BYTES}
+    if session.job_id is not None:
+        data.update(_job_links(session.job_id))
+    return data
+
+
+def _early_analysis_lost(session) -> bool:
+    """
+    True when the upload just completed but its early-started analysis cannot deliver a full result: it failed
+    (UploadIncomplete after the upload stalled) or is unknown (the server restarted during the upload).
+    """
+    if session.status != COMPLETE or session.job_id is None:
+        return False
+    job = job_manager.get(session.job_id)
+    return job is None or (job.status == FAILED and job.params.get("early_start", False))
+
+
+def _start_upload_analysis(session, cache_key: str = None):
+    """
+    Queues the analysis requested with an upload: a complete upload is analysed as requested, an unfinished
+    streamable one (start_early) in a single pass that reads the file while it grows.
+    """
+    if session.analysis is None or session.job_id is not None:
+        return
+    params = {**session.analysis, "video_path": str(session.path), "model_path": MODEL_PATH}
+    start_early = params.pop("start_early")
+    if session.status != COMPLETE:
+        if not (start_early and session.early_start_ready and params["mode"] in ("auto", "single")):
+            return
+        params["mode"] = "single"
+        params["early_start"] = True
+        cache_key = None
+    try:
+        job = job_manager.submit(params, cache_key)
+    except QueueFullError as e:
+        # Keyingi bo'lakda (yoki yuklash tugaganda) yana urinib ko'riladi
+        print(f"⚠️ Analysis of upload {session.id} not started yet: {e}")
+        return
+    session.job_id = job.id
+    print(f"🚀 Analysis job {job.id} started for upload {session.id} ({session.offset}/{session.size} bytes)")
+
+
+@app.post("/uploads", status_code=201)
+async def create_upload(request: UploadRequest):
+    # Yuklash sessiyasi yaratiladi; baytlar PATCH /uploads/{id} orqali Upload-Offset sarlavhasi bilan yuboriladi
+    if request.analyze:
+        _validate_analysis_options(request, ("auto", "single", "segments"))
+    analysis = None
+    if request.analyze:
+        analysis = {"mode": request.mode, "segment_workers": request.segment_workers, "roi": request.roi,
+                    "roi_polygons": request.roi_polygons, "backend": request.backend,
+                    "start_early": request.start_early}
+    try:
+        session = await asyncio.to_thread(upload_manager.create, request.filename, request.size, analysis)
+    except UnsupportedVideo as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return _upload_response(session)
+
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    # Uzilgan yuklash shu yerdan olingan offset dan davom ettiriladi
+    return _upload_response(_get_upload_or_404(upload_id))
+
+
+@app.patch("/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request, upload_offset: int = Header(...)):
+    # So'rov tanasi xotiraga to'liq o'qilmaydi: UPLOAD_CHUNK_BYTES bo'laklarda diskka yoziladi va xeshlanadi
+    session = _get_upload_or_404(upload_id)
+    try:
+        await upload_manager.append(session, upload_offset, request.stream(), on_chunk=_start_upload_analysis)
+    except UploadOffsetMismatch as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Upload-Offset": str(e.offset)})
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e), headers={"Upload-Offset": str(session.offset)})
+    except UnsupportedVideo as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    if _early_analysis_lost(session):
+        # To'liq fayl qayta tahlil qilinadi
+        print(f"🔄 Early analysis {session.job_id} of upload {session.id} did not finish, analysing the full upload")
+        session.job_id = None
+    if session.status == COMPLETE and session.analysis is not None and session.job_id is None:
+        # Xesh yuklash paytida hisoblangan, kesh kaliti faylni qayta o'qimaydi
+        cache_key = None
+        if job_manager.result_cache is not None:
+            params = {**session.analysis, "video_path": str(session.path), "model_path": MODEL_PATH}
+            cache_key = await asyncio.to_thread(analysis_cache_key, params)
+        await asyncio.to_thread(_start_upload_analysis, session, cache_key)
+    await asyncio.to_thread(session.save)
+    return JSONResponse(content=_upload_response(session), headers={"Upload-Offset": str(session.offset)})
+
+
+def _get_job_or_404(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@app.get("/health")
+async def health():
+    pools = job_manager.pool_status()
+    warm = job_manager.is_warm
+    # Standart backend tayyor bo'lsa servis ishlaydi; boshqa backend poollari yuklanayotgani alohida ko'rsatiladi
+    loading = sorted({pool["backend"] for pool in pools if not pool["warm"] and not pool["error"]})
+    return JSONResponse(status_code=200 if warm else 503,
+                        content={"status": "ok" if warm else "warming", "executor": job_manager.executor,
+                                 "loading_backends": loading, "model_pools": pools})
+
+
+@app.get("/metrics")
+async def metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (METRICS=0)")
+    return PlainTextResponse(REGISTRY.expose(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/jobs/stats")
+async def get_jobs_stats():
+    return job_manager.stats()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return _get_job_or_404(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/progress")
+async def get_job_progress(job_id: str):
+    job = _get_job_or_404(job_id)
+    return {"status": job.status, **job.progress, "hls_url": job.stream_url}
+
+
+def _sse_message(kind: str, data: dict, event_id: int = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {kind}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    # Server-Sent Events: progress (cheklangan chastotada), har bir topilgan qoidabuzarlik va yakuniy "complete".
+    # Qayta ulanishda brauzer Last-Event-ID yuboradi, o'tkazib yuborilgan hodisalar qayta beriladi.
+    job = _get_job_or_404(job_id)
+    try:
+        after_event_id = int(request.headers.get("last-event-id", 0))
+    except ValueError:
+        after_event_id = 0
+
+    async def event_stream():
+        subscriber = job.subscribe(after_event_id)
         try:
-            result = analyze_video_for_violations(video_path, model_path, update_progress_callback)
-            analysis_result = result
-            print("Analysis completed in background task.")
-        except Exception as e:
-            print(f"Error during video analysis: {e}")
-            analysis_result = {"error": str(e)}
+            yield "retry: 2000\n\n" + _sse_message("progress", {"status": job.status, **job.progress})
+            if job.status in FINISHED_STATES and subscriber.empty():
+                # Tugagan ishning barcha hodisalarini mijoz allaqachon olgan
+                yield _sse_message("complete", job.completion_event())
+                return
+            while True:
+                try:
+                    event_id, kind, data = await asyncio.wait_for(subscriber.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse_message(kind, data, event_id)
+                if kind == "complete":
+                    break
         finally:
-            analysis_progress["current_frame"] = analysis_progress["total_frames"]
+            job.unsubscribe(subscriber)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-    background_tasks.add_task(video_analysis_task, video_to_process, model_to_use)
 
-    return {"message": "Video tahlili boshlandi", "status": "processing"}
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = _get_job_or_404(job_id)
+    if job.status not in FINISHED_STATES:
+        return JSONResponse(status_code=202, content={"status": job.status, "detail": "Analysis not finished yet."})
+    if job.status != COMPLETED:
+        return JSONResponse(status_code=409, content={"status": job.status, "error": job.error})
+    return job.result
 
 
-@app.get("/progress")
-async def get_progress():
-    global analysis_progress
-    return analysis_progress
+@app.get("/jobs/{job_id}/detection_log")
+async def export_detection_log(job_id: str):
+    # Log diskda JSON Lines yoki npz ko'rinishida saqlanadi; JSON massiv faqat so'ralganda oqim bilan yaratiladi
+    job = _get_job_or_404(job_id)
+    if job.status != COMPLETED:
+        return JSONResponse(status_code=409, content={"status": job.status, "detail": "Analysis not completed."})
+    log_url = job.result.get("detection_log_url")
+    log_path = RESULTS_ROOT / log_url[len("/results/"):] if log_url else None
+    if log_path is None or not log_path.exists():
+        raise HTTPException(status_code=404, detail=f"Detection log of job {job_id} not found")
+    return StreamingResponse(iter_json_export(log_path), media_type="application/json",
+                             headers={"Content-Disposition": f'attachment; filename="detection_log_{job_id}.json"'})
 
 
-@app.get("/results_data")
-async def get_results_data():
-    global analysis_result
-    if analysis_result is None:
-        raise HTTPException(status_code=404, detail="Analysis results not yet available or no analysis started.")
-    return analysis_result
\ No newline at end of file
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    # Bir xil so'rovlar bo'lishgan ish boshqa kutayotganlar uchun davom etadi (sharers > 0)
+    return {"job_id": job.id, "status": job.status, "cancel_requested": job.cancel_event.is_set(),
+            "sharers": job.sharers}
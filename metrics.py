@@ -0,0 +1,267 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from stage_timing import NULL_TIMER
+
+# --- CONFIGURATION ---
+# "1" (default): analysis hot paths are timed and /metrics serves Prometheus text format; "0": hooks are no-ops
+METRICS_ENABLED = os.environ.get("METRICS", "1") != "0"
+METRIC_PREFIX = "driverlens_"
+# Histogram buckets (upper bounds)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+INFERENCE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FPS_BUCKETS = (1, 2, 5, 10, 15, 20, 25, 30, 50, 100, 200)
+LOAD_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+WAIT_BUCKETS = (0.1, 1, 5, 10, 30, 60, 300, 600, 1800)
+
+
+def _format_labels(labelnames, values, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self, reset: bool = False) -> dict:
+        with self._lock:
+            values = dict(self._values)
+            if reset:
+                self._values.clear()
+        return values
+
+    def merge(self, values: dict):
+        for labels, amount in values.items():
+            self.inc(amount, *labels)
+
+    def expose(self) -> list:
+        lines = self.header()
+        for labels, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def expose(self) -> list:
+        lines = self.header()
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels, count: int = 1):
+        """Records `count` observations of `value` (count > 1: e.g. every frame of a batch)."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [bucket bo'yicha sonlar (+Inf bilan), yig'indi, soni]
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += count
+            state[1] += value * count
+            state[2] += count
+
+    def snapshot(self, reset: bool = False) -> dict:
+        with self._lock:
+            values = {labels: [list(counts), total, count] for labels, (counts, total, count) in self._values.items()}
+            if reset:
+                self._values.clear()
+        return values
+
+    def merge(self, values: dict):
+        with self._lock:
+            for labels, (counts, total, count) in values.items():
+                state = self._values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+
+    def expose(self) -> list:
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of one process. Worker processes (ANALYSIS_EXECUTOR=process) send their counters and histograms
+    to the API process with drain()/merge(); gauges are filled at scrape time by collectors.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """collector() is called before every exposition, e.g. to set gauges from the current state."""
+        self._collectors.append(collector)
+
+    def drain(self) -> dict:
+        """:return: {metric name: values} of counters and histograms, which are reset."""
+        return {metric.name: metric.snapshot(reset=True) for metric in self.metrics
+                if isinstance(metric, (Counter, Histogram))}
+
+    def merge(self, drained: dict):
+        by_name = {metric.name: metric for metric in self.metrics}
+        for name, values in drained.items():
+            if name in by_name:
+                by_name[name].merge(values)
+
+    def expose(self) -> str:
+        """:return: All metrics in the Prometheus text exposition format."""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "stage_seconds", "Per-frame time of an analysis stage.", STAGE_BUCKETS, ("stage",)))
+INFERENCE_FRAME_SECONDS = REGISTRY.register(Histogram(
+    "inference_frame_seconds", "Detector latency per frame (batch time divided by its frames).", INFERENCE_BUCKETS,
+    ("backend",)))
+ENCODE_FRAME_SECONDS = REGISTRY.register(Histogram(
+    "encode_frame_seconds", "Time to hand one annotated frame to the video encoder (ffmpeg pipe).", STAGE_BUCKETS))
+JOB_FPS = REGISTRY.register(Histogram(
+    "job_frames_per_second", "Frames per second of finished analysis jobs.", FPS_BUCKETS, ("mode",)))
+JOB_QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "job_queue_wait_seconds", "Time analysis jobs waited in the queue.", WAIT_BUCKETS))
+MODEL_LOAD_SECONDS = REGISTRY.register(Histogram(
+    "model_load_seconds", "Time to load (and on first use export) a detector model.", LOAD_BUCKETS, ("backend",)))
+JOBS_FINISHED = REGISTRY.register(Counter(
+    "jobs_finished_total", "Finished analysis jobs.", ("status",)))
+FRAMES_ANALYSED = REGISTRY.register(Counter(
+    "frames_analysed_total", "Frames of finished analysis jobs."))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "queue_depth", "Analysis jobs waiting in the queue."))
+JOBS = REGISTRY.register(Gauge(
+    "jobs", "Analysis jobs kept in memory by status.", ("status",)))
+PROCESS_RSS_BYTES = REGISTRY.register(Gauge(
+    "process_resident_memory_bytes", "Resident memory of the API process and its analysis worker processes.",
+    ("process",)))
+
+
+def process_rss_bytes(pid="self"):
+    """:return: Current resident memory of a process from /proc, or None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MetricsTimer:
+    """
+    StageTimer interface (measure/add) that feeds the Prometheus histograms. ViolationAnalyzer and
+    analyze_video_for_violations take it as `timer`: "inference" and "encode" go to their own histograms,
+    every other stage to STAGE_SECONDS.
+    """
+
+    def __init__(self, backend: str = None):
+        self.backend = backend or os.environ.get("INFERENCE_BACKEND", "torch")
+
+    def _observe(self, stage: str, seconds: float, count: int = 1):
+        if stage == "inference":
+            INFERENCE_FRAME_SECONDS.observe(seconds, self.backend, count=count)
+        elif stage == "encode":
+            ENCODE_FRAME_SECONDS.observe(seconds, count=count)
+        else:
+            STAGE_SECONDS.observe(seconds, stage, count=count)
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        if count:
+            self._observe(stage, seconds / count, count)
+
+
+def job_timer(backend: str = None):
+    """:return: Timer for one analysis job; NULL_TIMER when metrics are disabled."""
+    return MetricsTimer(backend) if METRICS_ENABLED else NULL_TIMER
+
+
+def observe_model_load(backend: str, seconds: float):
+    if METRICS_ENABLED:
+        MODEL_LOAD_SECONDS.observe(seconds, backend)
+
+
+def observe_job_finished(status: str, mode: str = None, frames: int = None, run_seconds: float = None,
+                         queue_wait_seconds: float = None):
+    if not METRICS_ENABLED:
+        return
+    JOBS_FINISHED.inc(1, status)
+    if queue_wait_seconds is not None:
+        JOB_QUEUE_WAIT_SECONDS.observe(queue_wait_seconds)
+    if frames and run_seconds:
+        FRAMES_ANALYSED.inc(frames)
+        JOB_FPS.observe(frames / run_seconds, mode or "single")
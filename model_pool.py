@@ -0,0 +1,227 @@
+import os
+import hashlib
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+from inference_backends import get_backend
+from metrics import observe_model_load
+
+# --- CONFIGURATION ---
+# Fallback weights used when the trained model file is missing
+DEFAULT_MODEL_NAME = 'yolov8n.pt'
+# Torch threads used by one model instance (kept in sync with OMP_NUM_THREADS in infer_and_track_violations.py)
+THREADS_PER_MODEL = int(os.environ.get("OMP_NUM_THREADS", "2"))
+# Image size used for the warm-up inference
+WARMUP_IMGSZ = 640
+
+
+def file_sha256(path, chunk_size: int = 1 << 20) -> str:
+    """
+    Computes the SHA-256 hash of a file without reading it into memory at once.
+
+    :param path: Path to the file.
+    :param chunk_size: Number of bytes read per iteration.
+    :return: Hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_hash_cache = {}
+_hash_cache_lock = threading.Lock()
+
+
+def cached_file_sha256(path) -> str:
+    """SHA-256 of a file, cached per (path, mtime, size) so unchanged files are hashed only once."""
+    path = Path(path)
+    stat = path.stat()
+    cache_key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+    with _hash_cache_lock:
+        digest = _hash_cache.get(cache_key)
+    if digest is None:
+        digest = file_sha256(path)
+        with _hash_cache_lock:
+            _hash_cache[cache_key] = digest
+    return digest
+
+
+def prime_file_sha256(path, digest: str):
+    """Records a hash computed elsewhere (e.g. while a file was uploaded) for cached_file_sha256."""
+    path = Path(path)
+    stat = path.stat()
+    with _hash_cache_lock:
+        _hash_cache[(str(path.resolve()), stat.st_mtime_ns, stat.st_size)] = digest
+
+
+def weights_key(model_path) -> tuple:
+    """
+    Returns the (resolved weights path, file hash) pair that identifies a model.
+
+    :param model_path: Path to the weights file. Missing files resolve to the default YOLOv8n weights.
+    """
+    path = Path(model_path)
+    if not path.exists():
+        return DEFAULT_MODEL_NAME, DEFAULT_MODEL_NAME
+    return str(path.resolve()), cached_file_sha256(path)
+
+
+def load_yolo_model(model_path, backend: str = None):
+    """
+    Loads a YOLO model, falling back to the default 'yolov8n.pt' weights if the file does not exist.
+
+    :param model_path: Path to the trained weights.
+    :param backend: Inference backend ("torch", "onnx", "openvino"); None uses INFERENCE_BACKEND.
+        Non-torch backends export the weights once and load the cached export.
+    :return: The loaded YOLO model.
+    """
+    print(f"Loading model from: {model_path}")
+    if not Path(model_path).exists():
+        print(f"❌ ERROR: Model file not found! Please check the specified path: {model_path}")
+        print(f"Hint: Using default '{DEFAULT_MODEL_NAME}' model for inference.")
+        return YOLO(DEFAULT_MODEL_NAME)
+    backend = get_backend(backend)
+    if backend.name != "torch":
+        print(f"Using {backend.name} inference backend")
+    start = time.perf_counter()
+    model = backend.load(model_path, weights_key(model_path)[1])
+    observe_model_load(backend.name, time.perf_counter() - start)
+    return model
+
+
+def warm_up_model(model, imgsz: int = WARMUP_IMGSZ):
+    """
+    Runs one inference on a blank frame so the predictor is built and the first real frame is not slow.
+
+    :param model: Loaded YOLO model.
+    :param imgsz: Inference image size.
+    :return: Warm-up duration in seconds.
+    """
+    start = time.perf_counter()
+    model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), verbose=False, imgsz=imgsz)
+    return time.perf_counter() - start
+
+
+def default_pool_size() -> int:
+    """Number of model instances that fit into the CPU budget of this process."""
+    env_size = os.environ.get("MODEL_POOL_SIZE")
+    if env_size:
+        return max(1, int(env_size))
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    return max(1, cpu_count // max(1, THREADS_PER_MODEL))
+
+
+class ModelPool:
+    """
+    A fixed-size pool of warmed-up YOLO models for one weights file.
+    Each analysis job borrows a model with acquire() and returns it when done,
+    so model instances are never shared between concurrently running jobs.
+    """
+
+    def __init__(self, model_path, size: int = None, imgsz: int = WARMUP_IMGSZ, backend: str = None):
+        self.model_path = str(model_path)
+        self.size = size or default_pool_size()
+        self.imgsz = imgsz
+        self.backend = get_backend(backend).name
+        self.key = weights_key(self.model_path)
+        self._models = queue.Queue()
+        self._loaded = 0
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self.error = None
+        self.load_seconds = None
+
+    def start(self):
+        """Loads and warms up all model instances. Safe to call from a background thread."""
+        with self._lock:
+            if self._ready.is_set() or self._loaded:
+                return
+            start = time.perf_counter()
+            try:
+                for _ in range(self.size):
+                    model = load_yolo_model(self.model_path, self.backend)
+                    warmup_seconds = warm_up_model(model, self.imgsz)
+                    self._models.put(model)
+                    self._loaded += 1
+                    print(f"✅ Model {self._loaded}/{self.size} warmed up in {warmup_seconds:.2f}s")
+            except Exception as e:
+                self.error = str(e)
+                print(f"❌ Model pool failed to load {self.model_path}: {e}")
+            self.load_seconds = time.perf_counter() - start
+            self._ready.set()
+
+    @property
+    def is_warm(self) -> bool:
+        return self._ready.is_set() and self.error is None and self._loaded > 0
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    @contextmanager
+    def acquire(self, timeout: float = None):
+        """
+        Borrows a model from the pool, loading the pool first if it has not been started yet.
+
+        :param timeout: Maximum seconds to wait for a free model (None waits forever).
+        """
+        if not self._ready.is_set():
+            self.start()
+        if self._loaded == 0:
+            raise RuntimeError(f"Model pool for {self.model_path} is empty: {self.error}")
+        model = self._models.get(timeout=timeout)
+        try:
+            yield model
+        finally:
+            self._models.put(model)
+
+    def status(self) -> dict:
+        return {
+            "model_path": self.key[0],
+            "weights_hash": self.key[1],
+            "backend": self.backend,
+            "size": self.size,
+            "loaded": self._loaded,
+            "available": self._models.qsize(),
+            "warm": self.is_warm,
+            "load_seconds": self.load_seconds,
+            "error": self.error,
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_model_pool(model_path, size: int = None, backend: str = None) -> ModelPool:
+    """
+    Returns the pool for a weights file and inference backend, keyed by the weights path and content hash.
+    If the file on disk changes, a new pool is created for the new hash.
+
+    :param model_path: Path to the weights file.
+    :param size: Pool size used when a new pool has to be created.
+    :param backend: Inference backend name (None for INFERENCE_BACKEND).
+    """
+    backend = get_backend(backend).name
+    key = weights_key(model_path) + (backend,)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ModelPool(model_path, size=size, backend=backend)
+            _pools[key] = pool
+    return pool
+
+
+def all_pools() -> list:
+    with _pools_lock:
+        return list(_pools.values())
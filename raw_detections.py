@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from detections import FrameDetections, box_iou
+from inference_backends import get_backend
+from light_classifier import LightStateClassifier
+from model_pool import cached_file_sha256, weights_key
+from roi_inference import resolve_roi
+
+# --- CONFIGURATION ---
+# "1" (default): single-pass analyses save the raw detector output, so tracker, rule and drawing changes can be
+# replayed (replay_analysis.py) without running the detector again; "0": nothing is saved
+RAW_DETECTION_STORE = os.environ.get("RAW_DETECTION_STORE", "1") != "0"
+RAW_DETECTIONS_ROOT = Path(os.environ.get("RAW_DETECTIONS_ROOT", "/app/raw_detections"))
+# Bump when the stored arrays change
+RAW_STORE_FORMAT_VERSION = 1
+# A replayed traffic-light box takes the recorded HSV state of the recorded box it overlaps at least this much
+REPLAY_LIGHT_MATCH_IOU = 0.5
+
+
+def raw_store_config(video_path, model_path, settings: dict, backend: str = None, roi: str = None,
+                     roi_polygons=None) -> dict:
+    """
+    Everything the raw detector output depends on, with the video and weights identified by content hash.
+
+    :param settings: Inference settings of the analysis (confidence threshold, image size, schedule...).
+    """
+    return {
+        "version": RAW_STORE_FORMAT_VERSION,
+        "video_sha256": cached_file_sha256(video_path),
+        "weights_sha256": weights_key(model_path)[1],
+        "backend": get_backend(backend).name,
+        "roi": resolve_roi(roi, roi_polygons),
+        **settings,
+    }
+
+
+def raw_store_path(video_path, model_path, settings: dict, backend: str = None, roi: str = None,
+                   roi_polygons=None) -> Path:
+    """Store file of a video analysed with these weights and inference settings (hashes the video)."""
+    config = json.dumps(raw_store_config(video_path, model_path, settings, backend, roi, roi_polygons),
+                        sort_keys=True)
+    return RAW_DETECTIONS_ROOT / f"{hashlib.sha256(config.encode()).hexdigest()[:32]}.npz"
+
+
+# The recorder writes a chunk file to disk after this many buffered rows (detections, light boxes, frames)
+RAW_STORE_CHUNK_ROWS = int(os.environ.get("RAW_STORE_CHUNK_ROWS", "65536"))
+
+# Stored arrays: name -> (empty shape, dtype)
+_RAW_COLUMNS = {
+    "inference_frames": ((0,), np.int32),
+    "frame": ((0,), np.int32),
+    "xyxy": ((0, 4), np.float32),
+    "conf": ((0,), np.float32),
+    "cls": ((0,), np.int16),
+    "light_frame": ((0,), np.int32),
+    "light_xyxy": ((0, 4), np.float32),
+    "light_cls": ((0,), np.int16),
+    "light_conf": ((0,), np.float32),
+}
+
+
+def _concat(chunks, shape, dtype):
+    return np.concatenate(chunks).astype(dtype) if chunks else np.empty(shape, dtype=dtype)
+
+
+def _load_column(chunk_path, name):
+    with np.load(chunk_path) as data:
+        return data[name]
+
+
+class RawDetectionRecorder:
+    """
+    Collects the detector output of every inference frame (before the tracker and the scene cache) and the
+    HSV traffic-light states. They are written as chunk files to a temporary directory in RAW_DETECTIONS_ROOT
+    during the run and assembled into one compressed npz file by save().
+    """
+
+    def __init__(self, meta: dict, root=None, chunk_rows: int = RAW_STORE_CHUNK_ROWS):
+        self.path = None
+        self.meta = meta
+        self.chunk_rows = chunk_rows
+        root = Path(root or RAW_DETECTIONS_ROOT)
+        root.mkdir(parents=True, exist_ok=True)
+        # Bo'laklar yakuniy store bilan bir diskda: save() oxirida faqat os.replace qilinadi
+        self.chunk_dir = Path(tempfile.mkdtemp(prefix=".recording_", dir=root))
+        self._columns = {name: [] for name in _RAW_COLUMNS}
+        self._buffered_rows = 0
+        self._chunks = 0
+        self._error = None
+
+    def add_detections(self, frame_idx: int, detections: FrameDetections):
+        self._columns["inference_frames"].append(np.array([frame_idx], dtype=np.int32))
+        if len(detections):
+            # Har bir detektsiya qatori uchun kadr raqami saqlanadi (ustunlar bo'yicha)
+            self._columns["frame"].append(np.full(len(detections), frame_idx, dtype=np.int32))
+            self._columns["xyxy"].append(detections.xyxy)
+            self._columns["conf"].append(detections.conf)
+            self._columns["cls"].append(detections.cls)
+        self._buffered_rows += 1 + len(detections)
+        if self._buffered_rows >= self.chunk_rows:
+            self._write_chunk()
+
+    def add_lights(self, frame_idx: int, boxes, cls_ids, confidences):
+        if len(boxes):
+            self._columns["light_frame"].append(np.full(len(boxes), frame_idx, dtype=np.int32))
+            self._columns["light_xyxy"].append(np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
+            self._columns["light_cls"].append(cls_ids)
+            self._columns["light_conf"].append(confidences)
+            self._buffered_rows += len(boxes)
+            if self._buffered_rows >= self.chunk_rows:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        if not self._buffered_rows:
+            return
+        arrays = {name: _concat(self._columns[name], shape, dtype) for name, (shape, dtype) in _RAW_COLUMNS.items()}
+        self._columns = {name: [] for name in _RAW_COLUMNS}
+        self._buffered_rows = 0
+        if self._error is not None:
+            return
+        try:
+            # Bo'laklar siqilmaydi, yakuniy fayl save() da siqiladi
+            np.savez(self.chunk_dir / f"chunk_{self._chunks:05d}.npz", **arrays)
+        except OSError as e:
+            # Store faqat replay uchun: disk xatosi tahlilni to'xtatmaydi, save() xatoni qaytaradi
+            print(f"⚠️ Could not write raw detection chunk: {e}")
+            self._error = e
+            return
+        self._chunks += 1
+
+    def save(self, path: Path) -> Path:
+        """Assembles the chunks into the store file at path, one array at a time, and removes the chunks."""
+        try:
+            self._write_chunk()
+            if self._error is not None:
+                raise self._error
+            self.path = Path(path)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.chunk_dir / "store.npz"
+            chunk_paths = [self.chunk_dir / f"chunk_{i:05d}.npz" for i in range(self._chunks)]
+            with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                with archive.open("meta.npy", "w") as f:
+                    np.lib.format.write_array(f, np.array(json.dumps(self.meta)))
+                for name, (shape, dtype) in _RAW_COLUMNS.items():
+                    # Xotirada bir vaqtda faqat bitta ustun bo'ladi
+                    parts = [_load_column(chunk_path, name) for chunk_path in chunk_paths]
+                    with archive.open(f"{name}.npy", "w", force_zip64=True) as f:
+                        np.lib.format.write_array(f, _concat(parts, shape, dtype))
+            # Yarim yozilgan fayl hech qachon tayyor store sifatida ko'rinmaydi
+            os.replace(tmp_path, self.path)
+            return self.path
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Removes the chunk directory (called by save(), or when the analysis fails)."""
+        self._columns = {name: [] for name in _RAW_COLUMNS}
+        self._buffered_rows = 0
+        shutil.rmtree(self.chunk_dir, ignore_errors=True)
+
+
+class RawDetectionStore:
+    """Raw detections of one analysed video, loaded from a RawDetectionRecorder file."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with np.load(self.path) as data:
+            self.meta = json.loads(str(data["meta"]))
+            self.inference_frames = data["inference_frames"]
+            frame, xyxy, conf, cls = data["frame"], data["xyxy"], data["conf"], data["cls"].astype(np.int32)
+            light_frame, light_xyxy = data["light_frame"], data["light_xyxy"]
+            light_cls, light_conf = data["light_cls"].astype(np.int32), data["light_conf"]
+        # Qatorlar kadr bo'yicha tartiblangan, har bir kadr bitta bo'lak (ko'rinish, nusxa emas)
+        self._detections = self._split(frame, xyxy, conf, cls)
+        self._lights = self._split(light_frame, light_xyxy, light_conf, light_cls)
+
+    @staticmethod
+    def _split(frame, xyxy, conf, cls) -> dict:
+        frames, starts = np.unique(frame, return_index=True)
+        ends = np.append(starts[1:], len(frame))
+        return {int(f): FrameDetections(xyxy[s:e], conf[s:e], cls[s:e]) for f, s, e in zip(frames, starts, ends)}
+
+    @property
+    def class_names(self) -> dict:
+        return {int(cls_id): name for cls_id, name in self.meta["class_names"].items()}
+
+    def detections(self, frame_idx: int) -> FrameDetections:
+        return self._detections.get(frame_idx, FrameDetections.empty())
+
+    def lights(self, frame_idx: int) -> FrameDetections:
+        """HSV-classified traffic-light boxes of a frame as recorded (cls -1: no lamp lit)."""
+        return self._lights.get(frame_idx, FrameDetections.empty())
+
+
+class ReplayLightClassifier(LightStateClassifier):
+    """
+    LightStateClassifier that needs no frame pixels: a box gets the recorded state of the recorded light box
+    it overlaps most (IoU >= REPLAY_LIGHT_MATCH_IOU) on the same frame, otherwise no lit lamp.
+    """
+
+    needs_frame = False
+
+    def __init__(self, class_names: dict, store: RawDetectionStore):
+        super().__init__(class_names, store.meta.get("light_classifier", "off"))
+        self.store = store
+
+    def classify(self, frame, boxes, frame_idx: int = None):
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        cls_ids = np.full(len(boxes), -1, dtype=np.int32)
+        confidences = np.zeros(len(boxes), dtype=np.float32)
+        recorded = self.store.lights(frame_idx)
+        if len(boxes) and len(recorded):
+            iou = box_iou(boxes, recorded.xyxy)
+            best = iou.argmax(axis=1)
+            matched = iou[np.arange(len(boxes)), best] >= REPLAY_LIGHT_MATCH_IOU
+            cls_ids[matched] = recorded.cls[best[matched]]
+            confidences[matched] = recorded.conf[best[matched]]
+        self.frames += 1
+        return cls_ids, confidences
@@ -0,0 +1,152 @@
+import time
+
+import cv2
+
+from infer_and_track_violations import (
+    CLIP_DURATION_SECONDS, ViolationAnalyzer, prepare_result_dirs, build_final_result, violation_entry,
+    inference_settings,
+)
+from frame_ring_buffer import ViolationClipRecorder
+from detection_log import open_log_writer
+from raw_detections import RawDetectionStore, ReplayLightClassifier, raw_store_path
+from video_pipeline import VideoPipeline, PIPELINE_QUEUE_SIZE
+from video_encoder import open_video_writer
+from stage_timing import NULL_TIMER
+
+# --- CONFIGURATION ---
+# How often (in frames) a replay without rendering reports progress
+REPLAY_PROGRESS_EVERY_FRAMES = 250
+
+
+def replay_video_for_violations(video_path: str, model_path: str, progress_callback=None, run_id: str = None,
+                                render: bool = False, rule_names=None, backend: str = None, roi: str = None,
+                                roi_polygons=None, timer=None, violation_callback=None, store_path=None):
+    """
+    Re-runs tracking, violation rules and the detection log on the raw detections saved by an earlier
+    analyze_video_for_violations run of the same video, weights and inference settings, without the detector.
+    Frames the detector ran on get their stored detections, the others are propagated as in the original run.
+
+    Without render no frame is decoded: traffic lights keep the states the HSV classifier recorded, and there
+    is no annotated video, screenshots or clips. With render the video is decoded, lights are classified
+    again from the pixels and the annotated video and violation clips are written.
+
+    :param store_path: Raw detection store to replay; by default the one matching the arguments.
+    :return: The analysis result (as analyze_video_for_violations), or {"error": ...} when there is no store.
+    """
+    timer = timer or NULL_TIMER
+    store_path = store_path or raw_store_path(video_path, model_path, inference_settings(), backend, roi,
+                                              roi_polygons)
+    if not store_path.exists():
+        print(f"❌ Error: No raw detections for {video_path} with these weights and inference settings")
+        return {"violation_detected": False,
+                "error": f"No raw detections for {video_path}; analyse it once without replay first"}
+    store = RawDetectionStore(store_path)
+    class_names = store.class_names
+    fps = store.meta["fps"]
+    total_frames = store.meta["frames"]
+    inference_frames = set(store.inference_frames.tolist())
+    print(f"🔄 Replaying {len(inference_frames)} inference frames of {total_frames} from {store_path}")
+
+    current_time_str, RESULT_DIR, VIOLATION_DIR, SCREENSHOT_DIR = prepare_result_dirs(run_id)
+    annotated_video_path = RESULT_DIR / 'annotated_video.mp4' if render else None
+    log_writer = open_log_writer(RESULT_DIR, class_names, fps)
+    # Render qilinmasa kadr piksellari yo'q: svetofor holatlari asl tahlilda yozilganidan olinadi
+    analyzer = ViolationAnalyzer(class_names, fps, draw=render, rule_names=rule_names, log_writer=log_writer,
+                                 timer=timer,
+                                 light_classifier=None if render else ReplayLightClassifier(class_names, store))
+    clip_recorder = None
+    if render:
+        clip_recorder = ViolationClipRecorder(VIOLATION_DIR, SCREENSHOT_DIR, fps,
+                                              (store.meta["width"], store.meta["height"]), CLIP_DURATION_SECONDS)
+    violation_artifacts = {}
+
+    def replay_frame(frame_idx: int, frame):
+        violations_before = len(analyzer.violations)
+        if frame_idx in inference_frames:
+            analyzer.process_frame(frame_idx, frame, store.detections(frame_idx))
+        else:
+            analyzer.propagate_frame(frame_idx, frame)
+        for info in analyzer.violations[violations_before:]:
+            key = (info['frame_idx'], info['car_id'])
+            if clip_recorder is not None and key not in violation_artifacts:
+                violation_artifacts[key] = clip_recorder.add_violation(info)
+            if violation_callback:
+                violation_callback(violation_entry(current_time_str, info, violation_artifacts))
+
+    start = time.perf_counter()
+    try:
+        if render:
+            pipeline_stats = _replay_rendered(video_path, annotated_video_path, store.meta, replay_frame,
+                                              clip_recorder, progress_callback, timer)
+        else:
+            for frame_idx in range(total_frames):
+                if progress_callback and frame_idx % REPLAY_PROGRESS_EVERY_FRAMES == 0:
+                    progress_callback(frame_idx, total_frames)
+                replay_frame(frame_idx, None)
+            if progress_callback and total_frames:
+                progress_callback(total_frames - 1, total_frames)
+            pipeline_stats = None
+    finally:
+        log_writer.close()
+        if clip_recorder is not None:
+            clip_recorder.close()
+    elapsed = time.perf_counter() - start
+    print(f"✅ Replay finished in {elapsed:.2f}s ({total_frames / max(elapsed, 1e-9):.0f} frames/sec)")
+    print(f"✅ {len(analyzer.violations)} violation(s) detected")
+
+    final_result = build_final_result(current_time_str, annotated_video_path, analyzer.violations,
+                                      violation_artifacts)
+    final_result["detection_log_url"] = f"/results/{current_time_str}/{log_writer.path.name}"
+    final_result["scene_layout"] = analyzer.scene.stats() if analyzer.scene is not None else {"enabled": False}
+    final_result["light_classifier"] = {"mode": analyzer.light_classifier.mode,
+                                        "classified_frames": analyzer.light_classifier.frames,
+                                        "replayed": not render}
+    final_result["raw_detection_store"] = store_path.name
+    final_result["replay"] = {"frames": total_frames, "inference_frames": len(inference_frames),
+                              "rendered": render, "elapsed_seconds": round(elapsed, 3),
+                              "frames_per_second": round(total_frames / max(elapsed, 1e-9), 1)}
+    if pipeline_stats is not None:
+        final_result["pipeline_stats"] = pipeline_stats
+    return final_result
+
+
+def _replay_rendered(video_path, annotated_video_path, meta: dict, replay_frame, clip_recorder, progress_callback,
+                     timer):
+    """Decodes the video, replays every frame on it and encodes the annotated video (decode -> replay -> encode)."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open video: {video_path}")
+    total_frames = meta["frames"]
+    out = open_video_writer(annotated_video_path, meta["fps"], (meta["width"], meta["height"]))
+
+    def decode_frames():
+        # Asl tahlildagidek faqat yozilgan kadrlar soni o'ynatiladi
+        for frame_idx in range(total_frames):
+            with timer.measure("decode"):
+                ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame_idx, frame
+
+    def replay_stage(item, emit):
+        frame_idx, frame = item
+        if progress_callback:
+            progress_callback(frame_idx, total_frames)
+        clip_recorder.push(frame_idx, frame)  # chizishdan oldin, kadr nusxasi saqlanadi
+        replay_frame(frame_idx, frame)
+        emit(frame)
+
+    def encode_stage(frame, emit):
+        with timer.measure("encode"):
+            out.write(frame)
+
+    pipeline = VideoPipeline(queue_size=PIPELINE_QUEUE_SIZE)
+    pipeline.set_source("decode", decode_frames())
+    pipeline.add_stage("replay", replay_stage)
+    pipeline.add_stage("encode", encode_stage)
+    try:
+        pipeline_stats = pipeline.run()
+    finally:
+        cap.release()
+        out.release()
+    return pipeline_stats
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+import infer_and_track_violations as itv
+from detection_log import DETECTION_LOG_FORMAT
+from inference_backends import get_backend
+from inference_scheduler import INFERENCE_SCHEDULE
+from light_classifier import LIGHT_CLASSIFIER
+from model_pool import cached_file_sha256, weights_key
+from roi_inference import resolve_roi
+from scene_layout import SCENE_LAYOUT_CACHE
+from violation_rules import VIOLATION_RULES
+
+# --- CONFIGURATION ---
+# "1" (default): identical analyses (same video content, weights and settings) reuse the earlier result
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "1") != "0"
+# Cached result directories are evicted least-recently-used first when they take more than this
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get("RESULT_CACHE_MAX_GB", "20")) * 1024 ** 3)
+# Index of cached results, stored next to the result directories; it holds only metadata, the result dict
+# itself is kept as RESULT_FILE_NAME in its result directory
+RESULT_CACHE_INDEX_NAME = "result_cache.json"
+RESULT_FILE_NAME = "result.json"
+# Cache hits only update last-used times; the index is rewritten for them at most this often
+RESULT_CACHE_INDEX_SAVE_SECONDS = 30
+# Bump when a code change makes earlier results invalid
+CACHE_FORMAT_VERSION = 1
+
+
+def analysis_config(params: dict) -> dict:
+    """Everything an analysis result depends on, with the video and weights identified by content hash."""
+    return {
+        "version": CACHE_FORMAT_VERSION,
+        "video_sha256": cached_file_sha256(params["video_path"]),
+        "weights_sha256": weights_key(params["model_path"])[1],
+        "backend": get_backend(params.get("backend")).name,
+        "mode": params.get("mode", "auto"),
+        "render": bool(params.get("render")),
+        "roi": resolve_roi(params.get("roi"), params.get("roi_polygons")),
+        "confidence_threshold": itv.CONFIDENCE_THRESHOLD,
+        "imgsz": itv.IMGSZ,
+        "frame_skip": itv.FRAME_SKIP,
+        "violation_rules": VIOLATION_RULES,
+        "inference_schedule": INFERENCE_SCHEDULE,
+        "scene_layout_cache": SCENE_LAYOUT_CACHE,
+        "light_classifier": LIGHT_CLASSIFIER,
+        "detection_log_format": DETECTION_LOG_FORMAT,
+    }
+
+
+def analysis_cache_key(params: dict) -> str:
+    """
+    Content-addressed key of an analysis job. Hashing streams the video from disk (hashes are cached per
+    path, mtime and size), so call it outside the event loop.
+    """
+    config = json.dumps(analysis_config(params), sort_keys=True)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+def _directory_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ResultCache:
+    """
+    Maps analysis cache keys to finished results and their result directories under RESULTS_ROOT.
+    The index survives restarts (RESULT_CACHE_INDEX_NAME) and keeps only metadata; each result is read from
+    RESULT_FILE_NAME in its directory. Directories of evicted results are deleted.
+    """
+
+    def __init__(self, results_root: Path = None, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.results_root = Path(results_root or itv.RESULTS_ROOT)
+        self.index_path = self.results_root / RESULT_CACHE_INDEX_NAME
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        # Faqat last_used_at/hits o'zgargan: indeks keyinroq (flush yoki keyingi put da) yoziladi
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _load(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Result cache index {self.index_path} is unreadable ({e}), starting empty")
+            return {}
+
+    def _save(self):
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def flush(self):
+        """Writes last-used times of cache hits that are not saved yet."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    @staticmethod
+    def run_dir_name(result: dict):
+        """Result directory of a result, from its "/results/<dir>/..." URLs."""
+        url = result.get("annotated_video_url") or result.get("detection_log_url")
+        return url.split("/")[2] if url and url.startswith("/results/") else None
+
+    def _read_result(self, entry: dict):
+        try:
+            with open(self.results_root / entry["run_dir"] / RESULT_FILE_NAME) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key: str):
+        """:return: The cached result, or None. Entries whose directory or result file is gone are dropped."""
+        with self._lock:
+            entry = self._entries.get(key)
+            result = self._read_result(entry) if entry is not None else None
+            if entry is not None and result is None:
+                del self._entries[key]
+                self._save()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            entry["last_used_at"] = time.time()
+            entry["hits"] += 1
+            self.hits += 1
+            # Har bir hit da indeks qayta yozilmaydi: LRU tartibi uchun bir oz eskirgan vaqt yetarli
+            self._dirty = True
+            if time.monotonic() - self._saved_at >= RESULT_CACHE_INDEX_SAVE_SECONDS:
+                self._save()
+            return result
+
+    def put(self, key: str, result: dict):
+        run_dir = self.run_dir_name(result)
+        if run_dir is None or "error" in result:
+            return
+        result_path = self.results_root / run_dir / RESULT_FILE_NAME
+        tmp_path = result_path.with_name(f"{RESULT_FILE_NAME}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, result_path)
+        size = _directory_size(self.results_root / run_dir)
+        with self._lock:
+            now = time.time()
+            self._entries[key] = {"run_dir": run_dir, "size_bytes": size, "created_at": now,
+                                  "last_used_at": now, "hits": 0}
+            self._evict(keep=key)
+            self._save()
+
+    def _evict(self, keep: str):
+        total = sum(entry["size_bytes"] for entry in self._entries.values())
+        # Eng uzoq ishlatilmagan natijalar katalogi bilan birga o'chiriladi
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]["last_used_at"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.results_root / entry["run_dir"], ignore_errors=True)
+            total -= entry["size_bytes"]
+            del self._entries[key]
+            self.evictions += 1
+            print(f"ℹ️ Result cache: evicted {entry['run_dir']} ({entry['size_bytes'] / 1024 ** 2:.1f} MB)")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "size_bytes": sum(entry["size_bytes"] for entry in self._entries.values()),
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
@@ -0,0 +1,214 @@
+import os
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from detections import FrameDetections, box_iou
+
+# --- CONFIGURATION ---
+# "off": full frames; "auto": zones around the cached crosswalks, stop lines and lights; any other value is a
+# camera id whose polygons are read from ROI_CONFIG
+ROI_MODE = os.environ.get("ROI_MODE", "off")
+# JSON file {"<camera id>": [[[x, y], ...], ...]} with ROI polygons in full-frame pixels
+ROI_CONFIG = Path(os.environ.get("ROI_CONFIG", "/app/roi_config.json"))
+# Auto zones: crosswalk/line boxes grow by this share of their size on each side (cars approaching them),
+# light boxes by ROI_LIGHT_MARGIN
+ROI_AUTO_MARGIN = 1.0
+ROI_LIGHT_MARGIN = 2.0
+# If the zones cover more than this share of the frame, the full frame is cheaper
+ROI_MAX_FRAME_SHARE = 0.6
+# Detections of overlapping zones are merged with class-wise NMS at this IoU
+ROI_NMS_IOU = 0.5
+# Pixels of a crop outside its polygon are filled with the letterbox colour
+ROI_FILL_VALUE = 114
+
+
+def load_roi_config(path=ROI_CONFIG) -> dict:
+    """:return: {camera id: polygons} from the ROI config file, or {} if there is none."""
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def resolve_roi(roi: str = None, polygons=None):
+    """
+    Resolves the ROI settings of a job.
+
+    :param roi: "off", "auto", a camera id from ROI_CONFIG, or None for ROI_MODE.
+    :param polygons: Explicit polygons; they take precedence over roi.
+    :return: (mode, polygons) with mode "off", "auto" or "polygons".
+    """
+    if polygons:
+        return "polygons", polygons
+    roi = roi or ROI_MODE
+    if roi in ("off", "auto"):
+        return roi, None
+    config = load_roi_config()
+    if roi not in config:
+        raise ValueError(f"Unknown ROI camera '{roi}', {ROI_CONFIG} has: {sorted(config)}")
+    return "polygons", config[roi]
+
+
+def make_roi_detector(frame_size, roi: str = None, polygons=None, scene=None):
+    """:return: ROIDetector for the job's ROI settings (see resolve_roi), or None for full-frame inference."""
+    mode, polygons = resolve_roi(roi, polygons)
+    if mode == "off":
+        return None
+    if mode == "auto" and scene is None:
+        print("⚠️ ROI auto mode needs the scene layout cache (SCENE_LAYOUT_CACHE=1), using full frames")
+        return None
+    return ROIDetector(frame_size, mode, polygons, scene)
+
+
+def _ceil32(value: int) -> int:
+    return int(np.ceil(value / 32) * 32)
+
+
+def _merge_rects(rects):
+    """Merges overlapping (x1, y1, x2, y2) rectangles until none overlap."""
+    rects = [list(rect) for rect in rects]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
+def nms_merge(detections: FrameDetections, iou_threshold: float = ROI_NMS_IOU) -> FrameDetections:
+    """Class-wise greedy NMS; removes duplicates of objects seen by two overlapping zones."""
+    if len(detections) < 2:
+        return detections
+    order = np.argsort(-detections.conf)
+    iou = box_iou(detections.xyxy[order], detections.xyxy[order])
+    same_class = detections.cls[order][:, None] == detections.cls[order][None, :]
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        suppressed[i + 1:] |= (iou[i, i + 1:] >= iou_threshold) & same_class[i, i + 1:]
+    return detections.select(np.sort(order[~suppressed]))
+
+
+class ROIDetector:
+    """
+    Runs the detector only on regions of interest of each frame.
+
+    Regions are either configured polygons (their bounding rectangles, pixels outside the polygon filled)
+    or, in auto mode, rectangles around the crosswalks, stop lines and traffic lights cached by
+    SceneLayoutCache; until the layout is locked, and when the zones cover most of the frame, whole frames
+    are used. The crops of all frames of a batch go to one inference call at an image size that fits the
+    largest crop, so small objects keep more of their resolution. Boxes are mapped back to full-frame
+    coordinates and merged with NMS where zones overlap.
+    """
+
+    def __init__(self, frame_size, mode: str = "auto", polygons=None, scene=None):
+        if mode not in ("auto", "polygons"):
+            raise ValueError(f"Unknown ROI mode '{mode}', expected 'auto' or 'polygons'")
+        self.width, self.height = frame_size
+        self.mode = mode
+        # Avto rejimda zonalar SceneLayoutCache dan olinadi (track_draw oqimi yangilaydi, bu yerda faqat o'qiladi)
+        self.scene = scene
+        self.frames = 0
+        self.roi_frames = 0
+        self.crops = 0
+        self._regions = None
+        self._regions_key = None
+        if mode == "polygons":
+            self._regions = self._polygon_regions(polygons)
+
+    def _polygon_regions(self, polygons):
+        regions = []
+        for polygon in polygons:
+            points = np.asarray(polygon, dtype=np.float32).reshape(-1, 2)
+            x1, y1 = np.floor(points.min(axis=0)).astype(int)
+            x2, y2 = np.ceil(points.max(axis=0)).astype(int)
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(self.width, x2), min(self.height, y2)
+            if x2 <= x1 or y2 <= y1:
+                continue
+            mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+            cv2.fillPoly(mask, [np.round(points - (x1, y1)).astype(np.int32)], 1)
+            regions.append((x1, y1, x2, y2, mask.astype(bool)))
+        return regions
+
+    def _auto_regions(self):
+        if self.scene is None or not self.scene.locked:
+            return None
+        # Joylashuv qayta qulflanganda zonalar qayta hisoblanadi
+        key = (self.scene.locks, len(self.scene.layout_ids))
+        if key == self._regions_key:
+            return self._regions
+        layout = self.scene.layout
+        is_light = np.isin(layout.cls, self.scene.light_cls)
+        margin = np.where(is_light, ROI_LIGHT_MARGIN, ROI_AUTO_MARGIN)[:, None]
+        size = np.stack((layout.xyxy[:, 2] - layout.xyxy[:, 0], layout.xyxy[:, 3] - layout.xyxy[:, 1]), axis=1)
+        grown = np.concatenate((layout.xyxy[:, :2] - margin * size, layout.xyxy[:, 2:] + margin * size), axis=1)
+        grown = np.clip(grown, 0, [self.width, self.height, self.width, self.height]).round().astype(int)
+        rects = _merge_rects(grown.tolist())
+        area = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in rects)
+        regions = None
+        if rects and area <= ROI_MAX_FRAME_SHARE * self.width * self.height:
+            regions = [(x1, y1, x2, y2, None) for x1, y1, x2, y2 in rects if x2 > x1 and y2 > y1]
+        self._regions, self._regions_key = regions, key
+        return regions
+
+    def regions(self):
+        """:return: [(x1, y1, x2, y2, polygon mask or None)], or None when whole frames should be used."""
+        return self._regions if self.mode == "polygons" else self._auto_regions()
+
+    def detect(self, frames: list, infer, imgsz: int) -> list:
+        """
+        :param frames: BGR frames of one batch.
+        :param infer: infer(images, imgsz) -> ultralytics Results per image (run_batched_inference).
+        :return: FrameDetections per frame, in full-frame coordinates.
+        """
+        if not frames:
+            return []
+        self.frames += len(frames)
+        regions = self.regions()
+        if not regions:
+            return [FrameDetections.from_result(result) for result in infer(frames, imgsz)]
+
+        crops = []
+        for frame in frames:
+            for x1, y1, x2, y2, mask in regions:
+                crop = frame[y1:y2, x1:x2]
+                if mask is not None:
+                    crop = crop.copy()
+                    crop[~mask] = ROI_FILL_VALUE
+                crops.append(crop)
+        # Zonalar kadrdan kichik: eng katta zona sig'adigan o'lchamda (IMGSZ dan oshmasdan) aniqlanadi
+        crop_imgsz = min(imgsz, _ceil32(max(max(x2 - x1, y2 - y1) for x1, y1, x2, y2, _ in regions)))
+        results = iter(infer(crops, crop_imgsz))
+        self.roi_frames += len(frames)
+        self.crops += len(crops)
+
+        frame_detections = []
+        for _ in frames:
+            xyxy, conf, cls = [], [], []
+            for x1, y1, x2, y2, _mask in regions:
+                detections = FrameDetections.from_result(next(results))
+                xyxy.append(detections.xyxy + np.array([x1, y1, x1, y1], dtype=np.float32))
+                conf.append(detections.conf)
+                cls.append(detections.cls)
+            merged = FrameDetections(np.concatenate(xyxy), np.concatenate(conf), np.concatenate(cls))
+            frame_detections.append(nms_merge(merged) if len(regions) > 1 else merged)
+        return frame_detections
+
+    def stats(self) -> dict:
+        regions = self.regions() or []
+        return {"mode": self.mode, "frames": self.frames, "roi_frames": self.roi_frames, "crops": self.crops,
+                "regions": [[int(x1), int(y1), int(x2), int(y2)] for x1, y1, x2, y2, _ in regions]}
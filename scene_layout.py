@@ -0,0 +1,202 @@
+import os
+
+import numpy as np
+
+from detections import FrameDetections, box_iou, resolve_class_ids
+from light_classifier import TRAFFIC_LIGHT_CLASS_NAMES
+from inference_scheduler import SCHEDULER_MAX_INTERVAL_SECONDS
+
+# --- CONFIGURATION ---
+# "1": static scene objects are locked after warm-up and taken out of the tracker; "0": everything is tracked
+SCENE_LAYOUT_CACHE = os.environ.get("SCENE_LAYOUT_CACHE", "1") != "0"
+# Classes whose geometry does not change in fixed-camera footage
+STATIC_CLASS_NAMES = ('crosswalk', 'line')
+# Warm-up: static objects are observed this long (and on at least this many inference frames) before locking
+SCENE_WARMUP_SECONDS = 2.0
+SCENE_WARMUP_MIN_FRAMES = 5
+# An object is stable if it was seen on this share of warm-up frames and every box overlaps its mean box this much
+SCENE_STABLE_PRESENCE = 0.8
+SCENE_STABLE_IOU = 0.8
+# The locked layout is compared with the detections of an inference frame this often
+SCENE_RECHECK_SECONDS = 5.0
+# A cached object matches a detection at this IoU; the layout is dropped when fewer than this share match
+SCENE_MATCH_IOU = 0.5
+SCENE_MATCH_RATIO = 0.75
+# Traffic-light housings are small, so their detections match at a lower IoU
+LIGHT_MATCH_IOU = 0.3
+# A light state is kept this long after its last observation, then the light is treated as not visible.
+# It must outlast the longest gap between detector runs of the adaptive schedule, plus a grace period
+LIGHT_STATE_GRACE_SECONDS = 0.5
+LIGHT_STATE_HOLD_SECONDS = SCHEDULER_MAX_INTERVAL_SECONDS + LIGHT_STATE_GRACE_SECONDS
+
+
+class SceneLayoutCache:
+    """
+    Caches the geometry of static scene objects (crosswalks, stop lines, traffic-light housings).
+
+    While warming up, static objects go through the tracker as before and their tracks are observed.
+    Once they are stable the layout is locked: static detections no longer reach the tracker, the cached
+    boxes are added to the tracked objects of every frame under their warm-up track ids, and only the state
+    of each traffic light is updated: from the detections of inference frames and, with the light
+    classifier, from crops of the housings on every frame. Every SCENE_RECHECK_SECONDS the layout is
+    compared with the detections; if it no longer matches (camera moved) warm-up starts again.
+    """
+
+    def __init__(self, class_names: dict, fps: float, warmup_seconds: float = SCENE_WARMUP_SECONDS,
+                 recheck_seconds: float = SCENE_RECHECK_SECONDS):
+        self.static_cls = np.array(resolve_class_ids(class_names, *STATIC_CLASS_NAMES), dtype=np.int32)
+        self.light_cls = np.array(resolve_class_ids(class_names, *TRAFFIC_LIGHT_CLASS_NAMES), dtype=np.int32)
+        self.layout_cls = np.concatenate((self.static_cls, self.light_cls))
+        self.warmup_frames = max(1, int(warmup_seconds * fps))
+        self.recheck_frames = max(1, int(recheck_seconds * fps))
+        self.light_hold_frames = max(1, int(LIGHT_STATE_HOLD_SECONDS * fps))
+        self.locked = False
+        self.locks = 0
+        self.unlocks = 0
+        # Qulflangan joylashuv: track id lar, qutilar (svetoforlar uchun cls = oxirgi holat) va holat ko'rilgan kadr
+        self.layout_ids = np.empty(0, dtype=np.int64)
+        self.layout = FrameDetections.empty()
+        self._light_seen = np.empty(0, dtype=np.int64)
+        self._next_check = None
+        self._reset_warmup()
+
+    def _reset_warmup(self):
+        self._warmup_start = None
+        self._warmup_observations = 0
+        # track_id -> [(box, conf, cls), ...]
+        self._history = {}
+
+    def _is_light(self, cls):
+        return np.isin(cls, self.light_cls)
+
+    def filter(self, frame_idx: int, detections: FrameDetections) -> FrameDetections:
+        """
+        Takes the detections of an inference frame and returns the ones that should go to the tracker.
+        While locked, static detections are consumed here (recheck, traffic-light states).
+        """
+        if not self.locked:
+            return detections
+        static_mask = np.isin(detections.cls, self.layout_cls)
+        if frame_idx >= self._next_check:
+            self._next_check = frame_idx + self.recheck_frames
+            if not self._layout_matches(detections.select(static_mask)):
+                self._unlock()
+                return detections
+        self._update_lights(frame_idx, detections.select(static_mask & self._is_light(detections.cls)))
+        return detections.select(~static_mask)
+
+    def observe(self, frame_idx: int, track_ids, tracks: FrameDetections):
+        """
+        Takes the tracked objects of an inference frame. While warming up they are recorded; while locked,
+        static tracks still coasting in the tracker are removed (the cached layout replaces them).
+
+        :return: Row mask of the tracked objects to keep.
+        """
+        if not self.locked:
+            self._warm_up(frame_idx, track_ids, tracks)
+        if not self.locked:
+            return np.ones(len(tracks), dtype=bool)
+        return ~np.isin(tracks.cls, self.layout_cls)
+
+    def classify_lights(self, frame_idx: int, frame, classifier):
+        """Updates the state of the cached traffic lights from the frame pixels (LightStateClassifier)."""
+        if not self.locked or not classifier.enabled or (frame is None and classifier.needs_frame):
+            return
+        layout_rows = np.flatnonzero(self._is_light(self.layout.cls))
+        if not len(layout_rows):
+            return
+        cls_ids, confidences = classifier.classify(frame, self.layout.xyxy[layout_rows], frame_idx)
+        # Chiroq yonmayotgan ko'rinsa, detektor holati (yoki oxirgi holat) saqlanadi
+        lit = cls_ids >= 0
+        rows = layout_rows[lit]
+        self.layout.cls[rows] = cls_ids[lit]
+        self.layout.conf[rows] = confidences[lit]
+        self._light_seen[rows] = frame_idx
+
+    def merge(self, frame_idx: int, track_ids, tracks: FrameDetections):
+        """Appends the cached objects (lights only while their state is known) to the given tracks."""
+        if not self.locked or not len(self.layout_ids):
+            return track_ids, tracks
+        visible = ~self._is_light(self.layout.cls) | (frame_idx - self._light_seen <= self.light_hold_frames)
+        layout = self.layout.select(visible)
+        return (np.concatenate((track_ids, self.layout_ids[visible])),
+                FrameDetections(np.concatenate((tracks.xyxy, layout.xyxy)), np.concatenate((tracks.conf, layout.conf)),
+                                np.concatenate((tracks.cls, layout.cls))))
+
+    def _warm_up(self, frame_idx, track_ids, tracks):
+        if self._warmup_start is None:
+            self._warmup_start = frame_idx
+        self._warmup_observations += 1
+        for row in np.flatnonzero(np.isin(tracks.cls, self.layout_cls)).tolist():
+            self._history.setdefault(int(track_ids[row]), []).append(
+                (tracks.xyxy[row], float(tracks.conf[row]), int(tracks.cls[row])))
+        if (frame_idx - self._warmup_start >= self.warmup_frames
+                and self._warmup_observations >= SCENE_WARMUP_MIN_FRAMES):
+            self._try_lock(frame_idx)
+
+    def _try_lock(self, frame_idx):
+        ids, boxes, confs, classes = [], [], [], []
+        for track_id, observations in self._history.items():
+            if len(observations) < SCENE_STABLE_PRESENCE * self._warmup_observations:
+                continue
+            track_boxes = np.stack([box for box, _, _ in observations])
+            mean_box = track_boxes.mean(axis=0)
+            if box_iou(track_boxes, mean_box).min() < SCENE_STABLE_IOU:
+                continue
+            ids.append(track_id)
+            boxes.append(mean_box)
+            # Svetofor holati oxirgi kuzatuvdan olinadi, statik obyektlar uchun o'rtacha ishonch
+            _, last_conf, last_cls = observations[-1]
+            is_light = bool(self._is_light(last_cls))
+            confs.append(last_conf if is_light else float(np.mean([conf for _, conf, _ in observations])))
+            classes.append(last_cls)
+        self._reset_warmup()
+        if not ids:
+            return  # Sahna hali barqaror emas, warm-up qaytadan boshlanadi
+        self.layout_ids = np.array(ids, dtype=np.int64)
+        self.layout = FrameDetections(np.stack(boxes), confs, classes)
+        self._light_seen = np.full(len(ids), frame_idx, dtype=np.int64)
+        self.locked = True
+        self.locks += 1
+        self._next_check = frame_idx + self.recheck_frames
+        print(f"✅ Scene layout locked at frame {frame_idx}: {len(ids)} static object(s)")
+
+    def _unlock(self):
+        self.locked = False
+        self.unlocks += 1
+        self.layout_ids = np.empty(0, dtype=np.int64)
+        self.layout = FrameDetections.empty()
+        self._light_seen = np.empty(0, dtype=np.int64)
+        self._reset_warmup()
+        print("⚠️ Scene layout changed, warming up again")
+
+    def _layout_matches(self, detections: FrameDetections) -> bool:
+        if not len(detections):
+            return False
+        iou = box_iou(self.layout.xyxy, detections.xyxy)
+        # Svetofor holati o'zgarishi mumkin, shuning uchun svetoforlar faqat svetoforlar bilan solishtiriladi
+        layout_light = self._is_light(self.layout.cls)
+        detection_light = self._is_light(detections.cls)
+        same_group = np.where(layout_light[:, None], detection_light[None, :],
+                              self.layout.cls[:, None] == detections.cls[None, :])
+        threshold = np.where(layout_light, LIGHT_MATCH_IOU, SCENE_MATCH_IOU)[:, None]
+        matched = same_group & (iou >= threshold)
+        return (matched.any(axis=1).mean() >= SCENE_MATCH_RATIO
+                and matched.any(axis=0).mean() >= SCENE_MATCH_RATIO)
+
+    def _update_lights(self, frame_idx, lights: FrameDetections):
+        layout_rows = np.flatnonzero(self._is_light(self.layout.cls))
+        if not len(layout_rows) or not len(lights):
+            return
+        iou = box_iou(self.layout.xyxy[layout_rows], lights.xyxy)
+        best = iou.argmax(axis=1)
+        for layout_row, light_row, overlap in zip(layout_rows.tolist(), best.tolist(),
+                                                  iou.max(axis=1).tolist()):
+            if overlap >= LIGHT_MATCH_IOU:
+                self.layout.cls[layout_row] = lights.cls[light_row]
+                self.layout.conf[layout_row] = lights.conf[light_row]
+                self._light_seen[layout_row] = frame_idx
+
+    def stats(self) -> dict:
+        return {"enabled": True, "locked": self.locked, "locks": self.locks, "unlocks": self.unlocks,
+                "static_objects": int(len(self.layout_ids))}
@@ -0,0 +1,470 @@
+import os
+import json
+import queue
+import shutil
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_EXCEPTION, wait
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from infer_and_track_violations import (
+    CONFIDENCE_THRESHOLD, FRAME_SKIP, IMGSZ, BATCH_SIZE, VIOLATION_COLOR, CLIP_DURATION_SECONDS,
+    ViolationAnalyzer, run_batched_inference, prepare_result_dirs, make_class_colors,
+    draw_tracked_box, build_final_result,
+)
+from frame_ring_buffer import ViolationClipRecorder
+from detection_log import open_log_writer, iter_log_entries
+from inference_scheduler import InferenceScheduler, SCHEDULE_LOG_NAME
+from roi_inference import make_roi_detector, resolve_roi
+from inference_backends import get_backend
+from model_pool import load_yolo_model, warm_up_model, default_pool_size, weights_key
+from video_encoder import open_video_writer, concat_videos
+
+# --- CONFIGURATION ---
+# Worker processes used for one segment-parallel analysis (each loads its own model)
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "0")) or default_pool_size()
+# Frames shared by neighbouring segments; the later segment's tracker warms up on them and
+# its track IDs are matched to the earlier segment's IDs there
+SEGMENT_OVERLAP_SECONDS = 2.0
+# Segments shorter than this are not worth a separate process
+SEGMENT_MIN_SECONDS = 30
+# mode="auto" switches to segment-parallel analysis for videos at least this long
+SEGMENT_MODE_MIN_SECONDS = 600
+# Two tracks are the same object if their boxes overlap at least this much on enough overlap frames
+STITCH_IOU_THRESHOLD = 0.5
+STITCH_MIN_COMMON_FRAMES = 3
+# How often (in frames) a worker reports progress
+PROGRESS_EVERY_FRAMES = 25
+
+# (model_path, num_workers, backend) -> (weights_key, executor)
+_executors = {}
+_executors_lock = threading.Lock()
+_manager = None
+
+# Per-process model of a segment worker
+_worker_model = None
+
+
+def video_duration_seconds(video_path: str) -> float:
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return 0.0
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+    total_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0.0
+    cap.release()
+    return total_frames / fps if fps > 0 else 0.0
+
+
+def should_use_segments(video_path: str, mode: str = "auto") -> bool:
+    """Resolves an analysis mode ("single", "segments" or "auto") for a video."""
+    if mode == "segments":
+        return True
+    if mode == "auto":
+        return SEGMENT_WORKERS > 1 and video_duration_seconds(video_path) >= SEGMENT_MODE_MIN_SECONDS
+    return False
+
+
+def plan_segments(total_frames: int, num_segments: int, overlap_frames: int) -> list:
+    """
+    Splits [0, total_frames) into contiguous segments. Every segment except the first starts reading
+    overlap_frames earlier than the range it owns.
+
+    :return: List of dicts with index, start, end (owned range) and read_start.
+    """
+    num_segments = max(1, min(num_segments, total_frames))
+    bounds = np.linspace(0, total_frames, num_segments + 1).astype(int)
+    return [{"index": i, "start": int(bounds[i]), "end": int(bounds[i + 1]),
+             "read_start": max(0, int(bounds[i]) - overlap_frames)}
+            for i in range(num_segments)]
+
+
+def _open_at(video_path: str, frame_idx: int):
+    cap = cv2.VideoCapture(video_path)
+    if frame_idx > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        # Ba'zi konteynerlarda seek kalit kadrga tushadi, qolganini o'qib o'tkazib yuboramiz
+        while 0 <= position < frame_idx and cap.grab():
+            position += 1
+    return cap
+
+
+def _init_segment_worker(model_path: str, backend: str = None):
+    global _worker_model
+    _worker_model = load_yolo_model(model_path, backend)
+    warm_up_model(_worker_model, IMGSZ)
+
+
+def _worker_class_names() -> dict:
+    # Sinf nomlari workerning tayyor modelidan olinadi (eksport qilingan backendlarda ham to'g'ri)
+    return dict(_worker_model.names)
+
+
+def _analyze_segment(video_path: str, segment: dict, progress_queue, stop_event, batch_size: int,
+                     roi: str = "off", roi_polygons=None, log_dir: str = None):
+    """
+    Runs detection and tracking over one segment without drawing. Executed in a worker process.
+    The segment's detection log (overlap frames included) is streamed to log_dir, only its path is returned.
+    """
+    model = _worker_model
+    cap = _open_at(video_path, segment["read_start"])
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+    log_writer = open_log_writer(log_dir, model.names, fps)
+    analyzer = ViolationAnalyzer(model.names, fps, draw=False, min_violation_frame=segment["start"],
+                                 log_writer=log_writer)
+    frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    roi_detector = make_roi_detector(frame_size, roi, roi_polygons, analyzer.scene)
+    scheduler = InferenceScheduler(fps, min_interval=FRAME_SKIP)
+
+    frame_idx = segment["read_start"]
+    reported = 0
+    pending = []
+    pending_inference_count = 0
+
+    def flush():
+        nonlocal reported, pending_inference_count
+        frames = [frame for _, frame, needs_inference in pending if needs_inference]
+        if roi_detector is not None:
+            results = iter(roi_detector.detect(frames, lambda images, size: run_batched_inference(
+                model, images, CONFIDENCE_THRESHOLD, size), IMGSZ))
+        else:
+            results = iter(run_batched_inference(model, frames, CONFIDENCE_THRESHOLD, IMGSZ))
+        # Inference qilinmagan kadrlar treker bo'yicha taxminiy qutilar oladi, tartib saqlanadi.
+        # Kadrlar chizilmaydi, faqat svetofor holatini aniqlash uchun uzatiladi
+        for pending_idx, frame, needs_inference in pending:
+            if needs_inference:
+                analyzer.process_frame(pending_idx, frame, next(results))
+                scheduler.report_tracks(analyzer.dynamic_track_count)
+            else:
+                analyzer.propagate_frame(pending_idx, frame)
+        pending.clear()
+        pending_inference_count = 0
+        owned_done = max(0, frame_idx - segment["start"])
+        if owned_done - reported >= PROGRESS_EVERY_FRAMES:
+            progress_queue.put(owned_done - reported)
+            reported = owned_done
+
+    while frame_idx < segment["end"]:
+        if stop_event.is_set():
+            break
+        ret, frame = cap.read()
+        if not ret:
+            break
+        needs_inference = scheduler.decide(frame_idx, frame)
+        pending.append((frame_idx, frame, needs_inference))
+        if needs_inference:
+            pending_inference_count += 1
+        # Kadrlar xotirada saqlanadi, shuning uchun harakatsiz sahnada kutayotgan kadrlar soni ham cheklanadi
+        if pending_inference_count >= batch_size or len(pending) >= max(PROGRESS_EVERY_FRAMES, batch_size * FRAME_SKIP):
+            flush()
+        frame_idx += 1
+    try:
+        flush()
+    finally:
+        cap.release()
+        log_writer.close()
+
+    progress_queue.put(max(0, frame_idx - segment["start"]) - reported)
+    # Overlap kadrlari qarorlari tashlanadi, har bir kadr faqat o'z segmentida loglanadi
+    schedule = [record for record in scheduler.records if record["frame"] >= segment["start"]]
+    return {"index": segment["index"], "log_path": str(log_writer.path), "violations": analyzer.violations,
+            "schedule": schedule}
+
+
+def _render_segment(video_path: str, segment: dict, log_path: str, id_map: dict, class_names: dict, violations: list,
+                    output_path: str, fps: float, width: int, height: int, violation_dir=None, screenshot_dir=None,
+                    stop_event=None):
+    """
+    Draws stitched tracks on the frames a segment owns and writes them to output_path. The tracks are read
+    from the segment's own log (log_path) frame by frame and get their global IDs from id_map.
+    The segment also records the screenshots and clips of the violations in its frames; for that it decodes
+    the pre-roll frames before the segment and the post-roll frames after it. Stops early once stop_event is set.
+
+    :return: (output_path, {(frame_idx, car_id): (screenshot path, clip path)})
+    """
+    class_colors = make_class_colors(class_names)
+    name_to_id = {name: cls_id for cls_id, name in class_names.items()}
+    # Log kadr tartibida, shuning uchun u kadrlar bilan birga o'qiladi (butun log xotiraga yuklanmaydi)
+    entries = (dict(entry, id=id_map[entry["id"]]) for entry in iter_log_entries(log_path)
+               if segment["start"] <= entry["frame"] < segment["end"])
+    next_entry = next(entries, None)
+    violation_keys = {(info["frame_idx"], info["car_id"]) for info in violations}
+    owned = [info for info in violations if segment["start"] <= info["frame_idx"] < segment["end"]]
+
+    recorder = None
+    read_start, read_end = segment["start"], segment["end"]
+    if owned and violation_dir is not None:
+        recorder = ViolationClipRecorder(violation_dir, screenshot_dir, fps, (width, height), CLIP_DURATION_SECONDS)
+        read_start = max(0, min(read_start, owned[0]["frame_idx"] - recorder.clip_frames))
+        read_end = max(read_end, owned[-1]["frame_idx"] + recorder.clip_frames)
+    violations_by_frame = defaultdict(list)
+    for info in owned:
+        violations_by_frame[info["frame_idx"]].append(info)
+    artifacts = {}
+
+    cap = _open_at(video_path, read_start)
+    # Segmentlar bir xil parametrlar bilan H.264 ga yoziladi, keyin qayta kodlamasdan birlashtiriladi
+    out = open_video_writer(output_path, fps, (width, height))
+    try:
+        for frame_idx in range(read_start, read_end):
+            if stop_event is not None and stop_event.is_set():
+                break
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if recorder is not None:
+                recorder.push(frame_idx, frame)
+                for info in violations_by_frame.get(frame_idx, ()):
+                    key = (info["frame_idx"], info["car_id"])
+                    if key not in artifacts:
+                        artifacts[key] = recorder.add_violation(info)
+            if not segment["start"] <= frame_idx < segment["end"]:
+                continue
+            frame_entries = []
+            while next_entry is not None and next_entry["frame"] <= frame_idx:
+                if next_entry["frame"] == frame_idx:
+                    frame_entries.append(next_entry)
+                next_entry = next(entries, None)
+            for entry in frame_entries:
+                color = class_colors.get(name_to_id.get(entry["class"]), (0, 0, 255))
+                if (frame_idx, entry["id"]) in violation_keys:
+                    color = VIOLATION_COLOR
+                draw_tracked_box(frame, entry["box"], f'{entry["class"]} ID:{entry["id"]} Conf:{entry["conf"]:.2f}',
+                                 color)
+            out.write(frame)
+    finally:
+        cap.release()
+        out.release()
+        if recorder is not None:
+            recorder.close()
+    return output_path, artifacts
+
+
+def _box_iou(a, b) -> float:
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, ix2 - ix1) * max(0, iy2 - iy1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _stitched_entries(log_path, segment: dict, id_map: dict, id_offset: int, keep_from, kept: dict):
+    """
+    Yields the entries of the frames a segment owns with global track IDs; new local IDs are added to id_map.
+    Entries from frame keep_from on (the next segment's overlap) are also collected in kept by frame.
+    """
+    for entry in iter_log_entries(log_path):
+        if entry["frame"] < segment["start"]:
+            continue
+        if entry["id"] not in id_map:
+            id_map[entry["id"]] = id_offset + entry["id"]
+        stitched = dict(entry, id=id_map[entry["id"]])
+        if keep_from is not None and entry["frame"] >= keep_from:
+            kept[entry["frame"]].append(stitched)
+        yield stitched
+
+
+def stitch_segment_tracks(segments: list, segment_results: list, log_writer=None):
+    """
+    Merges the per-segment logs (read from disk one entry at a time) into one log with globally unique
+    track IDs. A track of segment k keeps the ID of the segment k-1 track it overlaps most often (same class,
+    IoU >= STITCH_IOU_THRESHOLD) in the overlap frames; unmatched tracks get new IDs.
+    Only the previous segment's overlap frames are kept in memory.
+
+    :param log_writer: Receives the stitched entries in frame order (None: only the ID maps are built).
+    :return: List of per-segment {local_id: global_id} maps.
+    """
+    results_by_index = {result["index"]: result for result in segment_results}
+    id_maps = []
+    max_global_id = 0
+    previous_by_frame = {}
+
+    for position, segment in enumerate(segments):
+        log_path = results_by_index[segment["index"]]["log_path"]
+        votes = defaultdict(int)
+        for entry in iter_log_entries(log_path):
+            if entry["frame"] >= segment["start"]:
+                break
+            best_id, best_iou = None, STITCH_IOU_THRESHOLD
+            for previous in previous_by_frame.get(entry["frame"], ()):
+                if previous["class"] != entry["class"]:
+                    continue
+                iou = _box_iou(entry["box"], previous["box"])
+                if iou >= best_iou:
+                    best_id, best_iou = previous["id"], iou
+            if best_id is not None:
+                votes[(entry["id"], best_id)] += 1
+
+        id_map = {}
+        used_global_ids = set()
+        for (local_id, global_id), count in sorted(votes.items(), key=lambda item: -item[1]):
+            if count < STITCH_MIN_COMMON_FRAMES or local_id in id_map or global_id in used_global_ids:
+                continue
+            id_map[local_id] = global_id
+            used_global_ids.add(global_id)
+
+        # Yangi treklar uchun ID = oldingi eng katta global ID + lokal ID (birinchi segmentda ID o'zgarmaydi)
+        id_offset = max_global_id
+        previous_by_frame = defaultdict(list)
+        keep_from = segments[position + 1]["read_start"] if position + 1 < len(segments) else None
+        entries = _stitched_entries(log_path, segment, id_map, id_offset, keep_from, previous_by_frame)
+        if log_writer is not None:
+            log_writer.write_entries(entries)
+        else:
+            for _ in entries:
+                pass
+        max_global_id = max([max_global_id, *id_map.values()])
+        id_maps.append(id_map)
+
+    return id_maps
+
+
+def _get_executor(model_path: str, num_workers: int, backend: str = None) -> ProcessPoolExecutor:
+    """
+    Returns the worker pool for these weights and backend. The pool is keyed by the weights hash as well, so
+    weights replaced under the same path get fresh workers and the pool holding the old model is shut down.
+    """
+    global _manager
+    ctx = multiprocessing.get_context("spawn")
+    key = (model_path, num_workers, backend)
+    weights = weights_key(model_path)
+    with _executors_lock:
+        if _manager is None:
+            _manager = ctx.Manager()
+        current = _executors.get(key)
+        if current is not None and current[0] == weights:
+            return current[1]
+        if current is not None:
+            print(f"🔄 Weights changed for {model_path}, restarting segment workers")
+            # Eski workerlar qo'lidagi vazifalarni tugatib, keyin yopiladi
+            current[1].shutdown(wait=False)
+        executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx,
+                                       initializer=_init_segment_worker, initargs=(model_path, backend))
+        _executors[key] = (weights, executor)
+        return executor
+
+
+def _wait_with_progress(futures, progress_queue, progress_callback, total_frames, done_frames=0):
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=0.5, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+        while True:
+            try:
+                done_frames += progress_queue.get_nowait()
+            except queue.Empty:
+                break
+        if progress_callback:
+            progress_callback(min(done_frames, total_frames), total_frames)
+    return [future.result() for future in futures]
+
+
+def analyze_video_in_segments(video_path: str, model_path: str, progress_callback=None, run_id: str = None,
+                              num_workers: int = None, batch_size=None, class_names: dict = None, roi: str = None,
+                              roi_polygons=None, backend: str = None):
+    """
+    Analyses a long video by splitting it into overlapping frame ranges, running detection and tracking
+    for each range in its own worker process, stitching track IDs across segment boundaries and
+    rendering the annotated segments in parallel. Returns the same result dict as
+    analyze_video_for_violations.
+
+    :param num_workers: Worker processes (default SEGMENT_WORKERS).
+    :param class_names: Model class names; taken from a worker's model (on the requested backend) if not given.
+    :param roi: ROI mode or camera id, roi_polygons: explicit ROI polygons (see roi_inference.resolve_roi).
+    :param backend: Inference backend of the worker models (None for INFERENCE_BACKEND).
+    """
+    num_workers = num_workers or SEGMENT_WORKERS
+    # ROI sozlamalari asosiy jarayonda tekshiriladi, workerlarga tayyor poligonlar uzatiladi
+    roi, roi_polygons = resolve_roi(roi, roi_polygons)
+    batch_size = BATCH_SIZE if batch_size in (None, "auto") else max(1, int(batch_size))
+    current_time_str, RESULT_DIR, VIOLATION_DIR, SCREENSHOT_DIR = prepare_result_dirs(run_id)
+    segment_dir = RESULT_DIR / 'segments'
+    segment_dir.mkdir(parents=True, exist_ok=True)
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"❌ Error: Could not open video: {video_path}")
+        return {"violation_detected": False, "error": f"Could not open video: {video_path}"}
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    num_segments = max(1, min(num_workers, int(total_frames // max(1, SEGMENT_MIN_SECONDS * fps))))
+    segments = plan_segments(total_frames, num_segments, int(SEGMENT_OVERLAP_SECONDS * fps))
+    print(f"Splitting {total_frames} frames into {len(segments)} segments across {num_workers} workers")
+
+    backend = get_backend(backend).name
+    executor = _get_executor(model_path, num_workers, backend)
+    if class_names is None:
+        # Asosiy jarayonda alohida model yuklanmaydi
+        class_names = executor.submit(_worker_class_names).result()
+    progress_queue = _manager.Queue()
+    stop_event = _manager.Event()
+
+    try:
+        # Har bir worker o'z logini diskka yozadi; loglar diskdan oqim bilan o'qilib birlashtiriladi
+        futures = [executor.submit(_analyze_segment, video_path, segment, progress_queue, stop_event, batch_size,
+                                   roi, roi_polygons, str(segment_dir / f"log_{segment['index']:04d}"))
+                   for segment in segments]
+        segment_results = _wait_with_progress(futures, progress_queue, progress_callback, total_frames)
+
+        with open_log_writer(RESULT_DIR, class_names, fps) as log_writer:
+            id_maps = stitch_segment_tracks(segments, segment_results, log_writer)
+        track_count = len(set().union(*(id_map.values() for id_map in id_maps)))
+        print(f"✅ Stitched {len(segments)} segments into {track_count} tracks")
+        print(f"✅ Detection log saved to: {log_writer.path} ({log_writer.rows} rows)")
+
+        # Segmentlar qoidabuzarliklari vaqt tartibida yig'iladi, car_id global ID ga o'tkaziladi
+        violations = []
+        for result in sorted(segment_results, key=lambda r: r["index"]):
+            id_map = id_maps[result["index"]]
+            violations.extend(dict(info, car_id=id_map.get(info["car_id"], info["car_id"]))
+                              for info in result["violations"])
+
+        results_by_index = {result["index"]: result for result in segment_results}
+        render_futures = [executor.submit(_render_segment, video_path, segment,
+                                          results_by_index[segment["index"]]["log_path"], id_maps[segment["index"]],
+                                          class_names, violations,
+                                          str(segment_dir / f"segment_{segment['index']:04d}.mp4"),
+                                          fps, width, height, VIOLATION_DIR, SCREENSHOT_DIR, stop_event)
+                          for segment in segments]
+        # Tahlil tugagan, lekin chizish paytida ham bekor qilish tekshiriladi (progress_callback orqali)
+        rendered = _wait_with_progress(render_futures, progress_queue, progress_callback, total_frames,
+                                       done_frames=total_frames)
+        segment_paths = [output_path for output_path, _ in rendered]
+    except BaseException:
+        stop_event.set()
+        raise
+
+    FINAL_ANNOTATED_VIDEO_PATH = concat_videos(segment_paths, RESULT_DIR / 'annotated_video.mp4',
+                                               segment_dir / 'segments.txt')
+    shutil.rmtree(segment_dir, ignore_errors=True)
+    print(f"✅ Final annotated video available at: {FINAL_ANNOTATED_VIDEO_PATH}")
+
+    # Skrinshot va klip qoidabuzarlik kadri tegishli segmentni chizish paytida yozilgan
+    violation_artifacts = {}
+    for _, artifacts in rendered:
+        violation_artifacts.update(artifacts)
+    print(f"✅ {len(violations)} violation(s) detected")
+    final_result = build_final_result(current_time_str, FINAL_ANNOTATED_VIDEO_PATH, violations, violation_artifacts)
+    final_result["detection_log_url"] = f"/results/{current_time_str}/{log_writer.path.name}"
+
+    schedule = [record for result in sorted(segment_results, key=lambda r: r["index"])
+                for record in result["schedule"]]
+    with open(RESULT_DIR / SCHEDULE_LOG_NAME, 'w') as f:
+        for record in schedule:
+            f.write(json.dumps(record) + "\n")
+    inference_frames = sum(1 for record in schedule if record["inferred"])
+    final_result["inference_schedule"] = {"frames": len(schedule), "inference_frames": inference_frames}
+    final_result["inference_schedule_url"] = f"/results/{current_time_str}/{SCHEDULE_LOG_NAME}"
+    final_result["segments"] = len(segments)
+    return final_result
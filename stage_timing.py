@@ -0,0 +1,54 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+class StageTimer:
+    """
+    Collects per-call wall-clock durations of named analysis stages (convert, track, rules, draw, ...).
+    ViolationAnalyzer takes one as `timer`; without it NULL_TIMER is used and nothing is measured.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        """Records a duration measured elsewhere, split evenly over count items (e.g. frames of a batch)."""
+        if count:
+            self.samples[stage].extend([seconds / count] * count)
+
+    def summary(self) -> dict:
+        """:return: {stage: {"count", "total_seconds", "fps", "p50_ms", "p99_ms"}}."""
+        result = {}
+        for stage, samples in self.samples.items():
+            values = np.asarray(samples, dtype=np.float64)
+            total = float(values.sum())
+            result[stage] = {
+                "count": len(values),
+                "total_seconds": round(total, 6),
+                "fps": round(len(values) / total, 2) if total > 0 else None,
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 4),
+                "p99_ms": round(float(np.percentile(values, 99)) * 1000, 4),
+            }
+        return result
+
+
+class _NullTimer:
+    def measure(self, stage: str):
+        return nullcontext()
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        pass
+
+
+NULL_TIMER = _NullTimer()
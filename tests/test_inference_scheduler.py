@@ -0,0 +1,55 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_scheduler import InferenceScheduler  # noqa: E402
+
+FPS = 25
+WIDTH, HEIGHT = 1920, 1080
+
+
+def _noise_bank(rng, size=4):
+    return [rng.normal(0, 4, (HEIGHT, WIDTH, 3)).astype(np.int16) for _ in range(size)]
+
+
+def _frame(noise, car_x=None):
+    frame = np.full((HEIGHT, WIDTH, 3), 90, np.int16)
+    cv2.rectangle(frame, (0, 500), (WIDTH, 800), (60, 60, 60), -1)
+    if car_x is not None:
+        # To'q qizil mashina: kulrang tusda asfaltdan atigi ~20 birlik farq qiladi
+        cv2.rectangle(frame, (car_x, 600), (car_x + 200, 700), (30, 30, 200), -1)
+    return np.clip(frame + noise, 0, 255).astype(np.uint8)
+
+
+def test_slow_moving_car_returns_interval_to_min():
+    noise = _noise_bank(np.random.default_rng(0))
+    scheduler = InferenceScheduler(FPS, min_interval=1, mode="adaptive")
+    frame_idx = 0
+    for _ in range(3 * FPS):
+        scheduler.decide(frame_idx, _frame(noise[frame_idx % len(noise)], car_x=400))
+        frame_idx += 1
+    assert scheduler.interval == scheduler.max_interval
+
+    inferred = []
+    for step in range(150):
+        inferred.append(scheduler.decide(frame_idx, _frame(noise[frame_idx % len(noise)], car_x=400 + 10 * step)))
+        frame_idx += 1
+        if step == 5:
+            assert scheduler.interval == scheduler.min_interval
+    # 10 px/kadr tezlikdagi mashina deyarli har kadrda inference qilinadi
+    assert sum(inferred) >= 0.5 * len(inferred)
+    scheduler.close()
+
+
+def test_static_scene_backs_off_to_max_interval():
+    noise = _noise_bank(np.random.default_rng(1))
+    scheduler = InferenceScheduler(FPS, min_interval=1, mode="adaptive")
+    for frame_idx in range(4 * FPS):
+        scheduler.decide(frame_idx, _frame(noise[frame_idx % len(noise)]))
+    assert scheduler.interval == scheduler.max_interval
+    assert scheduler.inference_frames <= 10
+    scheduler.close()
@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# --- CONFIGURATION ---
+# The project root is one level above this script (utils/)
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(PROJECT_ROOT))
+
+import infer_and_track_violations as itv  # noqa: E402
+from detection_log import open_log_writer  # noqa: E402
+from stage_timing import StageTimer  # noqa: E402
+from video_encoder import open_video_writer  # noqa: E402
+
+DEFAULT_WEIGHTS = PROJECT_ROOT / 'runs' / 'train' / 'exp_fast_train3' / 'weights' / 'best.pt'
+# Synthetic videos are generated once and reused by later runs
+DEFAULT_VIDEO_DIR = PROJECT_ROOT / 'data' / 'benchmark_videos'
+DEFAULT_RESOLUTIONS = ('640x360', '1280x720', '1920x1080')
+DEFAULT_FRAME_COUNTS = (150, 450)
+DEFAULT_CAR_COUNTS = (2, 10, 30)
+VIDEO_FPS = 25
+# A stage regresses if its frames/sec drops by more than this share of the baseline
+DEFAULT_TOLERANCE = 0.1
+# Stages in pipeline order, as reported in the JSON output
+STAGES = ('decode', 'inference', 'convert', 'track', 'light_state', 'rules', 'draw', 'video_write', 'log_write')
+
+# Classes and colours (BGR) of the synthetic scene; the "color" detector finds objects by these colours
+SYNTHETIC_CLASS_NAMES = {0: 'person', 1: 'car', 2: 'traffic_light_red', 3: 'traffic_light_yellow',
+                         4: 'traffic_light_green', 5: 'crosswalk', 6: 'line'}
+SYNTHETIC_COLORS = {1: (220, 0, 0), 0: (220, 0, 220), 5: (255, 255, 255), 6: (255, 255, 0),
+                    2: (0, 0, 255), 4: (0, 255, 0)}
+COLOR_TOLERANCE = 45
+# Red and green phases of the synthetic traffic light, in frames
+LIGHT_CYCLE_FRAMES = (60, 60)
+
+
+# --- 1. SYNTHETIC VIDEOS ---
+
+def parse_resolution(value: str) -> tuple:
+    width, height = (int(part) for part in value.lower().split('x'))
+    return width, height
+
+
+def render_frame(frame_idx: int, width: int, height: int, cars: np.ndarray) -> np.ndarray:
+    """
+    Draws one frame of the synthetic junction: road, crosswalk, stop line, a traffic light that cycles
+    red/green, cars driving along lanes and pedestrians crossing.
+
+    :param cars: (C, 4) rows of (start x, lane, speed px/frame, length) in units of the frame width.
+    """
+    frame = np.full((height, width, 3), 80, dtype=np.uint8)
+    scale = width / 640
+    road_top, road_bottom = int(0.45 * height), int(0.9 * height)
+    cv2.rectangle(frame, (0, road_top), (width, road_bottom), (60, 60, 60), -1)
+    cv2.rectangle(frame, (int(0.47 * width), road_top), (int(0.7 * width), road_bottom),
+                  SYNTHETIC_COLORS[5], -1)
+    cv2.rectangle(frame, (int(0.45 * width), road_top), (int(0.455 * width) + 2, road_bottom),
+                  SYNTHETIC_COLORS[6], -1)
+    red = frame_idx % sum(LIGHT_CYCLE_FRAMES) < LIGHT_CYCLE_FRAMES[0]
+    light = (int(0.875 * width), int(0.05 * height), int(0.875 * width + 20 * scale), int(0.05 * height + 20 * scale))
+    cv2.rectangle(frame, light[:2], light[2:], SYNTHETIC_COLORS[2 if red else 4], -1)
+
+    lane_height = (road_bottom - road_top) / 4
+    car_height = int(0.7 * lane_height)
+    for start, lane, speed, length in cars:
+        x = int(((start + speed * frame_idx) % 1.2 - 0.1) * width)
+        y = int(road_top + lane * lane_height + 0.15 * lane_height)
+        cv2.rectangle(frame, (x, y), (x + int(length * width), y + car_height), SYNTHETIC_COLORS[1], -1)
+    # Piyodalar o'tish joyi bo'ylab yuqoridan pastga yuradi
+    for i in range(max(1, len(cars) // 5)):
+        x = int((0.5 + 0.04 * i) * width)
+        y = int(road_top + ((frame_idx * (1.5 + 0.3 * i) * scale) % (road_bottom - road_top)))
+        cv2.rectangle(frame, (x, y), (x + int(10 * scale), y + int(25 * scale)), SYNTHETIC_COLORS[0], -1)
+    return frame
+
+
+def synthetic_video(video_dir: Path, width: int, height: int, frames: int, cars: int) -> Path:
+    """Generates (or reuses) a deterministic synthetic video for one scenario."""
+    path = video_dir / f"synthetic_{width}x{height}_{frames}f_{cars}c.mp4"
+    if path.exists():
+        return path
+    video_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(cars)
+    car_rows = np.column_stack((rng.uniform(0, 1.2, cars), rng.integers(0, 4, cars),
+                                rng.uniform(0.002, 0.008, cars), rng.uniform(0.05, 0.09, cars)))
+    print(f"🔄 Generating {path.name}...")
+    tmp_path = path.with_suffix('.tmp.mp4')
+    writer = cv2.VideoWriter(str(tmp_path), cv2.VideoWriter_fourcc(*'mp4v'), VIDEO_FPS, (width, height))
+    for frame_idx in range(frames):
+        writer.write(render_frame(frame_idx, width, height, car_rows))
+    writer.release()
+    os.rename(tmp_path, path)
+    return path
+
+
+# --- 2. DETECTORS ---
+
+class ColorDetector:
+    """
+    Detector for synthetic videos that needs no weights: objects are the connected components of the
+    scene colours. It returns ultralytics Results like a YOLO model, so the whole pipeline runs offline.
+    """
+
+    names = SYNTHETIC_CLASS_NAMES
+    ckpt_path = "synthetic-color"
+
+    def _detect(self, image):
+        import torch
+        from ultralytics.engine.results import Results
+
+        boxes = []
+        for cls_id, color in SYNTHETIC_COLORS.items():
+            color = np.array(color)
+            mask = cv2.inRange(image, np.clip(color - COLOR_TOLERANCE, 0, 255), np.clip(color + COLOR_TOLERANCE, 0, 255))
+            count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+            for x, y, w, h, area in stats[1:count]:
+                if area >= 60:
+                    boxes.append([x, y, x + w, y + h, 0.9, cls_id])
+        return Results(image, path="", names=self.names, boxes=torch.tensor(boxes, dtype=torch.float32).reshape(-1, 6))
+
+    def __call__(self, source, **kwargs):
+        return [self._detect(image) for image in (source if isinstance(source, list) else [source])]
+
+
+def load_detector(detector: str, weights: Path, backend: str = None):
+    if detector == "color":
+        return ColorDetector()
+    from model_pool import load_yolo_model
+    return load_yolo_model(str(weights), backend)
+
+
+# --- 3. BENCHMARK ---
+
+def benchmark_stages(video_path: Path, model, batch_size: int, work_dir: Path) -> tuple:
+    """
+    Runs every stage of the analysis sequentially on every frame and times each one separately.
+
+    :return: (StageTimer, {stage: seconds} of closing the video writer and the detection log)
+    """
+    timer = StageTimer()
+    cap = cv2.VideoCapture(str(video_path))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    log_writer = open_log_writer(work_dir, model.names, fps)
+    analyzer = itv.ViolationAnalyzer(model.names, fps, log_writer=log_writer, timer=timer)
+    out = open_video_writer(work_dir / 'annotated_video.mp4', fps, (width, height))
+
+    def flush(batch):
+        start = time.perf_counter()
+        results = itv.run_batched_inference(model, [frame for _, frame in batch], itv.CONFIDENCE_THRESHOLD, itv.IMGSZ)
+        timer.add("inference", time.perf_counter() - start, len(batch))
+        for (frame_idx, frame), result in zip(batch, results):
+            analyzer.process_frame(frame_idx, frame, result)
+            with timer.measure("video_write"):
+                out.write(frame)
+        batch.clear()
+
+    batch = []
+    frame_idx = 0
+    while True:
+        with timer.measure("decode"):
+            ret, frame = cap.read()
+        if not ret:
+            # Oxirgi muvaffaqiyatsiz o'qish decode statistikasiga kirmaydi
+            timer.samples["decode"].pop()
+            break
+        batch.append((frame_idx, frame))
+        frame_idx += 1
+        if len(batch) >= batch_size:
+            flush(batch)
+    flush(batch)
+    cap.release()
+
+    close_seconds = {}
+    for stage, closer in (("video_write", out.release), ("log_write", log_writer.close)):
+        start = time.perf_counter()
+        closer()
+        close_seconds[stage] = round(time.perf_counter() - start, 6)
+    return timer, close_seconds
+
+
+def benchmark_end_to_end(video_path: Path, model, batch_size: int, work_dir: Path) -> dict:
+    """Times analyze_video_for_violations itself (threaded pipeline, inference schedule, clips)."""
+    itv.RESULTS_ROOT = work_dir
+    start = time.perf_counter()
+    result = itv.analyze_video_for_violations(str(video_path), "benchmark", model=model, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    frames = result["inference_schedule"]["frames"]
+    return {"frames": frames, "elapsed_seconds": round(elapsed, 4), "fps": round(frames / elapsed, 2),
+            "inference_frames": result["inference_schedule"]["inference_frames"],
+            "bottleneck": result["pipeline_stats"]["bottleneck"], "violations": result["violation_count"]}
+
+
+def run_scenario(video_path: Path, model, batch_size: int, end_to_end: bool) -> dict:
+    work_dir = Path(tempfile.mkdtemp(prefix="benchmark_"))
+    try:
+        timer, close_seconds = benchmark_stages(video_path, model, batch_size, work_dir)
+        summary = timer.summary()
+        scenario = {"stages": {stage: summary[stage] for stage in STAGES if stage in summary},
+                    "close_seconds": close_seconds}
+        if end_to_end:
+            scenario["end_to_end"] = benchmark_end_to_end(video_path, model, batch_size, work_dir)
+        return scenario
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def environment_meta(args) -> dict:
+    import torch
+    import ultralytics
+
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "cpu_count": os.cpu_count(), "numpy": np.__version__,
+            "opencv": cv2.__version__, "torch": torch.__version__, "ultralytics": ultralytics.__version__,
+            "detector": args.detector, "weights": str(args.weights) if args.detector == "yolo" else None,
+            "backend": args.backend, "batch_size": args.batch_size, "imgsz": itv.IMGSZ}
+
+
+# --- 4. BASELINE COMPARISON ---
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: Regressions: one row per scenario stage whose frames/sec fell more than `tolerance`
+             below the baseline. Scenarios or stages missing from either report are skipped.
+    """
+    baseline_scenarios = {scenario["name"]: scenario for scenario in baseline.get("scenarios", [])}
+    regressions = []
+    print(f"\n{'scenario':<34}{'stage':<14}{'baseline':>10}{'current':>10}{'change':>9}")
+    for scenario in report["scenarios"]:
+        reference = baseline_scenarios.get(scenario["name"])
+        if reference is None:
+            continue
+        rows = [(stage, reference["stages"][stage]["fps"], stats["fps"]) for stage, stats in scenario["stages"].items()
+                if stage in reference["stages"]]
+        if "end_to_end" in scenario and "end_to_end" in reference:
+            rows.append(("end_to_end", reference["end_to_end"]["fps"], scenario["end_to_end"]["fps"]))
+        for stage, baseline_fps, current_fps in rows:
+            if not baseline_fps or current_fps is None:
+                continue
+            change = current_fps / baseline_fps - 1
+            regressed = change < -tolerance
+            print(f"{scenario['name']:<34}{stage:<14}{baseline_fps:>10.1f}{current_fps:>10.1f}{change:>+9.1%}"
+                  f"{'  ❌' if regressed else ''}")
+            if regressed:
+                regressions.append({"scenario": scenario["name"], "stage": stage, "baseline_fps": baseline_fps,
+                                    "fps": current_fps, "change": round(change, 4)})
+    return regressions
+
+
+def print_scenario(scenario: dict):
+    print(f"\n⏱️ {scenario['name']} ({scenario['frames']} frames)")
+    print(f"   {'stage':<14}{'fps':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for stage, stats in scenario["stages"].items():
+        print(f"   {stage:<14}{stats['fps'] or 0:>10.1f}{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}")
+    if "end_to_end" in scenario:
+        print(f"   {'end_to_end':<14}{scenario['end_to_end']['fps']:>10.1f}")
+
+
+# --- 5. MAIN ---
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage microbenchmark of the violation analysis pipeline "
+                                                 "on synthetic videos")
+    parser.add_argument("--resolutions", default=",".join(DEFAULT_RESOLUTIONS), help="e.g. 640x360,1920x1080")
+    parser.add_argument("--frames", default=",".join(map(str, DEFAULT_FRAME_COUNTS)), help="Video lengths in frames")
+    parser.add_argument("--cars", default=",".join(map(str, DEFAULT_CAR_COUNTS)), help="Cars per scene")
+    parser.add_argument("--detector", choices=("yolo", "color"), default="yolo",
+                        help="yolo: the trained weights; color: weight-free colour detector for synthetic scenes")
+    parser.add_argument("--weights", type=Path, default=DEFAULT_WEIGHTS)
+    parser.add_argument("--backend", default=None, help="Inference backend (default: INFERENCE_BACKEND)")
+    parser.add_argument("--batch-size", type=int, default=itv.BATCH_SIZE)
+    parser.add_argument("--video-dir", type=Path, default=DEFAULT_VIDEO_DIR)
+    parser.add_argument("--end-to-end", action="store_true", help="Also time analyze_video_for_violations")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path, help="Earlier JSON output to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed frames/sec drop against the baseline (share, 0.1 = 10%%)")
+    args = parser.parse_args()
+
+    if args.detector == "yolo" and not args.weights.exists():
+        print(f"❌ Error: Weights not found: {args.weights} (use --detector color for a weight-free run)")
+        sys.exit(1)
+    model = load_detector(args.detector, args.weights, args.backend)
+    # Birinchi chaqiruv (model yuklash, eksport) o'lchovga kirmasligi uchun isitish
+    itv.run_batched_inference(model, [np.zeros((360, 640, 3), dtype=np.uint8)] * args.batch_size)
+
+    report = {"meta": environment_meta(args), "scenarios": []}
+    for resolution in args.resolutions.split(','):
+        width, height = parse_resolution(resolution)
+        for frames in (int(value) for value in args.frames.split(',')):
+            for cars in (int(value) for value in args.cars.split(',')):
+                video_path = synthetic_video(args.video_dir, width, height, frames, cars)
+                scenario = {"name": f"{width}x{height}_{frames}f_{cars}c", "width": width, "height": height,
+                            "frames": frames, "cars": cars}
+                scenario.update(run_scenario(video_path, model, args.batch_size, args.end_to_end))
+                report["scenarios"].append(scenario)
+                print_scenario(scenario)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Benchmark results saved to: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+        print(f"\n✅ No stage is slower than the baseline by more than {args.tolerance:.0%}")
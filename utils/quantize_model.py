@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+import yaml
+
+# --- CONFIGURATION ---
+# The project root is one level above this script (utils/)
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(PROJECT_ROOT))
+
+from inference_backends import BACKENDS, export_dir_for  # noqa: E402
+from model_pool import weights_key  # noqa: E402
+
+DEFAULT_WEIGHTS = PROJECT_ROOT / 'runs' / 'train' / 'exp_fast_train3' / 'weights' / 'best.pt'
+DEFAULT_DATA_YAML = PROJECT_ROOT / 'data.yaml'
+# Calibration images sampled from the train and valid splits of data.yaml
+CALIBRATION_IMAGES = 300
+CALIBRATION_SPLITS = ('train', 'val')
+IMGSZ = 640
+# Largest allowed per-class mAP50-95 drop (absolute) of the INT8 model against FP32 on the test split
+MAX_CLASS_MAP_DROP = 0.02
+# Stricter limits for the classes the violation rules depend on
+CRITICAL_CLASS_MAP_DROP = {'traffic_light_red': 0.01, 'crosswalk': 0.01}
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+REPORT_NAME = 'quantization_report.json'
+
+
+# --- 1. CALIBRATION DATA ---
+
+def load_data_yaml(data_yaml: Path) -> dict:
+    with open(data_yaml) as f:
+        data = yaml.safe_load(f)
+    # Nisbiy yo'llar data.yaml joylashgan katalogga nisbatan hisoblanadi
+    base = Path(data.get('path', data_yaml.parent))
+    for split in ('train', 'val', 'test'):
+        if data.get(split) and not Path(data[split]).is_absolute():
+            data[split] = str(base / data[split])
+    return data
+
+
+def list_split_images(data: dict, split: str) -> list:
+    """Image paths of one split; the split is a directory of images or a .txt list of image paths."""
+    split_path = data.get(split)
+    if not split_path:
+        return []
+    split_path = Path(split_path)
+    if split_path.suffix == '.txt':
+        with open(split_path) as f:
+            return [Path(line.strip()) for line in f if line.strip()]
+    return sorted(p for p in split_path.rglob('*') if p.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def sample_calibration_images(data: dict, count: int = CALIBRATION_IMAGES, seed: int = 0) -> list:
+    images = [path for split in CALIBRATION_SPLITS for path in list_split_images(data, split)]
+    if not images:
+        raise FileNotFoundError(f"No calibration images found in splits {CALIBRATION_SPLITS} of data.yaml")
+    random.Random(seed).shuffle(images)
+    return images[:count]
+
+
+def preprocess_image(image_path: Path, imgsz: int = IMGSZ) -> np.ndarray:
+    """
+    Prepares an image exactly like the ultralytics predictor does for exported models:
+    square letterbox, BGR -> RGB, CHW, float32 in [0, 1].
+
+    :return: (1, 3, imgsz, imgsz) array.
+    """
+    from ultralytics.data.augment import LetterBox
+
+    image = cv2.imread(str(image_path))
+    if image is None:
+        raise ValueError(f"Could not read image: {image_path}")
+    image = LetterBox((imgsz, imgsz), auto=False)(image=image)
+    image = image[..., ::-1].transpose(2, 0, 1)
+    return np.ascontiguousarray(image, dtype=np.float32)[None] / 255.0
+
+
+# --- 2. QUANTIZATION ---
+
+def quantize_onnx(fp32_path: Path, output_path: Path, images: list, imgsz: int = IMGSZ):
+    """Static INT8 quantization (QDQ, per-channel weights) with ONNX Runtime, calibrated on the images."""
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    input_name = onnx.load(str(fp32_path), load_external_data=False).graph.input[0].name
+
+    class ImageCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self._images = iter(images)
+
+        def get_next(self):
+            image_path = next(self._images, None)
+            return None if image_path is None else {input_name: preprocess_image(image_path, imgsz)}
+
+    quantize_static(str(fp32_path), str(output_path), ImageCalibrationReader(), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    # ultralytics modelni metadata (names, stride, imgsz) bo'yicha yuklaydi, ular FP32 modeldan ko'chiriladi
+    fp32_model = onnx.load(str(fp32_path))
+    int8_model = onnx.load(str(output_path))
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, str(output_path))
+
+
+def quantize_openvino(fp32_dir: Path, output_dir: Path, images: list, imgsz: int = IMGSZ):
+    """Post-training INT8 quantization of the OpenVINO model with NNCF, calibrated on the images."""
+    import nncf
+    import openvino.runtime as ov
+
+    xml_path = next(fp32_dir.glob('*.xml'))
+    model = ov.Core().read_model(str(xml_path))
+    dataset = nncf.Dataset(images, lambda image_path: preprocess_image(image_path, imgsz))
+    quantized = nncf.quantize(model, dataset, preset=nncf.QuantizationPreset.MIXED, subset_size=len(images))
+    output_dir.mkdir(parents=True, exist_ok=True)
+    ov.serialize(quantized, str(output_dir / xml_path.name))
+    shutil.copy2(fp32_dir / 'metadata.yaml', output_dir / 'metadata.yaml')
+
+
+# --- 3. ACCURACY GATE ---
+
+def evaluate(model_path: Path, data_yaml: Path, imgsz: int = IMGSZ, split: str = 'test') -> dict:
+    """:return: {"map50_95": overall, "classes": {class name: {"map50_95", "map50"}}} on the split."""
+    from ultralytics import YOLO
+
+    model = YOLO(str(model_path), task='detect')
+    metrics = model.val(data=str(data_yaml), split=split, imgsz=imgsz, batch=1, plots=False, verbose=False)
+    names = metrics.names
+    classes = {names[int(cls_id)]: {"map50_95": float(metrics.box.ap[i]), "map50": float(metrics.box.ap50[i])}
+               for i, cls_id in enumerate(metrics.ap_class_index)}
+    return {"map50_95": float(metrics.box.map), "classes": classes}
+
+
+def check_class_drops(fp32: dict, int8: dict) -> tuple:
+    """
+    Compares per-class mAP50-95 of the two models.
+
+    :return: (passed, rows) where each row describes one class and whether it is within its limit.
+    """
+    rows = []
+    passed = True
+    for name, fp32_class in sorted(fp32["classes"].items()):
+        limit = CRITICAL_CLASS_MAP_DROP.get(name, MAX_CLASS_MAP_DROP)
+        int8_map = int8["classes"].get(name, {}).get("map50_95", 0.0)
+        drop = fp32_class["map50_95"] - int8_map
+        ok = drop <= limit
+        passed &= ok
+        rows.append({"class": name, "fp32": fp32_class["map50_95"], "int8": int8_map, "drop": drop,
+                     "limit": limit, "ok": ok})
+    # Qoidalar uchun muhim sinflar uchun test to'plamida mAP bo'lmasa, pasayishni tekshirib bo'lmaydi
+    for name in CRITICAL_CLASS_MAP_DROP:
+        if name not in fp32["classes"]:
+            passed = False
+            rows.append({"class": name, "fp32": None, "int8": None, "drop": None,
+                         "limit": CRITICAL_CLASS_MAP_DROP[name], "ok": False})
+    return passed, rows
+
+
+def print_report(rows: list):
+    print(f"\n{'class':<22}{'FP32':>8}{'INT8':>8}{'drop':>8}{'limit':>8}")
+    for row in rows:
+        if row["fp32"] is None:
+            print(f"{row['class']:<22}{'no FP32 mAP on test split':>32}  ❌")
+            continue
+        print(f"{row['class']:<22}{row['fp32']:>8.3f}{row['int8']:>8.3f}{row['drop']:>8.3f}{row['limit']:>8.3f}  "
+              f"{'✅' if row['ok'] else '❌'}")
+
+
+# --- 4. MAIN ---
+
+def quantize_model(weights: Path, data_yaml: Path, backend_name: str, calibration_images: int = CALIBRATION_IMAGES,
+                   imgsz: int = IMGSZ, force: bool = False) -> bool:
+    """
+    Exports, quantizes, evaluates and (if the accuracy gate passes) publishes the INT8 model so that
+    the analysis service can load it with INFERENCE_BACKEND=<backend>_int8.
+
+    :return: True if the INT8 model was published.
+    """
+    fp32_backend = BACKENDS[backend_name]
+    int8_backend = BACKENDS[f"{backend_name}_int8"]
+    _, weights_hash = weights_key(weights)
+    data = load_data_yaml(data_yaml)
+
+    print(f"🚀 Exporting FP32 {backend_name} model...")
+    fp32_path = fp32_backend.export(weights, weights_hash, imgsz)
+
+    images = sample_calibration_images(data, calibration_images)
+    print(f"🔄 Calibrating INT8 on {len(images)} images from {', '.join(CALIBRATION_SPLITS)}...")
+    publish_dir = export_dir_for(weights, weights_hash, int8_backend.name)
+    tmp_dir = publish_dir.with_name(f"{int8_backend.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    int8_path = int8_backend.exported_path(tmp_dir)
+    if backend_name == "onnx":
+        quantize_onnx(fp32_path, int8_path, images, imgsz)
+    else:
+        quantize_openvino(fp32_path, int8_path, images, imgsz)
+
+    print("🔄 Evaluating FP32 and INT8 models on the test split...")
+    fp32_metrics = evaluate(fp32_path, data_yaml, imgsz)
+    int8_metrics = evaluate(int8_path, data_yaml, imgsz)
+    passed, rows = check_class_drops(fp32_metrics, int8_metrics)
+    print_report(rows)
+    print(f"\nOverall mAP50-95: FP32 {fp32_metrics['map50_95']:.3f}, INT8 {int8_metrics['map50_95']:.3f}")
+
+    report = {"weights": str(weights), "weights_hash": weights_hash, "backend": int8_backend.name,
+              "calibration_images": len(images), "imgsz": imgsz, "passed": passed, "forced": force and not passed,
+              "fp32": fp32_metrics, "int8": int8_metrics, "classes": rows}
+    report_path = publish_dir.parent / f"{int8_backend.name}_{REPORT_NAME}"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"ℹ️ Report saved to: {report_path}")
+
+    if not passed and not force:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        print("❌ Per-class mAP drop is over the limit, the INT8 model is NOT published.")
+        return False
+    # Avvalgi nashr qilingan model yangisi bilan almashtiriladi
+    shutil.rmtree(publish_dir, ignore_errors=True)
+    os.rename(tmp_dir, publish_dir)
+    print(f"✅ INT8 model published: {int8_backend.exported_path(publish_dir)}")
+    print(f"   Use it with INFERENCE_BACKEND={int8_backend.name} or \"backend\": \"{int8_backend.name}\" in the request.")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization with a per-class mAP gate")
+    parser.add_argument("--weights", type=Path, default=DEFAULT_WEIGHTS, help="FP32 .pt weights")
+    parser.add_argument("--data", type=Path, default=DEFAULT_DATA_YAML, help="data.yaml with train/val/test splits")
+    parser.add_argument("--backend", choices=("onnx", "openvino"), default="openvino")
+    parser.add_argument("--calibration-images", type=int, default=CALIBRATION_IMAGES)
+    parser.add_argument("--imgsz", type=int, default=IMGSZ)
+    parser.add_argument("--force", action="store_true", help="Publish even if the accuracy gate fails")
+    args = parser.parse_args()
+
+    if not args.weights.exists():
+        print(f"❌ Error: Weights not found: {args.weights}")
+        sys.exit(1)
+    published = quantize_model(args.weights, args.data, args.backend, args.calibration_images, args.imgsz,
+                               args.force)
+    sys.exit(0 if published else 2)
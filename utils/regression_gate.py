@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import numpy as np
+
+# --- CONFIGURATION ---
+# The project root is one level above this script (utils/)
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(PROJECT_ROOT))
+
+from detections import box_iou  # noqa: E402
+from model_pool import weights_key  # noqa: E402
+
+DEFAULT_WEIGHTS = PROJECT_ROOT / 'runs' / 'train' / 'exp_fast_train3' / 'weights' / 'best.pt'
+# Fixed local test clips (every .mp4 in the directory) and their golden outputs (<clip name>.json)
+DEFAULT_CLIPS_DIR = PROJECT_ROOT / 'data' / 'regression' / 'clips'
+DEFAULT_GOLDEN_DIR = PROJECT_ROOT / 'data' / 'regression' / 'golden'
+# The gate fails if a clip's frames/sec drops by more than this share of the golden run
+MAX_THROUGHPUT_DROP = 0.1
+# Equivalence tolerances against the golden outputs
+DETECTION_MATCH_IOU = 0.5  # same class and at least this IoU in the same frame
+MIN_DETECTION_MATCH = 0.95  # share of golden rows found (recall) and of current rows expected (precision)
+MIN_TRACK_ID_CONSISTENCY = 0.95  # share of matched rows whose track id maps to the same golden track id
+VIOLATION_FRAME_TOLERANCE = 5  # a violation may move by this many frames
+# Settings that change the outputs; they are stored in the golden file so differences are visible
+RECORDED_ENV = ('INFERENCE_BACKEND', 'INFERENCE_SCHEDULE', 'SCENE_LAYOUT_CACHE', 'LIGHT_CLASSIFIER', 'ROI_MODE',
+                'DETECTION_LOG_FORMAT', 'RING_BUFFER_JPEG_QUALITY')
+
+
+# --- 1. RUNNING ONE CLIP ---
+
+def run_clip(clip_path: Path, weights: Path, backend: str = None, batch_size=None) -> dict:
+    """
+    Runs analyze_video_for_violations on one clip and collects its outputs and performance.
+    Called in a separate process (see measure_clip), so peak RSS belongs to this clip only.
+    """
+    import infer_and_track_violations as itv
+    from detection_log import find_detection_log, iter_log_entries
+    from model_pool import load_yolo_model
+
+    work_dir = Path(tempfile.mkdtemp(prefix="regression_"))
+    itv.RESULTS_ROOT = work_dir
+    try:
+        model = load_yolo_model(str(weights), backend)
+        start = time.perf_counter()
+        result = itv.analyze_video_for_violations(str(clip_path), str(weights), model=model, batch_size=batch_size)
+        wall = time.perf_counter() - start
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        log_path = find_detection_log(work_dir / result["detection_log_url"].split("/")[2])
+        detections = [[entry["frame"], entry["id"], entry["class"], *entry["box"]]
+                      for entry in iter_log_entries(log_path)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    frames = result["inference_schedule"]["frames"]
+    return {
+        "clip": clip_path.name,
+        "weights_sha256": weights_key(weights)[1],
+        "backend": backend or os.environ.get("INFERENCE_BACKEND", "torch"),
+        "settings": {name: os.environ[name] for name in RECORDED_ENV if name in os.environ},
+        "performance": {"frames": frames, "wall_seconds": round(wall, 4), "fps": round(frames / wall, 2),
+                        # Linuxda ru_maxrss kilobaytlarda
+                        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        "violations": [{"rule": v["rule"], "frame_idx": v["frame_idx"], "car_id": v["car_id"]}
+                       for v in result["violations"]],
+        "detections": detections,
+    }
+
+
+def measure_clip(clip_path: Path, weights: Path, backend: str = None, batch_size=None) -> dict:
+    """Runs run_clip in a fresh Python process and returns its output."""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        output_path = Path(f.name)
+    try:
+        command = [sys.executable, __file__, "--worker", str(clip_path), "--weights", str(weights),
+                   "--output", str(output_path)]
+        if backend:
+            command += ["--backend", backend]
+        if batch_size:
+            command += ["--batch-size", str(batch_size)]
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(output_path) as f:
+            return json.load(f)
+    finally:
+        output_path.unlink(missing_ok=True)
+
+
+# --- 2. COMPARISON WITH GOLDEN OUTPUTS ---
+
+def _rows_by_frame(detections: list) -> dict:
+    frames = defaultdict(list)
+    for frame_idx, track_id, class_name, *box in detections:
+        frames[frame_idx].append((track_id, class_name, box))
+    return frames
+
+
+def match_detections(golden: list, current: list) -> tuple:
+    """
+    Greedily matches detections of the same frame and class by IoU.
+
+    :return: (matched (golden track id, current track id) pairs, golden row count, current row count)
+    """
+    golden_frames, current_frames = _rows_by_frame(golden), _rows_by_frame(current)
+    pairs = []
+    for frame_idx, golden_rows in golden_frames.items():
+        current_rows = current_frames.get(frame_idx, [])
+        if not current_rows:
+            continue
+        iou = box_iou(np.array([box for _, _, box in golden_rows], dtype=np.float32),
+                      np.array([box for _, _, box in current_rows], dtype=np.float32))
+        same_class = np.array([[g[1] == c[1] for c in current_rows] for g in golden_rows])
+        iou[~same_class | (iou < DETECTION_MATCH_IOU)] = 0
+        # Eng katta IoU dan boshlab har bir qator faqat bir marta juftlanadi
+        while iou.size and iou.max() > 0:
+            g, c = np.unravel_index(np.argmax(iou), iou.shape)
+            pairs.append((golden_rows[g][0], current_rows[c][0]))
+            iou[g, :] = 0
+            iou[:, c] = 0
+    return pairs, len(golden), len(current)
+
+
+def compare_outputs(golden: dict, current: dict) -> list:
+    """:return: Failure messages; empty when the current run is equivalent to the golden run."""
+    failures = []
+    pairs, golden_rows, current_rows = match_detections(golden["detections"], current["detections"])
+    recall = len(pairs) / golden_rows if golden_rows else 1.0
+    precision = len(pairs) / current_rows if current_rows else 1.0
+    if recall < MIN_DETECTION_MATCH or precision < MIN_DETECTION_MATCH:
+        failures.append(f"detections: recall {recall:.3f}, precision {precision:.3f} "
+                        f"(minimum {MIN_DETECTION_MATCH}, IoU {DETECTION_MATCH_IOU})")
+
+    # Trek ID lari boshqacha raqamlanishi mumkin: har bir joriy ID ko'pchilik juftliklardagi oltin ID ga bog'lanadi
+    votes = defaultdict(Counter)
+    for golden_id, current_id in pairs:
+        votes[current_id][golden_id] += 1
+    id_map = {current_id: counter.most_common(1)[0][0] for current_id, counter in votes.items()}
+    consistent = sum(counter.most_common(1)[0][1] for counter in votes.values())
+    consistency = consistent / len(pairs) if pairs else 1.0
+    if consistency < MIN_TRACK_ID_CONSISTENCY:
+        failures.append(f"track ids: {consistency:.3f} of matched rows keep their track "
+                        f"(minimum {MIN_TRACK_ID_CONSISTENCY})")
+
+    unmatched = list(current["violations"])
+    for expected in golden["violations"]:
+        match = next((v for v in unmatched if v["rule"] == expected["rule"]
+                      and id_map.get(v["car_id"]) == expected["car_id"]
+                      and abs(v["frame_idx"] - expected["frame_idx"]) <= VIOLATION_FRAME_TOLERANCE), None)
+        if match is None:
+            failures.append(f"missing violation: {expected['rule']} car {expected['car_id']} "
+                            f"at frame {expected['frame_idx']}")
+        else:
+            unmatched.remove(match)
+    for extra in unmatched:
+        failures.append(f"unexpected violation: {extra['rule']} car {extra['car_id']} at frame {extra['frame_idx']}")
+    return failures
+
+
+def compare_performance(golden: dict, current: dict, max_drop: float) -> list:
+    golden_fps, current_fps = golden["performance"]["fps"], current["performance"]["fps"]
+    change = current_fps / golden_fps - 1
+    if change < -max_drop:
+        return [f"throughput: {current_fps:.1f} fps vs golden {golden_fps:.1f} fps ({change:+.1%}, "
+                f"allowed -{max_drop:.0%})"]
+    return []
+
+
+# --- 3. MAIN ---
+
+def run_gate(clips: list, weights: Path, golden_dir: Path, backend: str = None, batch_size=None,
+             max_drop: float = MAX_THROUGHPUT_DROP, update_golden: bool = False) -> bool:
+    """
+    Runs every clip and checks it against its golden output (or, with update_golden, records the outputs
+    as the new golden files).
+
+    :return: True if every clip passed.
+    """
+    weights_hash = weights_key(weights)[1]
+    passed = True
+    print(f"\n{'clip':<28}{'fps':>8}{'golden':>8}{'wall s':>9}{'RSS MB':>9}{'golden':>9}")
+    for clip_path in clips:
+        golden_path = golden_dir / f"{clip_path.stem}.json"
+        current = measure_clip(clip_path, weights, backend, batch_size)
+        performance = current["performance"]
+        if update_golden:
+            golden_dir.mkdir(parents=True, exist_ok=True)
+            with open(golden_path, 'w') as f:
+                json.dump(current, f)
+            print(f"{clip_path.name:<28}{performance['fps']:>8.1f}{'':>8}{performance['wall_seconds']:>9.2f}"
+                  f"{performance['peak_rss_mb']:>9.1f}  ✅ golden saved")
+            continue
+
+        if not golden_path.exists():
+            print(f"{clip_path.name:<28}  ❌ no golden output, run with --update-golden first")
+            passed = False
+            continue
+        with open(golden_path) as f:
+            golden = json.load(f)
+        if golden["weights_sha256"] != weights_hash:
+            print(f"{clip_path.name:<28}  ❌ golden output is for weights {golden['weights_sha256'][:12]}, "
+                  f"current weights are {weights_hash[:12]}")
+            passed = False
+            continue
+        failures = compare_outputs(golden, current) + compare_performance(golden, current, max_drop)
+        reference = golden["performance"]
+        print(f"{clip_path.name:<28}{performance['fps']:>8.1f}{reference['fps']:>8.1f}"
+              f"{performance['wall_seconds']:>9.2f}{performance['peak_rss_mb']:>9.1f}{reference['peak_rss_mb']:>9.1f}"
+              f"  {'❌' if failures else '✅'}")
+        for failure in failures:
+            print(f"    {failure}")
+        passed &= not failures
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end regression gate: golden outputs and throughput "
+                                                 "of analyze_video_for_violations on fixed clips")
+    parser.add_argument("--weights", type=Path, default=DEFAULT_WEIGHTS)
+    parser.add_argument("--backend", default=None, help="Inference backend (default: INFERENCE_BACKEND)")
+    parser.add_argument("--batch-size", default=None, help="Frames per inference call, or 'auto'")
+    parser.add_argument("--clips-dir", type=Path, default=DEFAULT_CLIPS_DIR)
+    parser.add_argument("--golden-dir", type=Path, default=DEFAULT_GOLDEN_DIR)
+    parser.add_argument("--max-throughput-drop", type=float, default=MAX_THROUGHPUT_DROP,
+                        help="Allowed frames/sec drop against the golden run (share, 0.1 = 10%%)")
+    parser.add_argument("--update-golden", action="store_true", help="Record the current outputs as golden")
+    parser.add_argument("--worker", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--output", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        batch_size = args.batch_size if args.batch_size in (None, "auto") else int(args.batch_size)
+        with open(args.output, 'w') as f:
+            json.dump(run_clip(args.worker, args.weights, args.backend, batch_size), f)
+        sys.exit(0)
+
+    if not args.weights.exists():
+        print(f"❌ Error: Weights not found: {args.weights}")
+        sys.exit(1)
+    clips = sorted(args.clips_dir.glob('*.mp4'))
+    if not clips:
+        print(f"❌ Error: No test clips (*.mp4) in {args.clips_dir}")
+        sys.exit(1)
+    print(f"🚀 Regression gate: {len(clips)} clip(s), weights {weights_key(args.weights)[1][:12]}")
+    if run_gate(clips, args.weights, args.golden_dir, args.backend, args.batch_size, args.max_throughput_drop,
+                args.update_golden):
+        print("\n✅ All clips match their golden outputs within tolerances")
+        sys.exit(0)
+    print("\n❌ Regression gate failed")
+    sys.exit(1)
@@ -0,0 +1,50 @@
+import sys
+import json
+import argparse
+from pathlib import Path
+
+# --- CONFIGURATION ---
+# The project root is one level above this script (utils/)
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(PROJECT_ROOT))
+
+from replay_analysis import replay_video_for_violations  # noqa: E402
+
+DEFAULT_WEIGHTS = PROJECT_ROOT / 'runs' / 'train' / 'exp_fast_train3' / 'weights' / 'best.pt'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays tracking and violation rules on the raw detections "
+                                                 "saved by an earlier analysis, without running the detector")
+    parser.add_argument("video", help="Video that was analysed before")
+    parser.add_argument("--weights", type=Path, default=DEFAULT_WEIGHTS,
+                        help="Weights of the analysis (part of the raw detection store key)")
+    parser.add_argument("--backend", default=None, help="Inference backend of the analysis (default: INFERENCE_BACKEND)")
+    parser.add_argument("--roi", default=None, help="ROI of the analysis: off, auto or a camera id (default: ROI_MODE)")
+    parser.add_argument("--store", type=Path, default=None, help="Replay this raw detection store file instead")
+    parser.add_argument("--rules", default=None, help="Comma-separated violation rules (default: VIOLATION_RULES)")
+    parser.add_argument("--render", action="store_true",
+                        help="Decode the video and write the annotated video, screenshots and clips")
+    parser.add_argument("--output", type=Path, help="Save the result JSON here")
+    args = parser.parse_args()
+
+    rule_names = [name.strip() for name in args.rules.split(",") if name.strip()] if args.rules else None
+    result = replay_video_for_violations(args.video, str(args.weights), render=args.render, rule_names=rule_names,
+                                         backend=args.backend, roi=args.roi, store_path=args.store)
+    if "error" in result:
+        print(f"❌ {result['error']}")
+        sys.exit(1)
+
+    for violation in result["violations"]:
+        print(f"  {violation['timestamp']} frame {violation['frame_idx']}: car {violation['car_id']} "
+              f"{violation['violation_type']} ({violation['rule']})")
+    replay = result["replay"]
+    print(f"🚀 {result['violation_count']} violation(s), {replay['frames']} frames replayed at "
+          f"{replay['frames_per_second']:.0f} frames/sec")
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2))
+        print(f"✅ Result saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
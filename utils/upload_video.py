@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import argparse
+import http.client
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# --- CONFIGURATION ---
+DEFAULT_SERVER = "http://localhost:8000"
+# Bytes sent per PATCH request; an interrupted request is resumed from the offset the server has
+REQUEST_BYTES = 64 * 1024 ** 2
+# Read size while a request body is streamed from the file
+READ_BYTES = 1024 ** 2
+MAX_RETRIES = 5
+RETRY_SECONDS = 3
+
+
+class FileRange:
+    """File-like view of [start, start + length) of a file, so http.client streams it without loading it."""
+
+    def __init__(self, f, start: int, length: int):
+        self.f = f
+        self.remaining = length
+        f.seek(start)
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def request(server: str, method: str, path: str, body=None, headers=None):
+    url = urlsplit(server)
+    connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(url.netloc, timeout=300)
+    connection.blocksize = READ_BYTES
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+    finally:
+        connection.close()
+
+
+def upload(server: str, video: Path, upload_id: str = None, analyze: bool = False, mode: str = "auto") -> dict:
+    """Uploads a video in resumable pieces; with upload_id an earlier upload is continued."""
+    size = video.stat().st_size
+    if upload_id is None:
+        status, session = request(server, "POST", "/uploads",
+                                  json.dumps({"filename": video.name, "size": size, "analyze": analyze,
+                                              "mode": mode}), {"Content-Type": "application/json"})
+        if status != 201:
+            raise RuntimeError(f"Could not create the upload ({status}): {session}")
+        print(f"🚀 Upload {session['id']} created (resume with --upload-id {session['id']})")
+    else:
+        status, session = request(server, "GET", f"/uploads/{upload_id}")
+        if status != 200:
+            raise RuntimeError(f"Upload {upload_id} not found ({status})")
+        print(f"🔄 Resuming upload {upload_id} at {session['offset']} bytes")
+
+    retries = 0
+    with open(video, 'rb') as f:
+        while session["status"] == "uploading":
+            offset = session["offset"]
+            length = min(REQUEST_BYTES, size - offset)
+            try:
+                status, body = request(server, "PATCH", f"/uploads/{session['id']}", FileRange(f, offset, length),
+                                       {"Upload-Offset": str(offset), "Content-Length": str(length),
+                                        "Content-Type": "application/offset+octet-stream"})
+            except (OSError, http.client.HTTPException) as e:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise
+                print(f"⚠️ Upload interrupted ({e}), resuming in {RETRY_SECONDS}s")
+                time.sleep(RETRY_SECONDS)
+                status, session = request(server, "GET", f"/uploads/{session['id']}")
+                continue
+            if status == 409:
+                # Server boshqa offset da: o'sha joydan davom etiladi
+                status, session = request(server, "GET", f"/uploads/{session['id']}")
+                continue
+            if status != 200:
+                raise RuntimeError(f"Upload failed ({status}): {body}")
+            session, retries = body, 0
+            sys.stdout.write(f"\rUploaded {session['offset'] / size * 100:.1f}% ({session['offset']}/{size} bytes)")
+            sys.stdout.flush()
+    print()
+    return session
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Uploads a video to the analysis API in resumable pieces")
+    parser.add_argument("video", type=Path)
+    parser.add_argument("--server", default=os.environ.get("DRIVERLENS_SERVER", DEFAULT_SERVER))
+    parser.add_argument("--upload-id", default=None, help="Continue this interrupted upload")
+    parser.add_argument("--analyze", action="store_true", help="Queue the analysis (it may start before the end)")
+    parser.add_argument("--mode", default="auto", help="Analysis mode: auto, single or segments")
+    args = parser.parse_args()
+
+    session = upload(args.server, args.video, args.upload_id, args.analyze, args.mode)
+    print(f"✅ Upload complete: {session['video_path']} (sha256 {session['sha256']}, "
+          f"{session['container']}/{session['codec']})")
+    if session.get("job_id"):
+        print(f"ℹ️ Analysis job {session['job_id']}: {args.server}{session['result_url']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import cv2
+
+# --- CONFIGURATION ---
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+X264_PRESET = "veryfast"
+X264_CRF = 23
+# "1" (default): the annotated video is also written as an HLS playlist of fMP4 segments while frames are
+# encoded (one encode, two outputs), so it can be watched before the analysis finishes; "0": MP4 only
+HLS_OUTPUT = os.environ.get("HLS_OUTPUT", "1") != "0"
+# Target HLS segment length; keyframes are forced at this interval so segments can be cut on time
+HLS_SEGMENT_SECONDS = float(os.environ.get("HLS_SEGMENT_SECONDS", "2"))
+HLS_PLAYLIST_NAME = "index.m3u8"
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which(FFMPEG_BINARY) is not None
+
+
+class FFmpegPipeWriter:
+    """
+    Streams raw BGR frames to an ffmpeg libx264 process over stdin, producing a browser-playable
+    H.264 MP4 (yuv420p, faststart) in a single pass. Has the same write()/release() interface as
+    cv2.VideoWriter.
+
+    With hls_dir, the same encoded stream is also muxed into an HLS event playlist (hls_dir/index.m3u8)
+    whose segments appear while frames are written; the MP4 is only complete after release().
+    """
+
+    def __init__(self, path, fps: float, size: tuple, hls_dir=None):
+        self.path = Path(path)
+        self.size = size
+        self.hls_dir = Path(hls_dir) if hls_dir is not None else None
+        width, height = size
+        command = [
+            FFMPEG_BINARY,
+            '-loglevel', 'error', '-nostats',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}',
+            '-r', f'{fps}',
+            '-i', '-',
+            '-an',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',  # yuv420p juft o'lchamlarni talab qiladi
+            '-c:v', 'libx264',
+            '-preset', X264_PRESET,
+            '-crf', str(X264_CRF),
+            '-pix_fmt', 'yuv420p',
+        ]
+        if self.hls_dir is None:
+            command += ['-movflags', '+faststart', '-y', str(self.path)]
+        else:
+            self.hls_dir.mkdir(parents=True, exist_ok=True)
+            # tee: bitta kodlangan oqim ham MP4 ga, ham HLS segmentlariga yoziladi (ikkinchi kodlash yo'q)
+            hls_options = ':'.join([
+                'f=hls', f'hls_time={HLS_SEGMENT_SECONDS:g}', 'hls_list_size=0', 'hls_playlist_type=event',
+                'hls_segment_type=fmp4', 'hls_flags=independent_segments+temp_file',
+                'hls_fmp4_init_filename=init.mp4', f'hls_segment_filename={self.hls_dir / "segment_%05d.m4s"}',
+            ])
+            command += [
+                '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS:g})',
+                '-flags', '+global_header',
+                '-map', '0:v',
+                '-f', 'tee',
+                f'[f=mp4:movflags=+faststart]{self.path}|[{hls_options}]{self.hls_dir / HLS_PLAYLIST_NAME}',
+            ]
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE)
+        # write() ffmpeg o'lganini (va uning stderr ini) allaqachon xabar qilgan
+        self._failed = False
+
+    def isOpened(self) -> bool:
+        return self._process.poll() is None
+
+    @property
+    def playlist_path(self):
+        return self.hls_dir / HLS_PLAYLIST_NAME if self.hls_dir is not None else None
+
+    def write(self, frame):
+        try:
+            self._process.stdin.write(memoryview(frame))
+        except BrokenPipeError:
+            self._failed = True
+            raise RuntimeError(f"FFmpeg encoder for {self.path} exited: {self._stderr()}") from None
+
+    def _stderr(self) -> str:
+        self._process.wait()
+        return self._process.stderr.read().decode(errors='replace').strip()
+
+    def release(self):
+        if self._process.stdin.closed:
+            return
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._failed:
+            # release() odatda finally ichida chaqiriladi: write() dagi asl xato yashirilmasligi kerak
+            self._process.wait()
+            return
+        stderr = self._stderr()
+        if self._process.returncode != 0:
+            raise RuntimeError(f"FFmpeg encoder for {self.path} failed ({self._process.returncode}): {stderr}")
+
+
+class OpenCVWriter:
+    """Fallback writer when ffmpeg is missing: cv2.VideoWriter with the 'mp4v' codec."""
+
+    playlist_path = None
+
+    def __init__(self, path, fps: float, size: tuple):
+        self.path = Path(path)
+        self.size = size
+        self._writer = cv2.VideoWriter(str(self.path), cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+
+    def isOpened(self) -> bool:
+        return self._writer.isOpened()
+
+    def write(self, frame):
+        self._writer.write(frame)
+
+    def release(self):
+        self._writer.release()
+
+
+def open_video_writer(path, fps: float, size: tuple, prefer_ffmpeg: bool = True, hls_dir=None):
+    """
+    Opens the best available writer for an annotated video or clip.
+
+    :param path: Output .mp4 path.
+    :param fps: Frames per second.
+    :param size: (width, height) of the frames.
+    :param prefer_ffmpeg: Use the ffmpeg pipe when ffmpeg is installed.
+    :param hls_dir: Also write a progressive HLS playlist there (ffmpeg only; ignored by the OpenCV fallback).
+    """
+    if prefer_ffmpeg and ffmpeg_available():
+        return FFmpegPipeWriter(path, fps, size, hls_dir)
+    print(f"⚠️ FFmpeg not found, writing {Path(path).name} with OpenCV 'mp4v' (may not play in browsers).")
+    return OpenCVWriter(path, fps, size)
+
+
+def concat_videos(segment_paths: list, target_path, list_path):
+    """
+    Joins videos with identical encoding parameters. With ffmpeg the streams are copied without
+    re-encoding; without ffmpeg the frames are decoded and written again with OpenCV.
+    """
+    if ffmpeg_available():
+        with open(list_path, 'w') as f:
+            for path in segment_paths:
+                f.write(f"file '{path}'\n")
+        command = [FFMPEG_BINARY, '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', str(list_path),
+                   '-c', 'copy', '-movflags', '+faststart', '-y', str(target_path)]
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return Path(target_path)
+        except subprocess.CalledProcessError as e:
+            print(f"❌ FFmpeg concat failed, joining segments with OpenCV instead: {e.stderr.decode()}")
+
+    out = None
+    for path in segment_paths:
+        cap = cv2.VideoCapture(str(path))
+        if out is None:
+            size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            out = open_video_writer(target_path, cap.get(cv2.CAP_PROP_FPS), size)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            out.write(frame)
+        cap.release()
+    if out is not None:
+        out.release()
+    return Path(target_path)
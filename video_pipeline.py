@@ -0,0 +1,207 @@
+import queue
+import threading
+import time
+
+# --- CONFIGURATION ---
+# Default capacity of the queue in front of every stage (in items, usually frames)
+PIPELINE_QUEUE_SIZE = 8
+# How often (seconds) the stats callback receives a snapshot
+STATS_INTERVAL_SECONDS = 1.0
+
+_END = object()
+
+
+class _PipelineStopped(Exception):
+    """Raised inside a stage thread when another stage has failed."""
+
+
+class StageStats:
+    def __init__(self, name: str, queue_size: int):
+        self.name = name
+        self.queue_size = queue_size
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.wait_input_seconds = 0.0
+        self.wait_output_seconds = 0.0
+        self.occupancy_sum = 0
+        self.occupancy_samples = 0
+        self.max_occupancy = 0
+
+    def sample_occupancy(self, occupancy: int):
+        self.occupancy_sum += occupancy
+        self.occupancy_samples += 1
+        if occupancy > self.max_occupancy:
+            self.max_occupancy = occupancy
+
+    def to_dict(self, current_occupancy: int = None) -> dict:
+        return {
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 4),
+            "wait_input_seconds": round(self.wait_input_seconds, 4),
+            "wait_output_seconds": round(self.wait_output_seconds, 4),
+            "queue_size": self.queue_size,
+            "queue_occupancy": current_occupancy,
+            "mean_queue_occupancy": round(self.occupancy_sum / self.occupancy_samples, 2)
+            if self.occupancy_samples else 0.0,
+            "max_queue_occupancy": self.max_occupancy,
+        }
+
+
+class VideoPipeline:
+    """
+    A linear pipeline with one thread per stage and a bounded queue in front of every stage.
+    Queues are FIFO and every stage has a single thread, so items leave the pipeline in the order
+    the source produced them.
+
+    Stage functions have the signature fn(item, emit); they call emit(x) zero or more times to pass
+    items downstream. An optional flush(emit) is called once after the last item, e.g. to process a
+    partially filled batch.
+    """
+
+    def __init__(self, queue_size: int = PIPELINE_QUEUE_SIZE, stats_callback=None,
+                 stats_interval: float = STATS_INTERVAL_SECONDS):
+        self.queue_size = queue_size
+        self.stats_callback = stats_callback
+        self.stats_interval = stats_interval
+        self._source = None
+        self._stages = []
+        self._stop = threading.Event()
+        self._error = None
+        self._error_lock = threading.Lock()
+        self._started_at = None
+        self._last_stats_at = 0.0
+
+    def set_source(self, name: str, iterable):
+        self._source = (name, iterable, StageStats(name, 0))
+
+    def add_stage(self, name: str, fn, flush=None, queue_size: int = None):
+        size = queue_size or self.queue_size
+        self._stages.append({
+            "name": name,
+            "fn": fn,
+            "flush": flush,
+            "queue": queue.Queue(maxsize=size),
+            "stats": StageStats(name, size),
+        })
+
+    def _fail(self, error):
+        with self._error_lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _put(self, q, item, stats):
+        start = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise _PipelineStopped()
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.wait_output_seconds += time.perf_counter() - start
+
+    def _get(self, q, stats):
+        start = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise _PipelineStopped()
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        stats.wait_input_seconds += time.perf_counter() - start
+        stats.sample_occupancy(q.qsize())
+        return item
+
+    def _make_emit(self, index, stats):
+        if index + 1 >= len(self._stages):
+            return lambda item: None
+        next_queue = self._stages[index + 1]["queue"]
+        return lambda item: self._put(next_queue, item, stats)
+
+    def _run_source(self):
+        name, iterable, stats = self._source
+        emit = self._make_emit(-1, stats)
+        try:
+            iterator = iter(iterable)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats.busy_seconds += time.perf_counter() - start
+                stats.items += 1
+                emit(item)
+            emit(_END)
+        except _PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _run_stage(self, index):
+        stage = self._stages[index]
+        stats = stage["stats"]
+        emit = self._make_emit(index, stats)
+        try:
+            while True:
+                item = self._get(stage["queue"], stats)
+                if item is _END:
+                    if stage["flush"] is not None:
+                        start = time.perf_counter()
+                        stage["flush"](emit)
+                        stats.busy_seconds += time.perf_counter() - start
+                    emit(_END)
+                    return
+                start = time.perf_counter()
+                stage["fn"](item, emit)
+                stats.busy_seconds += time.perf_counter() - start
+                stats.items += 1
+                if index == len(self._stages) - 1:
+                    self._maybe_report()
+        except _PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _maybe_report(self):
+        if self.stats_callback is None:
+            return
+        now = time.perf_counter()
+        if now - self._last_stats_at >= self.stats_interval:
+            self._last_stats_at = now
+            self.stats_callback(self.stats())
+
+    def occupancy(self) -> dict:
+        """Current number of items waiting in front of each stage."""
+        return {stage["name"]: stage["queue"].qsize() for stage in self._stages}
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self._started_at if self._started_at else 0.0
+        stages = {self._source[0]: self._source[2].to_dict()} if self._source else {}
+        for stage in self._stages:
+            stages[stage["name"]] = stage["stats"].to_dict(stage["queue"].qsize())
+        bottleneck = max(stages, key=lambda name: stages[name]["busy_seconds"]) if stages else None
+        return {"elapsed_seconds": round(elapsed, 4), "bottleneck": bottleneck, "stages": stages}
+
+    def run(self) -> dict:
+        """Runs the pipeline to completion. Re-raises the first exception raised by any stage."""
+        if self._source is None:
+            raise ValueError("Pipeline source is not set")
+        self._started_at = time.perf_counter()
+        threads = [threading.Thread(target=self._run_source, name=f"pipeline-{self._source[0]}", daemon=True)]
+        threads += [threading.Thread(target=self._run_stage, args=(i,), name=f"pipeline-{stage['name']}",
+                                     daemon=True) for i, stage in enumerate(self._stages)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        stats = self.stats()
+        if self.stats_callback is not None:
+            self.stats_callback(stats)
+        return stats
@@ -0,0 +1,453 @@
+import os
+import json
+import time
+import uuid
+import struct
+import asyncio
+import hashlib
+import threading
+import subprocess
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from model_pool import prime_file_sha256
+from video_encoder import FFMPEG_BINARY, ffmpeg_available
+
+# --- CONFIGURATION ---
+# Uploaded videos and their session files (<upload id>.json) are stored here
+UPLOAD_ROOT = Path(os.environ.get("UPLOAD_ROOT", "/app/uploads"))
+# The request body is written to disk (and hashed) in pieces of this size; it is the upload's memory bound
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_MB", "1")) * 1024 ** 2
+UPLOAD_MAX_BYTES = int(float(os.environ.get("UPLOAD_MAX_GB", "20")) * 1024 ** 3)
+# The container and codec are checked on the first bytes of the file
+UPLOAD_PROBE_BYTES = 1024 ** 2
+# Analysis of a streamable upload (MP4 with moov first, fragmented MP4, Matroska/WebM, MPEG-TS) may start once
+# this much (and at least the whole MP4 moov box) has arrived
+UPLOAD_EARLY_START_BYTES = int(os.environ.get("UPLOAD_EARLY_START_MB", "16")) * 1024 ** 2
+# Unfinished uploads not touched for this long are deleted
+UPLOAD_EXPIRE_SECONDS = int(os.environ.get("UPLOAD_EXPIRE_HOURS", "24")) * 3600
+# An analysis that reads a growing upload waits this long for new bytes, then fails with UploadIncomplete
+UPLOAD_STALL_TIMEOUT_SECONDS = 300
+UPLOAD_POLL_SECONDS = 0.2
+UPLOAD_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.ts')
+# Codecs OpenCV/FFmpeg decode in this image
+SUPPORTED_CODECS = ('h264', 'hevc', 'mpeg4', 'vp8', 'vp9', 'av1', 'mjpeg')
+PART_SUFFIX = ".part"
+
+UPLOADING, COMPLETE, FAILED = "uploading", "complete", "failed"
+
+# Sample entry fourcc (MP4/MOV stsd) -> codec
+MP4_CODECS = {b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc', b'hev1': 'hevc', b'mp4v': 'mpeg4',
+              b'av01': 'av1', b'vp08': 'vp8', b'vp09': 'vp9', b'jpeg': 'mjpeg', b'mjpa': 'mjpeg'}
+# Matroska CodecID -> codec
+MATROSKA_CODECS = {b'V_MPEG4/ISO/AVC': 'h264', b'V_MPEGH/ISO/HEVC': 'hevc', b'V_MPEG4/ISO/ASP': 'mpeg4',
+                   b'V_VP8': 'vp8', b'V_VP9': 'vp9', b'V_AV1': 'av1', b'V_MJPEG': 'mjpeg'}
+# AVI stream handler fourcc -> codec
+AVI_CODECS = {b'H264': 'h264', b'h264': 'h264', b'X264': 'h264', b'avc1': 'h264', b'HEVC': 'hevc',
+              b'XVID': 'mpeg4', b'xvid': 'mpeg4', b'DIVX': 'mpeg4', b'FMP4': 'mpeg4', b'MJPG': 'mjpeg'}
+MP4_AUDIO_ENTRIES = (b'mp4a', b'ac-3', b'ec-3', b'Opus', b'alac', b'fLaC')
+
+
+class UnsupportedVideo(ValueError):
+    """The uploaded bytes are not a video container/codec the analysis can decode."""
+
+
+class UploadOffsetMismatch(Exception):
+    """A chunk was sent for an offset other than the one the upload continues at."""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Upload continues at offset {offset}")
+        self.offset = offset
+
+
+class UploadTooLarge(Exception):
+    """More bytes were sent than the size declared when the upload was created."""
+
+
+class UploadIncomplete(RuntimeError):
+    """An analysis of a growing upload ran out of bytes because the upload stalled before it was complete."""
+
+
+def _mp4_boxes(data: bytes):
+    """Yields (type, start, end) of the top-level boxes whose header lies in data; end may be past data."""
+    position = 0
+    while position + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[position:position + 8])
+        if size == 1:
+            if position + 16 > len(data):
+                return
+            size = struct.unpack(">Q", data[position + 8:position + 16])[0]
+        elif size == 0:
+            size = float("inf")  # quti fayl oxirigacha davom etadi
+        if size < 8:
+            return
+        yield kind, position, position + size
+        position += size
+
+
+def _mp4_codec(data: bytes):
+    """Codec of the first video sample description (stsd) found in data, or the raw fourcc, or None."""
+    start = data.find(b'stsd')
+    while start >= 0:
+        # 'stsd' + version/flags (4) + entry_count (4) + entry size (4) -> sample entry fourcc
+        fourcc = data[start + 16:start + 20]
+        if len(fourcc) == 4 and fourcc not in MP4_AUDIO_ENTRIES:
+            return MP4_CODECS.get(fourcc, fourcc.decode('latin-1').strip())
+        start = data.find(b'stsd', start + 4)
+    return None
+
+
+def probe_video_header(data: bytes) -> dict:
+    """
+    Identifies the container and video codec from the first bytes of a file, without decoding.
+
+    :return: {"container", "codec" (None until it is found), "streamable", "header_bytes"}: streamable files can
+             be decoded while they are still arriving once header_bytes (the MP4 moov box) are there.
+    :raises UnsupportedVideo: Unknown container, or a codec outside SUPPORTED_CODECS.
+    """
+    info = {"container": None, "codec": None, "streamable": False, "header_bytes": 0}
+    if data[4:8] == b'ftyp':
+        info["container"] = "mp4"
+        info["codec"] = _mp4_codec(data)
+        for kind, start, end in _mp4_boxes(data):
+            # moov mdat dan oldin kelsa (faststart) yoki fragmentlangan MP4 bo'lsa, fayl oqim sifatida o'qiladi
+            if kind == b'moov':
+                info["streamable"], info["header_bytes"] = True, end
+                break
+            if kind == b'moof':
+                info["streamable"], info["header_bytes"] = True, start
+                break
+            if kind == b'mdat':
+                break
+    elif data[:4] == b'\x1a\x45\xdf\xa3':
+        info["container"] = "webm" if b'webm' in data[:64] else "matroska"
+        info["codec"] = next((codec for codec_id, codec in MATROSKA_CODECS.items() if codec_id in data), None)
+        info["streamable"] = True
+    elif data[:4] == b'RIFF' and data[8:12] == b'AVI ':
+        info["container"] = "avi"
+        header = data.find(b'strhvids')
+        if header >= 0:
+            fourcc = data[header + 8:header + 12]
+            info["codec"] = AVI_CODECS.get(fourcc, fourcc.decode('latin-1').strip())
+    elif len(data) >= 188 * 3 and all(data[i] == 0x47 for i in (0, 188, 376)):
+        info["container"] = "mpegts"
+        info["streamable"] = True
+    else:
+        raise UnsupportedVideo("Unknown video container (expected MP4/MOV, Matroska/WebM, AVI or MPEG-TS)")
+    if info["codec"] is not None and info["codec"] not in SUPPORTED_CODECS:
+        raise UnsupportedVideo(f"Unsupported video codec '{info['codec']}', "
+                               f"supported: {', '.join(SUPPORTED_CODECS)}")
+    return info
+
+
+def verify_decodable(path: Path):
+    """:return: Codec fourcc of the first video stream as OpenCV reports it, after one frame was decoded."""
+    cap = cv2.VideoCapture(str(path))
+    try:
+        ok = cap.isOpened() and cap.read()[0]
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    finally:
+        cap.release()
+    if not ok:
+        raise UnsupportedVideo("The uploaded file could not be decoded")
+    return "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip() or None
+
+
+class UploadSession:
+    """One resumable upload: bytes go to <id><ext>.part and the file is renamed to <id><ext> when complete."""
+
+    FIELDS = ("id", "filename", "size", "offset", "status", "error", "sha256", "container", "codec", "streamable",
+              "header_bytes", "analysis", "job_id", "created_at", "updated_at")
+
+    def __init__(self, upload_id: str, filename: str, size: int, analysis: dict = None, root: Path = None):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.offset = 0
+        self.status = UPLOADING
+        self.error = None
+        self.sha256 = None
+        self.container = None
+        self.codec = None
+        self.streamable = False
+        self.header_bytes = 0
+        # Yuklash tugagach (yoki yetarli qism kelganda) boshlanadigan tahlil parametrlari
+        self.analysis = analysis
+        self.job_id = None
+        self.created_at = self.updated_at = time.time()
+        self.root = Path(root or UPLOAD_ROOT)
+        self.lock = asyncio.Lock()
+        self._hasher = None
+
+    @property
+    def path(self) -> Path:
+        return self.root / f"{self.id}{Path(self.filename).suffix.lower()}"
+
+    @property
+    def part_path(self) -> Path:
+        return self.path.with_name(self.path.name + PART_SUFFIX)
+
+    @property
+    def meta_path(self) -> Path:
+        return self.root / f"{self.id}.json"
+
+    @property
+    def probed(self) -> bool:
+        return self.container is not None
+
+    def to_dict(self) -> dict:
+        data = {field: getattr(self, field) for field in self.FIELDS if field != "analysis"}
+        data["video_path"] = str(self.path) if self.status == COMPLETE else None
+        return data
+
+    def save(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        tmp_path = self.meta_path.with_name(f"{self.meta_path.name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.meta_path)
+
+    @classmethod
+    def load(cls, meta_path: Path):
+        with open(meta_path) as f:
+            data = json.load(f)
+        session = cls(data["id"], data["filename"], data["size"], data.get("analysis"), meta_path.parent)
+        for field in cls.FIELDS:
+            setattr(session, field, data.get(field, getattr(session, field)))
+        return session
+
+    def write(self, f, data):
+        """Appends data to the open .part file and to the running SHA-256."""
+        if self._hasher is None:
+            self._rebuild_hash()
+        f.write(data)
+        self._hasher.update(data)
+        self.offset += len(data)
+
+    def _rebuild_hash(self):
+        # Server qayta ishga tushgandan keyin davom ettirilgan yuklash: xesh diskdagi qismdan qayta hisoblanadi
+        self._hasher = hashlib.sha256()
+        with open(self.part_path, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+                self._hasher.update(block)
+
+    def probe(self):
+        with open(self.part_path, 'rb') as f:
+            info = probe_video_header(f.read(UPLOAD_PROBE_BYTES))
+        self.container, self.codec = info["container"], info["codec"]
+        self.streamable, self.header_bytes = info["streamable"], info["header_bytes"]
+
+    def finish(self):
+        """Renames the complete file, records its hash and checks that it decodes."""
+        self.sha256 = self._hasher.hexdigest()
+        os.replace(self.part_path, self.path)
+        # Tahlil va kesh kalitlari videoni qayta o'qib xeshlamaydi
+        prime_file_sha256(self.path, self.sha256)
+        codec = verify_decodable(self.path)
+        if self.codec is None:
+            self.codec = codec
+        self.status = COMPLETE
+
+    @property
+    def early_start_ready(self) -> bool:
+        """Enough of a streamable file has arrived to start decoding it before the upload completes."""
+        return (self.status == UPLOADING and self.streamable and ffmpeg_available()
+                and self.offset >= max(UPLOAD_EARLY_START_BYTES, self.header_bytes))
+
+
+class UploadManager:
+    """Resumable upload sessions; their state survives restarts in UPLOAD_ROOT/<id>.json."""
+
+    def __init__(self, root: Path = None, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.root = Path(root or UPLOAD_ROOT)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._sessions = {}
+        for meta_path in self.root.glob("*.json"):
+            try:
+                session = UploadSession.load(meta_path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️ Upload session {meta_path} is unreadable ({e}), skipping")
+                continue
+            self._sessions[session.id] = session
+        self.expire()
+
+    def create(self, filename: str, size: int, analysis: dict = None) -> UploadSession:
+        """:raises UnsupportedVideo: Unknown file extension. :raises UploadTooLarge: size over max_bytes."""
+        if Path(filename).suffix.lower() not in UPLOAD_EXTENSIONS:
+            raise UnsupportedVideo(f"Unsupported file type '{filename}', "
+                                   f"expected one of {', '.join(UPLOAD_EXTENSIONS)}")
+        if size > self.max_bytes:
+            raise UploadTooLarge(f"Upload of {size} bytes exceeds the {self.max_bytes} byte limit")
+        self.expire()
+        session = UploadSession(uuid.uuid4().hex, Path(filename).name, size, analysis, self.root)
+        session.part_path.touch()
+        session.save()
+        self._sessions[session.id] = session
+        return session
+
+    def get(self, upload_id: str):
+        return self._sessions.get(upload_id)
+
+    def expire(self):
+        """Deletes unfinished uploads that were not touched for UPLOAD_EXPIRE_SECONDS."""
+        cutoff = time.time() - UPLOAD_EXPIRE_SECONDS
+        for session in list(self._sessions.values()):
+            if session.status != COMPLETE and session.updated_at < cutoff:
+                self._discard(session)
+
+    def _discard(self, session: UploadSession):
+        for path in (session.part_path, session.meta_path):
+            path.unlink(missing_ok=True)
+        self._sessions.pop(session.id, None)
+
+    async def append(self, session: UploadSession, offset: int, chunks, on_chunk=None) -> UploadSession:
+        """
+        Streams a request body into the upload in UPLOAD_CHUNK_BYTES pieces, hashing them as they are written.
+        Bytes received before a disconnect are kept, so the client resumes at session.offset.
+
+        :param chunks: Async iterator of body bytes (Request.stream()).
+        :param on_chunk: Called with the session after every chunk written to disk (e.g. to start an analysis early).
+        :raises UploadOffsetMismatch: offset is not where the upload continues.
+        :raises UploadTooLarge: The body goes past the declared size.
+        :raises UnsupportedVideo: The header or the complete file is not a decodable video; the upload is deleted.
+        """
+        async with session.lock:
+            if session.status != UPLOADING or offset != session.offset:
+                raise UploadOffsetMismatch(session.offset)
+            try:
+                await self._receive(session, chunks, on_chunk)
+                if session.offset == session.size:
+                    if not session.probed:
+                        await asyncio.to_thread(session.probe)
+                    await asyncio.to_thread(session.finish)
+            except UnsupportedVideo as e:
+                session.status, session.error = FAILED, str(e)
+                session.part_path.unlink(missing_ok=True)
+                session.path.unlink(missing_ok=True)
+                raise
+            finally:
+                session.updated_at = time.time()
+                await asyncio.to_thread(session.save)
+        return session
+
+    async def _receive(self, session: UploadSession, chunks, on_chunk):
+        buffer = bytearray()
+        with open(session.part_path, 'ab') as f:
+            try:
+                async for data in chunks:
+                    if session.offset + len(buffer) + len(data) > session.size:
+                        raise UploadTooLarge(f"Upload is {session.size} bytes, more were sent")
+                    buffer += data
+                    if len(buffer) >= UPLOAD_CHUNK_BYTES:
+                        # Disk yozuvi va xesh event loop dan tashqarida; xotirada faqat bitta bo'lak turadi
+                        await asyncio.to_thread(session.write, f, buffer)
+                        buffer.clear()
+                        if not session.probed and session.offset >= UPLOAD_PROBE_BYTES:
+                            f.flush()
+                            await asyncio.to_thread(session.probe)
+                        if on_chunk is not None:
+                            f.flush()
+                            on_chunk(session)
+            finally:
+                # Uzilishda ham kelgan baytlar saqlanadi, mijoz session.offset dan davom ettiradi
+                if buffer:
+                    await asyncio.to_thread(session.write, f, buffer)
+                    buffer.clear()
+
+
+class GrowingFileCapture:
+    """
+    cv2.VideoCapture-like reader (isOpened/get/read/release) of an upload that is still arriving. A thread
+    follows the .part file and feeds its bytes to an ffmpeg process that decodes them to raw BGR frames; the
+    stream ends when the upload was renamed to its final path and all bytes were read. When no byte arrived
+    for UPLOAD_STALL_TIMEOUT_SECONDS, read() raises UploadIncomplete at the end of the received frames, so a
+    result never silently covers only part of the video.
+    """
+
+    def __init__(self, part_path: Path, final_path: Path):
+        self.part_path = Path(part_path)
+        self.final_path = Path(final_path)
+        # Kadr o'lchami, fps va (MP4 da) kadrlar soni allaqachon kelgan sarlavhadan olinadi
+        probe = cv2.VideoCapture(str(self.part_path))
+        self._properties = {prop: probe.get(prop) for prop in (cv2.CAP_PROP_FPS, cv2.CAP_PROP_FRAME_WIDTH,
+                                                               cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FRAME_COUNT)}
+        opened = probe.isOpened()
+        probe.release()
+        self.width = int(self._properties[cv2.CAP_PROP_FRAME_WIDTH])
+        self.height = int(self._properties[cv2.CAP_PROP_FRAME_HEIGHT])
+        self._process = None
+        # Yuklash tugamasdan bayt kelishi to'xtadi: oqim oxiri videoning oxiri emas
+        self.stalled = False
+        if not opened or not self.width or not self.height:
+            return
+        command = [FFMPEG_BINARY, '-loglevel', 'error', '-nostats', '-i', 'pipe:0', '-map', '0:v:0', '-an',
+                   '-fps_mode', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+        self._feeder = threading.Thread(target=self._feed, name="upload-follower", daemon=True)
+        self._feeder.start()
+
+    def _feed(self):
+        idle_since = time.monotonic()
+        try:
+            with open(self.part_path, 'rb') as f:
+                while True:
+                    # Fayl nomi o'zgartirilgani tekshirilgandan keyin o'qilgan bo'sh natija - haqiqiy oxir
+                    complete = self.final_path.exists()
+                    data = f.read(UPLOAD_CHUNK_BYTES)
+                    if data:
+                        self._process.stdin.write(data)
+                        idle_since = time.monotonic()
+                    elif complete:
+                        break
+                    elif time.monotonic() - idle_since > UPLOAD_STALL_TIMEOUT_SECONDS:
+                        self.stalled = True
+                        break
+                    else:
+                        time.sleep(UPLOAD_POLL_SECONDS)
+        except (BrokenPipeError, OSError, ValueError):
+            pass
+        finally:
+            try:
+                self._process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    def isOpened(self) -> bool:
+        return self._process is not None
+
+    def get(self, prop) -> float:
+        return self._properties.get(prop, 0.0)
+
+    def read(self):
+        if self._process is None:
+            return False, None
+        # Kadr to'g'ridan-to'g'ri yangi massivga o'qiladi (chizish uchun yoziladigan, qo'shimcha nusxasiz)
+        frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        if self._process.stdout.readinto(memoryview(frame).cast('B')) < frame.nbytes:
+            if self.stalled:
+                raise UploadIncomplete(f"No bytes of {self.final_path.name} arrived for "
+                                       f"{UPLOAD_STALL_TIMEOUT_SECONDS}s before the upload was complete; "
+                                       f"it is analysed again once the upload finishes")
+            return False, None
+        return True, frame
+
+    def release(self):
+        if self._process is None:
+            return
+        self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        self._process = None
+
+
+def open_video_capture(video_path):
+    """cv2.VideoCapture of a video, or GrowingFileCapture while the video is still being uploaded."""
+    path = Path(video_path)
+    part_path = path.with_name(path.name + PART_SUFFIX)
+    if not path.exists() and part_path.exists():
+        return GrowingFileCapture(part_path, path)
+    return cv2.VideoCapture(str(video_path))
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+
+from detections import FrameDetections, resolve_class_ids
+
+# --- CONFIGURATION ---
+# Rules checked on every analysed frame, in this order (names from RULES)
+VIOLATION_RULES = [name.strip() for name in os.environ.get(
+    "VIOLATION_RULES", "red_light_crosswalk,stop_line_crossing,pedestrian_crosswalk").split(",") if name.strip()]
+# A track that stops violating a rule for this long may be reported again as a new event
+RULE_REARM_SECONDS = 2.0
+
+RULES = {}
+
+
+def register_rule(rule_class):
+    """Class decorator that makes a rule available to VIOLATION_RULES under its `name`."""
+    RULES[rule_class.name] = rule_class
+    return rule_class
+
+
+def box_centroids(xyxy):
+    """(N, 2) centres of (N, 4) boxes."""
+    return np.stack(((xyxy[:, 0] + xyxy[:, 2]) / 2, (xyxy[:, 1] + xyxy[:, 3]) / 2), axis=1)
+
+
+def points_in_boxes(points, boxes):
+    """(P, B) matrix: point p lies strictly inside box b."""
+    x = points[:, 0:1]
+    y = points[:, 1:2]
+    return (boxes[:, 0] < x) & (x < boxes[:, 2]) & (boxes[:, 1] < y) & (y < boxes[:, 3])
+
+
+class ViolationRule:
+    """
+    Base class of a violation rule. Subclasses implement condition(), which marks the tracked objects
+    that violate the rule in this frame using array operations over all tracks at once. The base class
+    keeps per-track state so that a track is reported once per event, not once per frame.
+    """
+
+    name = None
+    violation_type = None
+
+    def __init__(self, class_names: dict, fps: float, rearm_seconds: float = RULE_REARM_SECONDS):
+        self.class_names = class_names
+        self.rearm_frames = max(1, int(rearm_seconds * fps))
+        self._last_violating = {}
+
+    def condition(self, frame_idx: int, track_ids, tracks: FrameDetections):
+        """:return: Boolean mask over the tracked objects of this frame."""
+        raise NotImplementedError
+
+    def evaluate(self, frame_idx: int, track_ids, tracks: FrameDetections):
+        """:return: Rows of the tracked objects whose violation event starts in this frame."""
+        rows = np.flatnonzero(self.condition(frame_idx, track_ids, tracks))
+        new_rows = []
+        for row in rows.tolist():
+            track_id = int(track_ids[row])
+            if frame_idx - self._last_violating.get(track_id, -self.rearm_frames - 1) > self.rearm_frames:
+                new_rows.append(row)
+            self._last_violating[track_id] = frame_idx
+        # Eski hodisalar holatini tozalaymiz, xotira treklar soni bilan chegaralanadi
+        if len(self._last_violating) > 256:
+            self._last_violating = {track_id: last for track_id, last in self._last_violating.items()
+                                    if frame_idx - last <= self.rearm_frames}
+        return new_rows
+
+
+@register_rule
+class RedLightCrosswalkRule(ViolationRule):
+    """Car centroid inside a crosswalk while a red light is visible."""
+
+    name = "red_light_crosswalk"
+    violation_type = "Qizil chiroqda o'tish"
+
+    def __init__(self, class_names: dict, fps: float, **kwargs):
+        super().__init__(class_names, fps, **kwargs)
+        self.car_cls, self.crosswalk_cls, self.red_light_cls = resolve_class_ids(
+            class_names, 'car', 'crosswalk', 'traffic_light_red')
+
+    def condition(self, frame_idx, track_ids, tracks):
+        mask = np.zeros(len(tracks), dtype=bool)
+        cars = tracks.cls == self.car_cls
+        crosswalks = tracks.xyxy[tracks.cls == self.crosswalk_cls]
+        if not cars.any() or not len(crosswalks) or not np.any(tracks.cls == self.red_light_cls):
+            return mask
+        mask[cars] = points_in_boxes(box_centroids(tracks.xyxy[cars]), crosswalks).any(axis=1)
+        return mask
+
+
+@register_rule
+class StopLineCrossingRule(ViolationRule):
+    """
+    Car centroid crosses a stop line ('line' class) between two analysed frames while a red light is
+    visible. A line box wider than tall is treated as a horizontal line at its centre y, otherwise as a
+    vertical line at its centre x; the car must be within the line's extent along it.
+    """
+
+    name = "stop_line_crossing"
+    violation_type = "Qizil chiroqda stop chizig'ini kesib o'tish"
+
+    def __init__(self, class_names: dict, fps: float, **kwargs):
+        super().__init__(class_names, fps, **kwargs)
+        self.car_cls, self.line_cls, self.red_light_cls = resolve_class_ids(
+            class_names, 'car', 'line', 'traffic_light_red')
+        # track_id -> (oxirgi kadr, markaz)
+        self._previous = {}
+
+    def condition(self, frame_idx, track_ids, tracks):
+        mask = np.zeros(len(tracks), dtype=bool)
+        cars = np.flatnonzero(tracks.cls == self.car_cls)
+        if not len(cars):
+            return mask
+        car_ids = track_ids[cars].tolist()
+        current = box_centroids(tracks.xyxy[cars])
+        previous = np.full_like(current, np.nan)
+        for i, track_id in enumerate(car_ids):
+            if track_id in self._previous:
+                previous[i] = self._previous[track_id][1]
+        for track_id, point in zip(car_ids, current):
+            self._previous[track_id] = (frame_idx, point)
+        if len(self._previous) > 256:
+            self._previous = {track_id: value for track_id, value in self._previous.items()
+                              if frame_idx - value[0] <= self.rearm_frames}
+
+        lines = tracks.xyxy[tracks.cls == self.line_cls]
+        if not len(lines) or not np.any(tracks.cls == self.red_light_cls):
+            return mask
+        horizontal = (lines[:, 2] - lines[:, 0]) >= (lines[:, 3] - lines[:, 1])
+        # Chiziq o'qi bo'yicha holat (pos) va chiziq bo'ylab oraliq (span_lo, span_hi), (L,) shaklida
+        axis = np.where(horizontal, 1, 0)
+        pos = np.where(horizontal, (lines[:, 1] + lines[:, 3]) / 2, (lines[:, 0] + lines[:, 2]) / 2)
+        span_lo = np.where(horizontal, lines[:, 0], lines[:, 1])
+        span_hi = np.where(horizontal, lines[:, 2], lines[:, 3])
+        # (C, L) matritsalar
+        before = previous[:, axis] - pos
+        after = current[:, axis] - pos
+        along = current[:, 1 - axis]
+        crossed = ((before < 0) & (after >= 0)) | ((before > 0) & (after <= 0))
+        crossed &= (span_lo <= along) & (along <= span_hi)
+        mask[cars] = crossed.any(axis=1)
+        return mask
+
+
+@register_rule
+class PedestrianCrosswalkRule(ViolationRule):
+    """Car centroid inside a crosswalk on which a pedestrian is standing (feet point inside it)."""
+
+    name = "pedestrian_crosswalk"
+    violation_type = "Piyodaga yo'l bermaslik"
+
+    def __init__(self, class_names: dict, fps: float, **kwargs):
+        super().__init__(class_names, fps, **kwargs)
+        self.car_cls, self.crosswalk_cls, self.person_cls = resolve_class_ids(
+            class_names, 'car', 'crosswalk', 'person')
+
+    def condition(self, frame_idx, track_ids, tracks):
+        mask = np.zeros(len(tracks), dtype=bool)
+        cars = tracks.cls == self.car_cls
+        people = tracks.xyxy[tracks.cls == self.person_cls]
+        crosswalks = tracks.xyxy[tracks.cls == self.crosswalk_cls]
+        if not cars.any() or not len(people) or not len(crosswalks):
+            return mask
+        feet = np.stack(((people[:, 0] + people[:, 2]) / 2, people[:, 3]), axis=1)
+        occupied = crosswalks[points_in_boxes(feet, crosswalks).any(axis=0)]
+        if len(occupied):
+            mask[cars] = points_in_boxes(box_centroids(tracks.xyxy[cars]), occupied).any(axis=1)
+        return mask
+
+
+class RuleEngine:
+    """Evaluates the configured rules over the tracked objects of each frame."""
+
+    def __init__(self, class_names: dict, fps: float, rule_names=None, **rule_kwargs):
+        rule_names = VIOLATION_RULES if rule_names is None else rule_names
+        unknown = [name for name in rule_names if name not in RULES]
+        if unknown:
+            raise ValueError(f"Unknown violation rules {unknown}, available: {sorted(RULES)}")
+        self.rules = [RULES[name](class_names, fps, **rule_kwargs) for name in rule_names]
+
+    def evaluate(self, frame_idx: int, track_ids, tracks: FrameDetections) -> list:
+        """:return: (rule, row) pairs of the violation events that start in this frame."""
+        events = []
+        for rule in self.rules:
+            events.extend((rule, row) for row in rule.evaluate(frame_idx, track_ids, tracks))
+        return events